@@ -75,9 +75,8 @@ def main():
     dataset.load_coco(FILAMENT_DIR,"val")
     dataset.prepare()
     print("Images: {}\nClasses: {}".format(len(dataset.image_ids), dataset.class_names))
-    with tf.device(DEVICE):
-        model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR,
-                              config=config)
+    model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR,
+                              config=config, device=DEVICE)
     weights_path = MODEL_PATH
     print("Loading weights ", weights_path)
     model.load_weights(weights_path, by_name=True)
@@ -29,8 +29,8 @@ sys.path.append(ROOT_DIR)  # To find local version of the library
 from mrcnn import utils
 from mrcnn import visualize
 from mrcnn.visualize import display_images
-import mrcnn.model_background as modellib
-from mrcnn.model_background import log
+import mrcnn.model as modellib
+from mrcnn.model import log
 import filament_fix
 
 args = sys.argv
@@ -66,9 +66,8 @@ def main():
     dataset.load_coco(FILAMENT_DIR,"val")
     dataset.prepare()
     print("Images: {}\nClasses: {}".format(len(dataset.image_ids), dataset.class_names))
-    with tf.device(DEVICE):
-        model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR,
-                              config=config)
+    model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR,
+                              config=config, device=DEVICE)
     weights_path = MODEL_PATH
     print("Loading weights ", weights_path)
     model.load_weights(weights_path, by_name=True)
@@ -80,13 +79,16 @@ def main():
     print("image ID: {}.{} ({}) {}".format(info["source"], info["id"], image_id, 
                                         dataset.image_reference(image_id)))
     # Run object detection
-    results = model.detect([image], verbose=1)
+    # backgroundと判定された候補領域も同じ推論で返す
+    results = model.detect([image], verbose=1, background=True)
 
     # Display results
     ax = get_ax(1)
 
     #resultsの中身にbackgroundのbboxが含まれているのかを確認するために追加した
     print(results[0])
+    log("background_rois", results[0]["background_rois"])
+    log("background_scores", results[0]["background_scores"])
     sys.exit()
 
     r = results[0]
@@ -0,0 +1,100 @@
+"""
+Mask R-CNN
+Batched bilinear crop-and-resize of binary masks in numpy.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Used by utils.minimize_mask() and utils.expand_mask(). It has no
+TensorFlow dependency, so it can be tested on its own.
+"""
+
+import numpy as np
+
+
+def _bilinear_taps(start, size, out_size, out_max):
+    """Computes the two interpolation taps along one axis for a batch of
+    crops. Uses the same pixel-center mapping as skimage's resize():
+    src = (dst + 0.5) * size / out_size - 0.5. Taps that fall outside the
+    crop get a weight of zero, like mode='constant' with cval=0.
+
+    start, size: [N] crop offsets and lengths in source pixels.
+    out_size: [N] output lengths. Rows beyond out_size (up to out_max) are
+        padding and get zero weights.
+
+    Returns (lo, hi, w_lo, w_hi), each [N, out_max]. lo and hi are absolute
+    source indices, always valid for indexing.
+    """
+    dst = np.arange(out_max, dtype=np.float64) + 0.5
+    src = dst[np.newaxis] * (size / np.maximum(out_size, 1))[:, np.newaxis] - 0.5
+    lo = np.floor(src).astype(np.int64)
+    frac = src - lo
+    hi = lo + 1
+    size = size[:, np.newaxis]
+    inside = np.arange(out_max)[np.newaxis] < out_size[:, np.newaxis]
+    w_lo = (1 - frac) * ((lo >= 0) & (lo < size) & inside)
+    w_hi = frac * ((hi >= 0) & (hi < size) & inside)
+    last = np.maximum(size - 1, 0)
+    lo = np.clip(lo, 0, last) + start[:, np.newaxis]
+    hi = np.clip(hi, 0, last) + start[:, np.newaxis]
+    return lo, hi, w_lo, w_hi
+
+
+def crop_and_resize(images, boxes, output_shape):
+    """Crops a box out of each mask and resizes it with bilinear
+    interpolation. All instances are processed in one vectorized pass.
+
+    Rounded, the results are the masks that resize(mask[y1:y2, x1:x2], shape)
+    gives for every instance, without the per-instance Python loop and
+    dtype conversions.
+
+    images: [height, width, N] bool (or 0/1) masks. One mask per box.
+    boxes: [N, (y1, x1, y2, x2)] in pixels. (y2, x2) is outside the box.
+    output_shape: (height, width) shared by all crops, or
+        [N, (height, width)] for a different size per crop. In the latter
+        case the results are zero padded to the largest size.
+
+    Returns: [N, height, width] float64 array.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape([-1, 4])[:, :4]
+    n = boxes.shape[0]
+    output_shape = np.broadcast_to(
+        np.asarray(output_shape, dtype=np.int64), (n, 2))
+    out_h, out_w = output_shape.max(axis=0) if n else (0, 0)
+    y_lo, y_hi, wy_lo, wy_hi = _bilinear_taps(
+        boxes[:, 0], boxes[:, 2] - boxes[:, 0], output_shape[:, 0], out_h)
+    x_lo, x_hi, wx_lo, wx_hi = _bilinear_taps(
+        boxes[:, 1], boxes[:, 3] - boxes[:, 1], output_shape[:, 1], out_w)
+
+    ix = np.arange(n)[:, np.newaxis, np.newaxis]
+
+    def tap(rows, cols):
+        return images[rows[:, :, np.newaxis], cols[:, np.newaxis, :], ix]
+
+    # The four taps of every output pixel and their weights, [4, N, h, w]
+    taps = np.stack([tap(y_lo, x_lo), tap(y_lo, x_hi),
+                     tap(y_hi, x_lo), tap(y_hi, x_hi)])
+    wy_lo = wy_lo[:, :, np.newaxis]
+    wy_hi = wy_hi[:, :, np.newaxis]
+    wx_lo = wx_lo[:, np.newaxis, :]
+    wx_hi = wx_hi[:, np.newaxis, :]
+    weights = np.stack([wy_lo * wx_lo, wy_lo * wx_hi,
+                        wy_hi * wx_lo, wy_hi * wx_hi])
+    crops = (weights * taps).sum(axis=0)
+
+    # Clip each crop to the range of its values, like resize(clip=True).
+    # Otherwise the zero padded edges of uniform crops, e.g. the masks of
+    # 1 pixel wide boxes, fall below the value of the crop. The range is
+    # taken from the sampled pixels: along upscaled axes those are all the
+    # pixels of the crop, and along downscaled axes no taps fall outside
+    # the crop, so the rounded results are the same.
+    sampled = weights > 0
+    crop_min = np.where(sampled, taps, np.inf).min(axis=(0, 2, 3), initial=np.inf)
+    crop_max = np.where(sampled, taps, -np.inf).max(axis=(0, 2, 3), initial=-np.inf)
+    # Crops with no output pixels
+    empty = crop_min > crop_max
+    crop_min[empty] = 0
+    crop_max[empty] = 0
+    crops = np.clip(crops, crop_min[:, np.newaxis, np.newaxis],
+                    crop_max[:, np.newaxis, np.newaxis])
+    # Keep the padding beyond the output size of each crop at zero
+    return crops * sampled.any(axis=0)
@@ -98,11 +98,34 @@ class Config(object):
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
 
+    # Extra ROIs that the inference model takes as an input and classifies
+    # along with the RPN proposals, zero padded. The tracker in
+    # mrcnn/sequence.py feeds it the previous frame's detections moved by
+    # the solar rotation, so objects that are still there are found even
+    # with a much lower POST_NMS_ROIS_INFERENCE. 0 for no such input.
+    PRIOR_ROIS = 0
+
     # If enabled, resizes instance masks to a smaller size to reduce
     # memory load. Recommended when using high-resolution images.
     USE_MINI_MASK = True
     MINI_MASK_SHAPE = (56, 56)  # (height, width) of the mini-mask
 
+    # If enabled, and the dataset implements load_polygons(), augmentation
+    # is applied to the annotation polygons rather than to the full-size
+    # mask stack, and the masks are rasterized afterwards. The cost of
+    # augmentation then no longer grows with instance count times image
+    # area. Only geometric augmenters (flips, Rot90, Affine, ...) move the
+    # polygons, the same ones that are applied to masks otherwise.
+    AUGMENT_POLYGONS = False
+
+    # If enabled, and the dataset implements load_polygons(), masks are
+    # always built from the annotation polygons: the polygons are scaled
+    # and padded like the image and rasterized at the training resolution.
+    # With USE_MINI_MASK each instance is rasterized straight into its
+    # mini-mask, skipping the full-size masks entirely. For augmented
+    # images AUGMENT_POLYGONS decides instead.
+    RASTERIZE_POLYGONS = False
+
     # Input image resizing
     # Generally, use the "square" resizing mode for training and predicting
     # and it should work well in most cases. In this mode, images are scaled
@@ -123,6 +146,11 @@ class Config(object):
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
     #         IMAGE_MAX_DIM is not used in this mode.
+    # disk:   For full-disk solar frames. Crops the bounding square of the
+    #         solar disk and scales it to IMAGE_MAX_DIM x IMAGE_MAX_DIM, so that
+    #         the empty corners of the frame are left out. The disk is found
+    #         as in DISK_MASK. Falls back to square if there's no disk or it's
+    #         implausibly small (see utils.DISK_MIN_SIZE).
     IMAGE_RESIZE_MODE = "square"
     IMAGE_MIN_DIM = 800
     IMAGE_MAX_DIM = 1024
@@ -149,10 +177,33 @@ class Config(object):
     # Percent of positive ROIs used to train classifier/mask heads
     ROI_POSITIVE_RATIO = 0.33
 
+    # Full-disk solar frames: a bright disk with black corners. If True, the
+    # anchors that don't overlap the disk (grown by DISK_MARGIN pixels) are
+    # left out of the RPN targets, so they're never sampled as negatives,
+    # and are never picked as proposals at inference. The disk of a frame
+    # comes from Dataset.load_disk() or, if the dataset doesn't know it, is
+    # found from the pixels brighter than DISK_THRESHOLD (utils.find_disk()).
+    # Bright regions smaller than utils.DISK_MIN_SIZE of the shorter image
+    # side aren't taken as the disk, and those frames keep all anchors.
+    # DISK_THRESHOLD also applies to the disk IMAGE_RESIZE_MODE.
+    DISK_MASK = False
+    DISK_THRESHOLD = 16
+    DISK_MARGIN = 16
+
     # Pooled ROIs
     POOL_SIZE = 7
     MASK_POOL_SIZE = 14
 
+    # Pool the ROIs of all pyramid levels with one crop_and_resize over the
+    # levels packed into a single feature map, instead of one crop per level
+    # followed by a sort back into box order. Same results up to float error
+    # (< 1e-4). Saves many small ops per image, at the cost of a copy 1.5x
+    # the size of P2, so it only pays off when the crops dominate. On one
+    # CPU core, TF 1.3, 1000 ROIs on a 1024px image: 220ms fused vs 160ms
+    # per level with 7x7 pools, 600ms vs 665ms with 14x14 pools. Measure
+    # with sasaki20/benchmark_roi_align.py before turning it on.
+    FUSED_ROI_ALIGN = False
+
     # Shape of output mask
     # To change this you also need to change the neural network mask branch
     MASK_SHAPE = [28, 28]
@@ -210,6 +261,40 @@ class Config(object):
     # Gradient norm clipping
     GRADIENT_CLIP_NORM = 5.0
 
+    # Checkpoints are written at the end of every epoch, on a background
+    # thread. If > 0, only this many of them are kept, those with the best
+    # exponential moving average (EMA) of the validation loss, plus the
+    # latest one. 0 keeps all checkpoints.
+    CHECKPOINT_KEEP_BEST = 0
+    # Weight of the previous EMA value when averaging the validation loss
+    CHECKPOINT_EMA_WEIGHT = 0.7
+
+    # Training losses are appended to metrics.jsonl in the log directory
+    # at the end of every epoch, and for every Nth training step. Set to 0
+    # to log epochs only. See mrcnn.metrics to read them back.
+    METRICS_LOG_STEPS = 10
+
+    # Log where the time of each training step goes: waiting for the data
+    # generator vs. the forward/backward pass, and how many batches were
+    # queued. Written to step_times.csv in the log directory, with a summary
+    # and the slowest images to load printed at the end of every epoch.
+    LOG_STEP_TIMES = False
+
+    # Directory for caches that the processes of one machine share, e.g.
+    # the anchor tables of experiments run in parallel. None disables them.
+    CACHE_DIR = None
+
+    # Train the "heads" layers from backbone feature maps (C2 to C5) that are
+    # computed once per image, and per flipped image, and stored as float16
+    # in CACHE_DIR. The backbone is frozen while training the heads, so its
+    # outputs don't change, and running it is most of a step on the CPU.
+    # Runs with the same backbone weights and images share the cache, e.g.
+    # the trials of a search. Takes 60 x IMAGE_MAX_DIM^2 bytes per image
+    # and flip with ResNet, 63MB at 1024. Needs CACHE_DIR, TRAIN_BN False,
+    # the "square" or "disk" IMAGE_RESIZE_MODE, and no augmentation other
+    # than imgaug's Fliplr.
+    FEATURE_CACHE = False
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
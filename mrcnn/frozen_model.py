@@ -0,0 +1,193 @@
+"""
+Mask R-CNN
+Frozen inference graph export and a light-weight detector to run it.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import tensorflow as tf
+import keras.backend as K
+
+from mrcnn.model import MaskRCNN
+from mrcnn.instrument import timed
+
+
+# Names of the input and output nodes of an exported graph
+INPUT_NAMES = ["input_image", "input_image_meta", "input_anchors"]
+# Extra input of graphs exported with Config.PRIOR_ROIS
+PRIOR_INPUT_NAME = "input_prior_rois"
+OUTPUT_NAMES = ["output_detections", "output_mrcnn_mask"]
+# Outputs for detect(background=True). The ops that compute them are
+# needed for the detections anyway, so exporting them costs nothing.
+BACKGROUND_OUTPUT_NAMES = ["output_mrcnn_class", "output_rpn_rois"]
+
+# Graph Transform Tool passes applied on export. The graph is already
+# reduced to what the two outputs need at this point, so these only fold
+# the frozen weights and batch norms into fewer ops.
+DEFAULT_TRANSFORMS = [
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+]
+
+
+def rename_nodes(graph_def, names):
+    """Renames nodes of a GraphDef in place and updates the references to them.
+    names: dict of {old name: new name}
+    """
+    for node in graph_def.node:
+        if node.name in names:
+            node.name = names[node.name]
+        for i, inp in enumerate(node.input):
+            # Inputs look like "name", "name:1" or "^name" (control input)
+            prefix = "^" if inp.startswith("^") else ""
+            name, sep, port = inp.lstrip("^").partition(":")
+            if name in names:
+                node.input[i] = prefix + names[name] + sep + port
+
+
+def export_frozen_graph(model, path, transforms=None):
+    """Writes a self-contained graph of an inference model for FrozenDetector.
+
+    The weights are turned into constants, everything that doesn't feed the
+    detections and masks (rpn_class, rpn_bbox, mrcnn_bbox, training-only
+    ops, ...) is dropped, and the Keras learning phase is
+    fixed to inference. The result is a single binary GraphDef file.
+
+    model: A MaskRCNN object in inference mode with the weights loaded
+    path: Path of the .pb file to write
+    transforms: List of Graph Transform Tool passes to optimize the frozen
+        graph with. Defaults to DEFAULT_TRANSFORMS. Pass [] to skip.
+    """
+    assert model.mode == "inference", "Create model in inference mode."
+    assert model.config.GPU_COUNT == 1, "Export a single GPU model."
+    transforms = DEFAULT_TRANSFORMS if transforms is None else transforms
+
+    # Name the outputs so the detector can find them
+    keras_model = model.keras_model
+    with model.as_default():
+        tf.identity(keras_model.outputs[0], name=OUTPUT_NAMES[0])
+        tf.identity(keras_model.outputs[3], name=OUTPUT_NAMES[1])
+        tf.identity(keras_model.outputs[1], name=BACKGROUND_OUTPUT_NAMES[0])
+        tf.identity(keras_model.outputs[4], name=BACKGROUND_OUTPUT_NAMES[1])
+        phase = K.learning_phase()
+    output_names = OUTPUT_NAMES + BACKGROUND_OUTPUT_NAMES
+    input_names = INPUT_NAMES + ([PRIOR_INPUT_NAME] if model.config.PRIOR_ROIS else [])
+
+    # Freeze the weights. This also drops all nodes the outputs don't use.
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        model.session, model.graph.as_graph_def(), output_names)
+
+    # Keras may have uniquified the input names (e.g. "input_image_1")
+    rename_nodes(graph_def, {t.op.name: name for t, name in
+                             zip(keras_model.inputs, input_names)})
+
+    # The graph only works with the batch size it was built with. Put it in
+    # the shape of the inputs, so that FrozenDetector can check it.
+    for node in graph_def.node:
+        if node.name in input_names and node.op == "Placeholder":
+            node.attr["shape"].shape.dim[0].size = model.config.BATCH_SIZE
+
+    # Replace the learning phase placeholder, if it's used, with a constant
+    if not isinstance(phase, int):
+        for node in graph_def.node:
+            if node.name == phase.op.name:
+                node.op = "Const"
+                if "shape" in node.attr:
+                    del node.attr["shape"]
+                node.attr["value"].tensor.CopyFrom(
+                    tf.make_tensor_proto(False, dtype=tf.bool))
+
+    if transforms:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, input_names, output_names,
+                                   transforms)
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return path
+
+
+def read_batch_size(path):
+    """Returns the batch size that a graph written by export_frozen_graph()
+    was built with, or None if the graph doesn't record it.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    for node in graph_def.node:
+        if node.name == INPUT_NAMES[0]:
+            size = node.attr["shape"].shape.dim[0].size if "shape" in node.attr else -1
+            return size if size > 0 else None
+    return None
+
+
+class FrozenDetector(MaskRCNN):
+    """Runs a graph written by export_frozen_graph() on the CPU.
+
+    Pre- and post-processing are those of MaskRCNN, so detect() and
+    detect_molded() return the same results. No Keras model is built, so
+    the training and inspection methods are not available.
+    """
+
+    def __init__(self, path, config, intra_op_threads=0, inter_op_threads=0):
+        """
+        path: Path to a .pb file written by export_frozen_graph()
+        config: The configuration the graph was exported with. It's used
+            to mold the inputs and to generate the anchors. Its BATCH_SIZE
+            must match the one of the export.
+        intra_op_threads, inter_op_threads: TensorFlow thread pool sizes.
+            0 lets TensorFlow pick.
+        """
+        self.mode = "inference"
+        self.config = config
+        self.keras_model = None
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs = [self.graph.get_tensor_by_name(name + ":0")
+                       for name in INPUT_NAMES]
+        # Graphs exported before the batch size was recorded can't be checked
+        batch_size = self.inputs[0].shape[0].value
+        if batch_size is not None and batch_size != config.BATCH_SIZE:
+            raise ValueError(
+                "The graph was exported with a batch size of {}, but the config "
+                "has BATCH_SIZE {}.".format(batch_size, config.BATCH_SIZE))
+        if config.PRIOR_ROIS:
+            self.inputs.append(self.graph.get_tensor_by_name(PRIOR_INPUT_NAME + ":0"))
+        self.outputs = [self.graph.get_tensor_by_name(name + ":0")
+                        for name in OUTPUT_NAMES]
+        # Graphs exported before these outputs were added don't have them
+        try:
+            self.background_outputs = [self.graph.get_tensor_by_name(name + ":0")
+                                       for name in BACKGROUND_OUTPUT_NAMES]
+        except KeyError:
+            self.background_outputs = None
+
+        session_config = tf.ConfigProto(
+            device_count={"GPU": 0},
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+    @timed
+    def predict_detections(self, molded_images, image_metas, anchors, background=False,
+                           prior_rois=None):
+        """Runs the frozen graph. See MaskRCNN.predict_detections()."""
+        feed_dict = dict(zip(self.inputs, [molded_images, image_metas, anchors] +
+                             self.prior_rois_input(prior_rois)))
+        if background:
+            if self.background_outputs is None:
+                raise ValueError("The graph has no background outputs. Export it again.")
+            return tuple(self.session.run(self.outputs + self.background_outputs,
+                                          feed_dict))
+        detections, mrcnn_mask = self.session.run(self.outputs, feed_dict)
+        return detections, mrcnn_mask
+
+    def close(self):
+        """Releases the TensorFlow session."""
+        self.session.close()
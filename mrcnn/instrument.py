@@ -0,0 +1,153 @@
+"""
+Mask R-CNN
+Low-overhead timing registry for the hot paths.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Disabled unless the MRCNN_PROFILE environment variable is set when mrcnn is
+imported. Then every function decorated with @timed records its call count
+and durations, and a report is printed to stderr at exit:
+
+    MRCNN_PROFILE=1 python3 filament.py evaluate ...
+
+MRCNN_PROFILE=memory also records the bytes each call allocates (and still
+holds on return, e.g. its result) with tracemalloc, which is slower.
+Call report() or summary() to get the numbers on demand.
+
+Only calls in the current process are recorded. During training
+load_image_gt() and build_rpn_targets() run in the Keras data generator
+worker processes, which are killed rather than exited, so their calls
+are not reported.
+"""
+
+import os
+import sys
+import time
+import array
+import atexit
+import functools
+import threading
+import numpy as np
+
+MODE = os.environ.get("MRCNN_PROFILE", "").lower()
+ENABLED = MODE not in ["", "0", "false"]
+TRACE_MEMORY = MODE == "memory"
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class Stat(object):
+    """Durations and allocations of the calls of one function."""
+
+    def __init__(self, name):
+        self.name = name
+        # Compact storage. Training can make millions of calls.
+        self.durations = array.array("d")
+        self.allocated = array.array("d")
+
+    def clear(self):
+        del self.durations[:]
+        del self.allocated[:]
+
+    def add(self, duration, allocated=None):
+        self.durations.append(duration)
+        if allocated is not None:
+            self.allocated.append(allocated)
+
+    def summary(self):
+        """Returns count, total, p50/p95/max duration in ms and, if traced,
+        mean and max bytes allocated per call."""
+        # Copy. Other threads may keep appending.
+        d = np.array(self.durations, dtype=np.float64) * 1000
+        s = {
+            "count": len(d),
+            "total_ms": float(d.sum()),
+            "p50_ms": float(np.percentile(d, 50)) if len(d) else 0.,
+            "p95_ms": float(np.percentile(d, 95)) if len(d) else 0.,
+            "max_ms": float(d.max()) if len(d) else 0.,
+        }
+        if len(self.allocated):
+            a = np.array(self.allocated, dtype=np.float64)
+            s["mean_bytes"] = float(a.mean())
+            s["max_bytes"] = float(a.max())
+        return s
+
+
+def get_stat(name):
+    """Returns the Stat registered under name, creating it if needed."""
+    with _lock:
+        if name not in _registry:
+            _registry[name] = Stat(name)
+        return _registry[name]
+
+
+def timed(func=None, name=None):
+    """Decorator that records the calls of a function in the registry.
+    Usage: @timed or @timed(name="...").
+
+    Returns the function unchanged when profiling is disabled, so there's
+    no overhead at all then.
+    """
+    if func is None:
+        return functools.partial(timed, name=name)
+    if not ENABLED:
+        return func
+    stat = get_stat(name or func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if TRACE_MEMORY:
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            if TRACE_MEMORY:
+                stat.add(duration, tracemalloc.get_traced_memory()[0] - before)
+            else:
+                stat.add(duration)
+    return wrapper
+
+
+def summary():
+    """Returns {name: stats dict} of all functions called so far."""
+    with _lock:
+        stats = list(_registry.values())
+    return {s.name: s.summary() for s in stats if len(s.durations)}
+
+
+def report(file=None):
+    """Prints a table of the stats, slowest total time first."""
+    file = file or sys.stderr
+    stats = sorted(summary().items(), key=lambda kv: -kv[1]["total_ms"])
+    if not stats:
+        return
+    columns = "{:40} {:>9} {:>12} {:>10} {:>10} {:>10}"
+    header = columns.format("function", "count", "total ms", "p50 ms",
+                            "p95 ms", "max ms")
+    if TRACE_MEMORY:
+        header += " {:>12} {:>12}".format("mean bytes", "max bytes")
+    print(header, file=file)
+    for name, s in stats:
+        line = columns.format(name[:40], s["count"], "{:.1f}".format(s["total_ms"]),
+                              "{:.2f}".format(s["p50_ms"]), "{:.2f}".format(s["p95_ms"]),
+                              "{:.2f}".format(s["max_ms"]))
+        if "mean_bytes" in s:
+            line += " {:12.0f} {:12.0f}".format(s["mean_bytes"], s["max_bytes"])
+        print(line, file=file)
+
+
+def reset():
+    """Clears all recorded calls."""
+    with _lock:
+        for stat in _registry.values():
+            stat.clear()
+
+
+if ENABLED:
+    if TRACE_MEMORY:
+        import tracemalloc
+        tracemalloc.start()
+    atexit.register(report)
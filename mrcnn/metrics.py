@@ -0,0 +1,119 @@
+"""
+Mask R-CNN
+Append-only training metrics store.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Metrics are stored as one JSON record per line (JSONL), so a file is
+always readable up to the last flush, even if training crashes. Training
+writes them through model.MetricsLogger. This module doesn't import
+TensorFlow or Keras, so the reader is cheap to use from plotting scripts.
+"""
+
+import os
+import glob
+import json
+import threading
+from collections import OrderedDict
+
+
+# Default file name of the store in a training log directory
+METRICS_FILE = "metrics.jsonl"
+
+
+class MetricsWriter(object):
+    """Appends records to a JSONL file. write() only buffers the record in
+    memory. A background thread writes the buffer out every
+    `flush_interval` seconds, or sooner when flush() is called, so the
+    training loop never waits for the disk.
+    """
+
+    def __init__(self, path, flush_interval=5.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = open(path, "a")
+        # Terminate a line left partially written by a crash
+        if self.file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        """Buffers a dict of JSON serializable values."""
+        line = json.dumps(record)
+        with self.lock:
+            self.buffer.append(line)
+
+    def flush(self):
+        """Asks the background thread to write the buffer out now."""
+        self.wake.set()
+
+    def write_buffer(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if lines:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+
+    def run(self):
+        """Background thread loop."""
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.write_buffer()
+
+    def close(self):
+        """Writes out what's left and closes the file."""
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.write_buffer()
+        self.file.close()
+
+
+def read_metrics(path, kind="epoch"):
+    """Reads a metrics store into columns.
+
+    path: A metrics file or a training log directory that contains one.
+    kind: "epoch" or "step" records.
+
+    Returns an OrderedDict of {metric name: list of values} with the
+    records sorted by epoch (and step). If an epoch was trained more than
+    once, e.g. because a training stage restarted from an earlier epoch,
+    the latest record wins. Metrics missing from a record are None.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, METRICS_FILE)
+    records = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                # Partially written last line
+                continue
+            if r.get("kind") != kind:
+                continue
+            key = (r["epoch"], r.get("step", 0))
+            # Re-insert so that the latest record wins
+            records.pop(key, None)
+            records[key] = r
+    records = [records[k] for k in sorted(records)]
+    names = []
+    for r in records:
+        names += [n for n in r if n not in names and n != "kind"]
+    return OrderedDict((n, [r.get(n) for r in records]) for n in names)
+
+
+def find_metrics(logs_dir):
+    """Returns the metrics files of all training runs in a logs directory,
+    oldest first."""
+    files = glob.glob(os.path.join(logs_dir, "*", METRICS_FILE))
+    return sorted(files, key=os.path.getmtime)
@@ -12,7 +12,15 @@ import random
 import datetime
 import re
 import math
+import time
+import heapq
+import shutil
+import hashlib
+import queue
+import pickle
 import logging
+import threading
+import contextlib
 from collections import OrderedDict
 import multiprocessing
 import numpy as np
@@ -23,7 +31,8 @@ import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
 
-from mrcnn import utils
+from mrcnn import utils, metrics
+from mrcnn.instrument import timed
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -85,6 +94,21 @@ def compute_backbone_shapes(config, image_shape):
             for stride in config.BACKBONE_STRIDES])
 
 
+def copy_weights(source, target):
+    """Copies the weights of the layers of a Keras model to the layers of
+    the same name in another model. Both must be in the current graph.
+    """
+    def layers(model):
+        # The layers of the inner model in multi-GPU training
+        return model.inner_model.layers if hasattr(model, "inner_model")\
+            else model.layers
+    source_layers = {l.name: l for l in layers(source) if l.weights}
+    pairs = [(t, w) for l in layers(target) if l.weights and l.name in source_layers
+             for t, w in zip(l.weights, source_layers[l.name].weights)]
+    values = K.batch_get_value([w for _, w in pairs])
+    K.batch_set_value(list(zip([t for t, _ in pairs], values)))
+
+
 ############################################################
 #  Resnet Graph
 ############################################################
@@ -281,34 +305,33 @@ class ProposalLayer(KE.Layer):
         deltas = deltas * np.reshape(self.config.RPN_BBOX_STD_DEV, [1, 1, 4])
         # Anchors
         anchors = inputs[2]
+        if self.config.DISK_MASK:
+            # Anchors off the solar disk are zeroed. Rank them last.
+            off_disk = tf.reduce_all(tf.equal(anchors, 0), axis=2)
+            scores = tf.where(off_disk, -tf.ones_like(scores), scores)
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
         pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
-
-        # Apply deltas to anchors to get refined anchors.
+        scores = utils.batch_gather(scores, ix)
+        deltas = utils.batch_gather(deltas, ix)
+        pre_nms_anchors = utils.batch_gather(anchors, ix, name="pre_nms_anchors")
+
+        # Apply deltas to anchors to get refined anchors. The box graphs work
+        # on [N, 4], so flatten the batch rather than slice it.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = apply_box_deltas_graph(tf.reshape(pre_nms_anchors, [-1, 4]),
+                                       tf.reshape(deltas, [-1, 4]))
+        boxes = tf.reshape(boxes, tf.shape(pre_nms_anchors), name="refined_anchors")
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = clip_boxes_graph(tf.reshape(boxes, [-1, 4]), window)
+        boxes = tf.reshape(boxes, tf.shape(pre_nms_anchors),
+                           name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
@@ -317,15 +340,18 @@ class ProposalLayer(KE.Layer):
         # Non-max suppression
         def nms(boxes, scores):
             indices = tf.image.non_max_suppression(
-                boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
+                boxes, scores, self.proposal_count, self.nms_threshold)
             proposals = tf.gather(boxes, indices)
             # Pad if needed
             padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
             proposals = tf.pad(proposals, [(0, padding), (0, 0)])
-            return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+            # Also return the kept indices, padded with -1
+            indices = tf.pad(indices + 1, [(0, padding)]) - 1
+            return [proposals, indices]
+        # Ops inside the map_fn loop can't be fetched. The indices come out
+        # as rpn_non_max_suppression [batch, proposal_count] for inspection.
+        proposals, _ = utils.batch_map([boxes, scores], nms, [tf.float32, tf.int32],
+                                       names=[None, "rpn_non_max_suppression"])
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -346,6 +372,7 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [pool_height, pool_width] of the output pooled regions. Usually [7, 7]
+    - fused: Pool all levels with one crop_and_resize. See crop_fused()
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
@@ -361,9 +388,10 @@ class PyramidROIAlign(KE.Layer):
     constructor.
     """
 
-    def __init__(self, pool_shape, **kwargs):
+    def __init__(self, pool_shape, fused=False, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
+        self.fused = fused
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -392,6 +420,21 @@ class PyramidROIAlign(KE.Layer):
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
+        if self.fused:
+            pooled = self.crop_fused(boxes, roi_level, feature_maps)
+        else:
+            pooled = self.crop_per_level(boxes, roi_level, feature_maps)
+
+        # Re-add the batch dimension
+        shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
+        pooled = tf.reshape(pooled, shape)
+        return pooled
+
+    def crop_per_level(self, boxes, roi_level, feature_maps):
+        """Pools the boxes of each level with their own crop_and_resize and
+        sorts the results back into box order.
+        Returns [batch * num_boxes, pool_height, pool_width, channels]
+        """
         # Loop through levels and apply ROI pooling to each. P2 to P5.
         pooled = []
         box_to_level = []
@@ -440,12 +483,54 @@ class PyramidROIAlign(KE.Layer):
             box_to_level)[0]).indices[::-1]
         ix = tf.gather(box_to_level[:, 2], ix)
         pooled = tf.gather(pooled, ix)
-
-        # Re-add the batch dimension
-        shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
-        pooled = tf.reshape(pooled, shape)
         return pooled
 
+    def crop_fused(self, boxes, roi_level, feature_maps):
+        """Pools all boxes with a single crop_and_resize.
+
+        The levels are packed side by side into one atlas per image: P2 on
+        the left and P3, P4 and P5 stacked on its right. That fits because
+        each level is half the size of the one before. Each box is moved
+        into the region of its level, so the samples land on the same
+        feature map pixels as in crop_per_level(), and the result comes
+        out in box order without the gathers and the sort. The atlas costs
+        a copy 1.5x the size of P2.
+        Returns [batch * num_boxes, pool_height, pool_width, channels]
+        """
+        sizes = [tf.shape(f)[1:3] for f in feature_maps]
+        # Stack P3 to P5 vertically, padded to the width of P3 and the height of P2
+        right = tf.concat([tf.pad(f, [[0, 0], [0, 0], [0, sizes[1][1] - s[1]], [0, 0]])
+                           for f, s in zip(feature_maps[1:], sizes[1:])], axis=1)
+        right = tf.pad(right, [[0, 0], [0, sizes[0][0] - tf.shape(right)[1]],
+                               [0, 0], [0, 0]])
+        atlas = tf.concat([feature_maps[0], right], axis=2)
+
+        # Top left corner of each level in the atlas. [levels, (y, x)]
+        sizes = tf.cast(tf.stack(sizes), tf.float32)
+        offsets = tf.stack([tf.cumsum(tf.stack([0., 0., sizes[1, 0], sizes[2, 0]])),
+                            tf.stack([0.] + [sizes[0, 1]] * 3)], axis=1)
+
+        # Normalized level coordinates to normalized atlas coordinates.
+        # crop_and_resize() maps 0..1 to the centers of the first and the
+        # last pixel, hence the -1s.
+        atlas_size = tf.cast(tf.shape(atlas)[1:3], tf.float32) - 1
+        level = roi_level - 2
+        scale = tf.tile(tf.gather(sizes - 1, level) / atlas_size, [1, 1, 2])
+        shift = tf.tile(tf.gather(offsets, level) / atlas_size, [1, 1, 2])
+        atlas_boxes = tf.reshape(boxes * scale + shift, [-1, 4])
+
+        # Box indices for crop_and_resize.
+        batch, num_boxes = tf.shape(boxes)[0], tf.shape(boxes)[1]
+        box_indices = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch), 1),
+                                         [1, num_boxes]), [-1])
+
+        # Stop gradient propogation to ROI proposals
+        atlas_boxes = tf.stop_gradient(atlas_boxes)
+        box_indices = tf.stop_gradient(box_indices)
+
+        return tf.image.crop_and_resize(atlas, atlas_boxes, box_indices,
+                                        self.pool_shape, method="bilinear")
+
     def compute_output_shape(self, input_shape):
         return input_shape[0][:2] + self.pool_shape + (input_shape[2][-1], )
 
@@ -657,11 +742,12 @@ class DetectionTargetLayer(KE.Layer):
         # Slice the batch and run a graph for each slice
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
-        outputs = utils.batch_slice(
+        outputs = utils.batch_map(
             [proposals, gt_class_ids, gt_boxes, gt_masks],
             lambda w, x, y, z: detection_targets_graph(
                 w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
+            [tf.float32, gt_class_ids.dtype, tf.float32, tf.float32],
+            names=names)
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -686,97 +772,88 @@ def refine_detections_graph(rois, probs, deltas, window, config):
     detections.
 
     Inputs:
-        rois: [N, (y1, x1, y2, x2)] in normalized coordinates
-        probs: [N, num_classes]. Class probabilities.
-        deltas: [N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
+        rois: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+        probs: [batch, N, num_classes]. Class probabilities.
+        deltas: [batch, N, num_classes, (dy, dx, log(dh), log(dw))]. Class-specific
                 bounding box deltas.
-        window: (y1, x1, y2, x2) in normalized coordinates. The part of the image
-            that contains the image excluding the padding.
+        window: [batch, (y1, x1, y2, x2)] in normalized coordinates. The part of
+            each image that contains the image excluding the padding.
 
-    Returns detections shaped: [num_detections, (y1, x1, y2, x2, class_id, score)] where
-        coordinates are normalized.
+    Returns detections shaped: [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+        where coordinates are normalized. Zero padded.
+
+    Per-class NMS of all images runs as a single NMS. The boxes of each
+    (image, class) pair are shifted into a region of their own first, so
+    boxes of different pairs never overlap and don't suppress each other.
     """
+    batch_size = tf.shape(probs)[0]
+    num_classes = tf.shape(probs)[2]
     # Class IDs per ROI
-    class_ids = tf.argmax(probs, axis=1, output_type=tf.int32)
+    class_ids = tf.argmax(probs, axis=2, output_type=tf.int32)
     # Class probability of the top class of each ROI
-    indices = tf.stack([tf.range(probs.shape[0]), class_ids], axis=1)
-    class_scores = tf.gather_nd(probs, indices)
+    class_scores = tf.reduce_max(probs, axis=2)
     # Class-specific bounding box deltas
-    deltas_specific = tf.gather_nd(deltas, indices)
+    roi_range = tf.range(tf.size(class_ids))
+    deltas_specific = tf.gather(tf.reshape(deltas, [-1, 4]),
+                                roi_range * num_classes + tf.reshape(class_ids, [-1]))
     # Apply bounding box deltas
-    # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
+    # Shape: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
     refined_rois = apply_box_deltas_graph(
-        rois, deltas_specific * config.BBOX_STD_DEV)
-    # Clip boxes to image window
-    refined_rois = clip_boxes_graph(refined_rois, window)
+        tf.reshape(rois, [-1, 4]), deltas_specific * config.BBOX_STD_DEV)
+    refined_rois = tf.reshape(refined_rois, tf.shape(rois))
+    # Clip boxes to the window of their image
+    wy1, wx1, wy2, wx2 = tf.split(tf.expand_dims(window, 1), 4, axis=2)
+    y1, x1, y2, x2 = tf.split(refined_rois, 4, axis=2)
+    refined_rois = tf.concat([tf.maximum(tf.minimum(y1, wy2), wy1),
+                              tf.maximum(tf.minimum(x1, wx2), wx1),
+                              tf.maximum(tf.minimum(y2, wy2), wy1),
+                              tf.maximum(tf.minimum(x2, wx2), wx1)], axis=2)
 
     # TODO: Filter out boxes with zero area
 
     # Filter out background boxes
-    keep = tf.where(class_ids > 0)[:, 0]
+    keep = class_ids > 0
     # Filter out low confidence boxes
     if config.DETECTION_MIN_CONFIDENCE:
-        conf_keep = tf.where(class_scores >= config.DETECTION_MIN_CONFIDENCE)[:, 0]
-        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                        tf.expand_dims(conf_keep, 0))
-        keep = tf.sparse_tensor_to_dense(keep)[0]
+        keep = tf.logical_and(keep, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+    # [kept boxes, (image index, roi index)]
+    keep = tf.cast(tf.where(keep), tf.int32)
 
     # Apply per-class NMS
     # 1. Prepare variables
-    pre_nms_class_ids = tf.gather(class_ids, keep)
-    pre_nms_scores = tf.gather(class_scores, keep)
-    pre_nms_rois = tf.gather(refined_rois,   keep)
-    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
-
-    def nms_keep_map(class_id):
-        """Apply Non-Maximum Suppression on ROIs of the given class."""
-        # Indices of ROIs of the given class
-        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
-        # Apply NMS
-        class_keep = tf.image.non_max_suppression(
-                tf.gather(pre_nms_rois, ixs),
-                tf.gather(pre_nms_scores, ixs),
-                max_output_size=config.DETECTION_MAX_INSTANCES,
-                iou_threshold=config.DETECTION_NMS_THRESHOLD)
-        # Map indices
-        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
-        # Pad with -1 so returned tensors have the same shape
-        gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
-        class_keep = tf.pad(class_keep, [(0, gap)],
-                            mode='CONSTANT', constant_values=-1)
-        # Set shape so map_fn() can infer result shape
-        class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
-        return class_keep
-
-    # 2. Map over class IDs
-    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
-                         dtype=tf.int64)
-    # 3. Merge results into one list, and remove -1 padding
-    nms_keep = tf.reshape(nms_keep, [-1])
-    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
-    # 4. Compute intersection between keep and nms_keep
-    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                    tf.expand_dims(nms_keep, 0))
-    keep = tf.sparse_tensor_to_dense(keep)[0]
-    # Keep top detections
-    roi_count = config.DETECTION_MAX_INSTANCES
-    class_scores_keep = tf.gather(class_scores, keep)
-    num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
-    top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
-    keep = tf.gather(keep, top_ids)
+    pre_nms_class_ids = tf.gather_nd(class_ids, keep)
+    pre_nms_scores = tf.gather_nd(class_scores, keep)
+    pre_nms_rois = tf.gather_nd(refined_rois, keep)
+    # 2. Shift the boxes of each (image, class) pair apart. Clipped
+    # normalized coordinates are within 0..1, so steps of 2 are enough.
+    pair = keep[:, 0] * num_classes + pre_nms_class_ids
+    pre_nms_rois += 2 * tf.to_float(pair)[:, tf.newaxis]
+    # 3. One NMS over everything. Returns the survivors by descending score.
+    nms_keep = tf.image.non_max_suppression(
+        pre_nms_rois, pre_nms_scores,
+        max_output_size=tf.shape(keep)[0],
+        iou_threshold=config.DETECTION_NMS_THRESHOLD)
+    # 4. Keep the top detections of each image. The rank of a survivor is
+    # the number of survivors of the same image before it.
+    image_ids = tf.gather(keep[:, 0], nms_keep)
+    image_one_hot = tf.one_hot(image_ids, batch_size, dtype=tf.int32)
+    rank = tf.reduce_sum(
+        tf.cumsum(image_one_hot, axis=0, exclusive=True) * image_one_hot, axis=1)
+    top = tf.where(rank < config.DETECTION_MAX_INSTANCES)[:, 0]
+    keep = tf.gather(keep, tf.gather(nms_keep, top))
 
     # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
     # Coordinates are normalized.
     detections = tf.concat([
-        tf.gather(refined_rois, keep),
-        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
-        tf.gather(class_scores, keep)[..., tf.newaxis]
+        tf.gather_nd(refined_rois, keep),
+        tf.to_float(tf.gather_nd(class_ids, keep))[..., tf.newaxis],
+        tf.gather_nd(class_scores, keep)[..., tf.newaxis]
         ], axis=1)
 
-    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
-    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
-    return detections
+    # Place them in their images, zero padded to DETECTION_MAX_INSTANCES
+    return tf.scatter_nd(
+        tf.stack([tf.gather(image_ids, top), tf.gather(rank, top)], axis=1),
+        detections, tf.stack([batch_size, config.DETECTION_MAX_INSTANCES, 6]))
 
 
 class DetectionLayer(KE.Layer):
@@ -805,12 +882,12 @@ class DetectionLayer(KE.Layer):
         m = parse_image_meta_graph(image_meta)
         image_shape = m['image_shape'][0]
         window = norm_boxes_graph(m['window'], image_shape[:2])
+        # The window extends past the image in the disk resize mode
+        window = tf.clip_by_value(window, 0., 1.)
 
-        # Run detection refinement graph on each item in the batch
-        detections_batch = utils.batch_slice(
-            [rois, mrcnn_class, mrcnn_bbox, window],
-            lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config),
-            self.config.IMAGES_PER_GPU)
+        # Run detection refinement graph on the whole batch
+        detections_batch = refine_detections_graph(
+            rois, mrcnn_class, mrcnn_bbox, window, self.config)
 
         # Reshape output
         # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
@@ -899,7 +976,7 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
 
 def fpn_classifier_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True,
-                         fc_layers_size=1024):
+                         fc_layers_size=1024, fused_roi_align=False):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -912,6 +989,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
     fc_layers_size: Size of the 2 FC layers
+    fused_roi_align: Pool all pyramid levels at once. See PyramidROIAlign
 
     Returns:
         logits: [batch, num_rois, NUM_CLASSES] classifier logits (before softmax)
@@ -921,7 +999,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     """
     # ROI Pooling
     # Shape: [batch, num_rois, POOL_SIZE, POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
+    x = PyramidROIAlign([pool_size, pool_size], fused=fused_roi_align,
                         name="roi_align_classifier")([rois, image_meta] + feature_maps)
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
@@ -954,7 +1032,8 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
 
 
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
-                         pool_size, num_classes, train_bn=True):
+                         pool_size, num_classes, train_bn=True,
+                         fused_roi_align=False):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
@@ -965,12 +1044,13 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layers
+    fused_roi_align: Pool all pyramid levels at once. See PyramidROIAlign
 
     Returns: Masks [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, NUM_CLASSES]
     """
     # ROI Pooling
     # Shape: [batch, num_rois, MASK_POOL_SIZE, MASK_POOL_SIZE, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
+    x = PyramidROIAlign([pool_size, pool_size], fused=fused_roi_align,
                         name="roi_align_mask")([rois, image_meta] + feature_maps)
 
     # Conv layers
@@ -1183,6 +1263,7 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 #  Data Generator
 ############################################################
 
+@timed
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
                   use_mini_mask=False):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
@@ -1207,17 +1288,35 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
+    # Load image and mask. When working on polygons, the masks are
+    # rasterized at the end, after resizing and augmentation.
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    polygons = None
+    if augmentation:
+        use_polygons = config.AUGMENT_POLYGONS
+    else:
+        use_polygons = config.RASTERIZE_POLYGONS
+    if use_polygons:
+        polygons, class_ids = dataset.load_polygons(image_id)
+    if polygons is None:
+        mask, class_ids = dataset.load_mask(image_id)
     original_shape = image.shape
+    disk = None
+    if config.IMAGE_RESIZE_MODE == "disk":
+        disk = dataset.load_disk(image_id)
+        if disk is None:
+            disk = utils.find_disk(image, config.DISK_THRESHOLD)
     image, window, scale, padding, crop = utils.resize_image(
         image,
         min_dim=config.IMAGE_MIN_DIM,
         min_scale=config.IMAGE_MIN_SCALE,
         max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+        mode=config.IMAGE_RESIZE_MODE,
+        disk=disk)
+    if polygons is None:
+        mask = utils.resize_mask(mask, scale, padding, crop)
+    else:
+        polygons = utils.resize_polygons(polygons, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -1225,7 +1324,11 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         logging.warning("'augment' is deprecated. Use 'augmentation' instead.")
         if random.randint(0, 1):
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            if polygons is None:
+                mask = np.fliplr(mask)
+            else:
+                polygons = [[p * [-1, 1] + [image.shape[1], 0] for p in parts]
+                            for parts in polygons]
 
     # Augmentation
     # This requires the imgaug lib (https://github.com/aleju/imgaug)
@@ -1245,28 +1348,56 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
         # Store shapes before augmentation to compare
         image_shape = image.shape
-        mask_shape = mask.shape
         # Make augmenters deterministic to apply similarly to images and masks
         det = augmentation.to_deterministic()
         image = det.augment_image(image)
-        # Change mask to np.uint8 because imgaug doesn't support np.bool
-        mask = det.augment_image(mask.astype(np.uint8),
-                                 hooks=imgaug.HooksImages(activator=hook))
         # Verify that shapes didn't change
         assert image.shape == image_shape, "Augmentation shouldn't change image size"
-        assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
-        # Change mask back to bool
-        mask = mask.astype(np.bool)
-
-    # Note that some boxes might be all zeros if the corresponding mask got cropped out.
-    # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
-    class_ids = class_ids[_idx]
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+        if polygons is None:
+            mask_shape = mask.shape
+            # Change mask to np.uint8 because imgaug doesn't support np.bool
+            mask = det.augment_image(mask.astype(np.uint8),
+                                     hooks=imgaug.HooksImages(activator=hook))
+            assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
+            # Change mask back to bool
+            mask = mask.astype(np.bool)
+        else:
+            # Move the polygon vertices instead. Non-geometric augmenters
+            # leave keypoints unchanged, so no hook is needed.
+            polygons = augment_polygons(det, polygons, image_shape)
+
+    if polygons is not None and use_mini_mask:
+        # Rasterize each instance straight into its mini mask. Boxes come
+        # from the polygons, so no full-size mask is built at all.
+        bbox = utils.polygons_to_bboxes(polygons, image.shape[:2])
+        _idx = (bbox[:, 2] > bbox[:, 0]) & (bbox[:, 3] > bbox[:, 1])
+        polygons = [p for p, keep in zip(polygons, _idx) if keep]
+        bbox = bbox[_idx]
+        class_ids = class_ids[_idx]
+        mask = utils.polygons_to_mask(polygons, config.MINI_MASK_SHAPE,
+                                      bbox=bbox)
+        # Drop slivers that don't cover any mini mask pixel
+        _idx = np.any(mask, axis=(0, 1))
+        mask = mask[:, :, _idx]
+        bbox = bbox[_idx]
+        class_ids = class_ids[_idx]
+    else:
+        if polygons is not None:
+            mask = utils.polygons_to_mask(polygons, image.shape[:2])
+
+        # Note that some boxes might be all zeros if the corresponding mask got cropped out.
+        # and here is to filter them out
+        _idx = np.sum(mask, axis=(0, 1)) > 0
+        mask = mask[:, :, _idx]
+        class_ids = class_ids[_idx]
+        # Bounding boxes. Note that some boxes might be all zeros
+        # if the corresponding mask got cropped out.
+        # bbox: [num_instances, (y1, x1, y2, x2)]
+        bbox = utils.extract_bboxes(mask)
+
+        # Resize masks to smaller size to reduce memory usage
+        if use_mini_mask:
+            mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1275,10 +1406,6 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
     active_class_ids[source_class_ids] = 1
 
-    # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
-
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
                                     window, scale, active_class_ids)
@@ -1286,6 +1413,38 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     return image, image_meta, class_ids, bbox, mask
 
 
+def augment_polygons(augmentation, polygons, image_shape):
+    """Applies an imgaug augmentation to instance polygons by moving their
+    vertices as keypoints.
+
+    augmentation: A deterministic imgaug augmenter. Use the same one that
+        was applied to the image so both get identical transformations.
+    polygons: See utils.Dataset.load_polygons()
+    image_shape: [height, width, channels] of the image before augmentation.
+
+    Returns the augmented polygons in the same structure.
+    """
+    import imgaug
+
+    points = [imgaug.Keypoint(x=x, y=y)
+              for parts in polygons for p in parts for x, y in p]
+    if not points:
+        return polygons
+    keypoints = imgaug.KeypointsOnImage(points, shape=tuple(image_shape))
+    keypoints = augmentation.augment_keypoints([keypoints])[0]
+    xy = np.array([[k.x, k.y] for k in keypoints.keypoints], dtype=np.float32)
+
+    # Split the flat list of vertices back into instances and parts
+    result = []
+    i = 0
+    for parts in polygons:
+        result.append([])
+        for p in parts:
+            result[-1].append(xy[i:i + len(p)])
+            i += len(p)
+    return result
+
+
 def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     """Generate targets for training Stage 2 classifier and mask heads.
     This is not used in normal training. It's useful for debugging or to train
@@ -1442,19 +1601,53 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def load_image_disk(dataset, config, image_id, image, image_meta, augmented=False):
+    """Returns the solar disk of an image loaded with load_image_gt().
+
+    The disk the dataset provides (Dataset.load_disk()) is moved to the
+    resized image, unless the image was augmented or cropped. Otherwise
+    it's found in the image.
+
+    Returns (y, x, radius) in pixels of the loaded image, or None.
+    """
+    disk = None
+    if not augmented and config.IMAGE_RESIZE_MODE != "crop":
+        disk = dataset.load_disk(image_id)
+    if disk is None:
+        return utils.find_disk(image, config.DISK_THRESHOLD)
+    meta = parse_image_meta(image_meta[np.newaxis])
+    scale, window = meta["scale"][0], meta["window"][0]
+    y, x, radius = disk
+    return np.array([y * scale + window[0], x * scale + window[1], radius * scale])
+
+
+@timed
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_valid=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_valid: Optional. [num_anchors] bool. Anchors that are False, e.g.
+        off the solar disk, are left neutral and skipped in the overlaps.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    if anchor_valid is not None:
+        # Match the valid anchors only. They keep their order, and so do the
+        # deltas of the positive ones in rpn_bbox.
+        valid_ix = np.where(anchor_valid)[0]
+        valid_match, rpn_bbox = build_rpn_targets(
+            image_shape, anchors[valid_ix], gt_class_ids, gt_boxes, config)
+        rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+        rpn_match[valid_ix] = valid_match
+        return rpn_match, rpn_bbox
+
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
     # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
@@ -1627,9 +1820,85 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+def fliplr_applied(augmentation):
+    """Runs an imgaug Fliplr augmentation on a probe image and returns True
+    if it flipped it."""
+    probe = np.arange(2, dtype=np.uint8).reshape([1, 2, 1])
+    return augmentation.augment_image(probe)[0, 0, 0] == 1
+
+
+class FeatureCache(object):
+    """The backbone feature maps (C2 to C5) of the images of a dataset,
+    computed once and stored as float16 .npy files in a directory. They are
+    memory-mapped for reading, so the processes that train from them share
+    one copy in the page cache. See Config.FEATURE_CACHE.
+
+    The features are indexed by image ID, and hold one entry per image,
+    or two with flips: the image as is and flipped right/left.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = None
+
+    def open(self):
+        """Returns the memory-mapped [images, flips, height, width, channels]
+        arrays of the levels."""
+        if self.arrays is None:
+            self.arrays = [np.load(os.path.join(self.path, "c{}.npy".format(i)),
+                                   mmap_mode="r") for i in range(2, 6)]
+        return self.arrays
+
+    def get(self, image_id, flip=False):
+        """Returns the [height, width, channels] feature maps of an image."""
+        return [a[image_id, int(flip)] for a in self.open()]
+
+    @classmethod
+    def create(cls, path, backbone, dataset, config, flips=False):
+        """Computes the features of all images of a dataset and writes them
+        to the directory path. Processes that create the same cache at the
+        same time each write their own copy and the first one done wins.
+
+        backbone: Function from a [1, height, width, 3] molded image to a
+            list of the [1, height, width, channels] feature maps
+        flips: If True, also stores the features of the flipped images
+        """
+        import imgaug
+        variants = [None, imgaug.augmenters.Fliplr(1.0)] if flips else [None]
+        log("Caching the backbone features of {} images{} in {}".format(
+            len(dataset.image_ids), " and their flips" if flips else "", path))
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        arrays = None
+        for image_id in dataset.image_ids:
+            for v, augmentation in enumerate(variants):
+                image = load_image_gt(dataset, config, image_id, augmentation=augmentation,
+                                      use_mini_mask=config.USE_MINI_MASK)[0]
+                features = backbone(mold_image(image.astype(np.float32), config)[np.newaxis])
+                if arrays is None:
+                    arrays = [np.lib.format.open_memmap(
+                        os.path.join(tmp_path, "c{}.npy".format(i + 2)), mode="w+",
+                        dtype=np.float16,
+                        shape=(len(dataset.image_ids), len(variants)) + f.shape[1:])
+                        for i, f in enumerate(features)]
+                for a, f in zip(arrays, features):
+                    a[image_id, v] = f[0]
+        for a in arrays:
+            a.flush()
+        del arrays
+        try:
+            # Fails if another process got there first
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, timing_queue=None,
+                   seed=None, start=0, worker_ids=None, workers=1,
+                   feature_cache=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1651,12 +1920,28 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    timing_queue: Optional. A multiprocessing.Queue that receives, for each
+        batch, the ids of its images and the seconds each took to load and
+        build targets for. See StepTimer.
+    seed: Optional. If given, the order of each pass over the dataset is
+        derived from the seed and the pass number, so it can be replayed.
+        See MaskRCNN.load_training_state().
+    start: Number of images to skip, e.g. those already trained on before
+        training was interrupted. Only meaningful with a seed.
+    worker_ids, workers: Optional. When Keras runs a copy of the generator
+        in each of `workers` processes, a multiprocessing.Value shared by
+        the copies. Each copy takes the next id from it and yields every
+        Nth image of the sequence, so the copies don't repeat each other.
+    feature_cache: Optional. A FeatureCache of the dataset. Its feature maps
+        replace the images in the inputs. The only augmentation then is the
+        right/left flip of an imgaug Fliplr.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
     of the lists differs depending on the received arguments:
     inputs list:
-    - images: [batch, H, W, C]
+    - images: [batch, H, W, C], or with a feature_cache the 4 feature maps
+      [batch, h, w, channels] in its place
     - image_meta: [batch, (meta data)] Image details. See compose_image_meta()
     - rpn_match: [batch, N] Integer (1=positive anchor, -1=negative, 0=neutral)
     - rpn_bbox: [batch, N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
@@ -1671,8 +1956,18 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
         and masks.
     """
     b = 0  # batch item index
-    image_index = -1
     image_ids = np.copy(dataset.image_ids)
+    current_pass = None
+    # Index in the sequence of all passes over the dataset. This copy of
+    # the generator takes every Nth one, starting at its worker id.
+    worker = 0
+    if worker_ids is not None:
+        with worker_ids.get_lock():
+            worker = worker_ids.value % workers
+            worker_ids.value += 1
+    else:
+        workers = 1
+    sample = start + worker - workers
     error_count = 0
     no_augmentation_sources = no_augmentation_sources or []
 
@@ -1683,30 +1978,42 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                                              config.RPN_ANCHOR_RATIOS,
                                              backbone_shapes,
                                              config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+                                             config.RPN_ANCHOR_STRIDE,
+                                             cache_dir=config.CACHE_DIR)
 
     # Keras requires a generator to run indefinitely.
     while True:
         try:
-            # Increment index to pick next image. Shuffle if at the start of an epoch.
-            image_index = (image_index + 1) % len(image_ids)
-            if shuffle and image_index == 0:
-                np.random.shuffle(image_ids)
+            # Increment index to pick next image. Shuffle if at the start of a pass.
+            sample += workers
+            data_pass, image_index = divmod(sample, len(image_ids))
+            if shuffle and data_pass != current_pass:
+                current_pass = data_pass
+                if seed is None:
+                    np.random.shuffle(image_ids)
+                else:
+                    image_ids = np.random.RandomState(seed + data_pass)\
+                        .permutation(dataset.image_ids)
 
             # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
+            image_start = time.time()
 
             # If the image source is not to be augmented pass None as augmentation
+            image_augmentation = augmentation
             if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+                image_augmentation = None
+            # The feature cache has each image as is and flipped. Decide
+            # which one and apply that to the ground truth.
+            flip = False
+            if feature_cache is not None and image_augmentation is not None:
+                import imgaug
+                flip = fliplr_applied(image_augmentation)
+                image_augmentation = imgaug.augmenters.Fliplr(1.0) if flip else None
+            image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
                 load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
+                              augmentation=image_augmentation,
                               use_mini_mask=config.USE_MINI_MASK)
-            else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
@@ -1715,8 +2022,15 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 continue
 
             # RPN Targets
+            anchor_valid = None
+            if config.DISK_MASK:
+                disk = load_image_disk(dataset, config, image_id, image, image_meta,
+                                       augmented=augment or image_augmentation is not None)
+                if disk is not None:
+                    anchor_valid = utils.boxes_on_disk(anchors, disk, config.DISK_MARGIN)
             rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+                                                    gt_class_ids, gt_boxes, config,
+                                                    anchor_valid)
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1729,14 +2043,19 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # Init batch arrays
             if b == 0:
+                batch_image_times = []
                 batch_image_meta = np.zeros(
                     (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
                 batch_rpn_match = np.zeros(
                     [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
                 batch_rpn_bbox = np.zeros(
                     [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
+                if feature_cache is not None:
+                    batch_features = [np.zeros((batch_size,) + f.shape, dtype=np.float32)
+                                      for f in feature_cache.get(image_id)]
+                else:
+                    batch_images = np.zeros(
+                        (batch_size,) + image.shape, dtype=np.float32)
                 batch_gt_class_ids = np.zeros(
                     (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
                 batch_gt_boxes = np.zeros(
@@ -1769,7 +2088,11 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
             batch_image_meta[b] = image_meta
             batch_rpn_match[b] = rpn_match[:, np.newaxis]
             batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
+            if feature_cache is not None:
+                for batch_f, f in zip(batch_features, feature_cache.get(image_id, flip)):
+                    batch_f[b] = f
+            else:
+                batch_images[b] = mold_image(image.astype(np.float32), config)
             batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
             batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
             batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
@@ -1780,12 +2103,16 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                     batch_mrcnn_class_ids[b] = mrcnn_class_ids
                     batch_mrcnn_bbox[b] = mrcnn_bbox
                     batch_mrcnn_mask[b] = mrcnn_mask
+            batch_image_times.append(
+                (dataset.image_info[image_id].get("id", image_id),
+                 time.time() - image_start))
             b += 1
 
             # Batch full?
             if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
+                inputs = list(batch_features) if feature_cache is not None else [batch_images]
+                inputs += [batch_image_meta, batch_rpn_match, batch_rpn_bbox,
+                           batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
                 outputs = []
 
                 if random_rois:
@@ -1798,6 +2125,9 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                         outputs.extend(
                             [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
 
+                if timing_queue is not None:
+                    timing_queue.put(batch_image_times)
+
                 yield inputs, outputs
 
                 # start a new batch
@@ -1813,36 +2143,411 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+############################################################
+#  Training Callbacks
+############################################################
+
+class StepTimer(keras.callbacks.Callback):
+    """Breaks the time of every training step down into waiting for the
+    data generator and running the forward/backward pass.
+
+    Pass `queue` to data_generator() as timing_queue. The generator, which
+    runs in the Keras worker processes, reports how long each image took
+    to load, and the number of batches produced but not yet consumed gives
+    the queue occupancy seen at the start of each step.
+
+    One line per step is appended to a CSV file:
+        epoch,step,wait_ms,compute_ms,queued,slowest_image,slowest_image_ms
+    and a summary is printed at the end of every epoch.
+    """
+
+    def __init__(self, log_path, slowest=10):
+        """
+        log_path: CSV file to append the per-step times to
+        slowest: How many of the slowest images to keep track of
+        """
+        super(StepTimer, self).__init__()
+        self.log_path = log_path
+        self.slowest = slowest
+        self.queue = multiprocessing.Queue()
+        # Min-heap of (seconds, image id) of the slowest images
+        self.slowest_images = []
+        self.produced = 0
+        self.consumed = 0
+
+    def drain(self):
+        """Collects the batches the generator reported so far."""
+        while True:
+            try:
+                image_times = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            self.produced += 1
+            self.batches.append(image_times)
+            for image_id, t in image_times:
+                item = (t, str(image_id))
+                if len(self.slowest_images) < self.slowest:
+                    heapq.heappush(self.slowest_images, item)
+                else:
+                    heapq.heappushpop(self.slowest_images, item)
+
+    def on_train_begin(self, logs=None):
+        write_header = not os.path.exists(self.log_path)
+        self.file = open(self.log_path, "a")
+        if write_header:
+            self.file.write("epoch,step,wait_ms,compute_ms,queued,"
+                            "slowest_image,slowest_image_ms\n")
+        self.batches = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.waits = []
+        self.computes = []
+        self.queued = []
+        self.step_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step_begin = time.time()
+        self.drain()
+        self.waits.append(self.step_begin - self.step_end)
+        # Batches ready beyond the one this step consumes
+        self.queued.append(max(self.produced - self.consumed - 1, 0))
+
+    def on_batch_end(self, batch, logs=None):
+        self.step_end = time.time()
+        self.computes.append(self.step_end - self.step_begin)
+        self.consumed += 1
+        # Batches are consumed in the order they were produced
+        image_id, image_time = "", 0
+        if self.batches:
+            image_id, image_time = max(self.batches.pop(0), key=lambda x: x[1])
+        self.file.write("{},{},{:.1f},{:.1f},{},{},{:.1f}\n".format(
+            self.epoch, batch, self.waits[-1] * 1000, self.computes[-1] * 1000,
+            self.queued[-1], image_id, image_time * 1000))
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.file.flush()
+        if not self.computes:
+            return
+        wait = np.sum(self.waits)
+        compute = np.sum(self.computes)
+        log("Step times: wait {:.0f}ms, compute {:.0f}ms per step. "
+            "Waiting {:.0%} of the time, {:.1f} batches queued on average".format(
+                1000 * wait / len(self.waits), 1000 * compute / len(self.computes),
+                wait / (wait + compute), np.mean(self.queued)))
+        log("Slowest images: " + ", ".join(
+            "{} ({:.0f}ms)".format(i, t * 1000)
+            for t, i in sorted(self.slowest_images, reverse=True)))
+
+    def on_train_end(self, logs=None):
+        self.file.close()
+
+
+class CheckpointManager(keras.callbacks.Callback):
+    """Saves the weights at the end of every epoch without blocking the
+    training loop on disk I/O, and keeps only the best checkpoints.
+
+    The weights are copied to host memory in the callback, then written in
+    the Keras .h5 format, compatible with MaskRCNN.load_weights(), by a
+    background thread. Checkpoints are ranked by the exponential moving
+    average (EMA) of the monitored loss. Only the `keep_best` best ones
+    and the latest are kept on disk.
+
+    If `state_fn` is set, the full training state is written as well, to
+    TRAINING_STATE_FILE in the same directory. See
+    MaskRCNN.load_training_state().
+
+    Use one instance across training stages, so the ranking covers all of
+    them. The EMA restarts with each stage, like EMAEarlyStopping.
+    """
+
+    def __init__(self, checkpoint_path, keep_best=0, ema_weight=0.7,
+                 monitor="val_loss", state_fn=None):
+        """
+        checkpoint_path: Path with an {epoch} placeholder. See set_log_dir().
+        keep_best: Number of best checkpoints to keep. 0 keeps all.
+        ema_weight: Weight of the previous EMA value
+        monitor: The loss to rank checkpoints by
+        state_fn: Optional. Called with the epoch at the end of every epoch.
+            Returns a dict of training state to save with the weights.
+        """
+        super(CheckpointManager, self).__init__()
+        self.checkpoint_path = checkpoint_path
+        self.state_path = os.path.join(os.path.dirname(checkpoint_path),
+                                       TRAINING_STATE_FILE)
+        self.keep_best = keep_best
+        self.ema_weight = ema_weight
+        self.monitor = monitor
+        self.state_fn = state_fn
+        # The model to save, if not the one being trained. See
+        # MaskRCNN.train() with Config.FEATURE_CACHE.
+        self.weights_model = None
+        self.lock = threading.Lock()
+        self.pending = []
+        self.thread = None
+        # {path: (EMA score or None, epoch)} of the checkpoints on disk
+        self.saved = {}
+
+    def on_train_begin(self, logs=None):
+        self.ema = None
+
+    def get_state(self):
+        with self.lock:
+            return {"ema": self.ema, "saved": dict(self.saved)}
+
+    def set_state(self, state):
+        self.ema = state["ema"]
+        with self.lock:
+            self.saved.update(state["saved"])
+
+    def snapshot(self):
+        """Copies the weights to host memory. Returns a list of
+        (layer name, weight names, weight values)."""
+        # The layers of the inner model in multi-GPU training, like
+        # Keras' save_weights().
+        model = self.weights_model or self.model
+        layers = model.inner_model.layers if hasattr(model, "inner_model")\
+            else model.layers
+        values = iter(K.batch_get_value([w for l in layers for w in l.weights]))
+        return [(l.name, [w.name for w in l.weights], [next(values) for _ in l.weights])
+                for l in layers]
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        score = None
+        if self.monitor in logs:
+            value = float(logs[self.monitor])
+            self.ema = value if self.ema is None else\
+                (1 - self.ema_weight) * value + self.ema_weight * self.ema
+            score = self.ema
+
+        weights = self.snapshot()
+        state = self.state_fn(epoch) if self.state_fn else None
+        path = self.checkpoint_path.format(epoch=epoch + 1)
+        self.enqueue((path, score, epoch, weights, state))
+
+    def save_state(self, state):
+        """Saves the current weights with the given training state, but
+        not as an epoch checkpoint. E.g. between training stages."""
+        self.enqueue((None, None, None, self.snapshot(), state))
+
+    def rewind(self, epoch):
+        """Saves the current weights as the checkpoint of `epoch` and deletes
+        the checkpoints of later epochs, so that find_last() picks it up.
+        E.g. after restoring the weights of the best epoch at the end of a
+        training stage, with training continuing from `epoch`.
+        """
+        path = self.checkpoint_path.format(epoch=epoch)
+        self.wait()
+        with self.lock:
+            # Keep the EMA score of the epoch, for the ranking
+            score = self.saved.get(path, (None, None))[0]
+            later = [p for p in self.saved if self.saved[p][1] >= epoch]
+            for p in later:
+                del self.saved[p]
+        for p in later:
+            if p != path and os.path.exists(p):
+                os.remove(p)
+        self.write(path, self.snapshot())
+        with self.lock:
+            self.saved[path] = (score, epoch - 1)
+        self.remove_old()
+
+    def enqueue(self, job):
+        with self.lock:
+            self.pending.append(job)
+            # Threads aren't daemons, so the interpreter waits for the
+            # writes to finish before exiting.
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_pending)
+                self.thread.start()
+
+    def write_pending(self):
+        """Background thread. Writes the queued snapshots, then exits."""
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                path, score, epoch, weights, state = self.pending.pop(0)
+            try:
+                if path:
+                    self.write(path, weights)
+                    with self.lock:
+                        self.saved[path] = (score, epoch)
+                    self.remove_old()
+                if state is not None:
+                    self.write_state(weights, state)
+            except Exception:
+                logging.exception("Error saving checkpoint {}".format(
+                    path or self.state_path))
+
+    def temp_path(self, path):
+        # A name that find_last() doesn't pick up
+        return os.path.join(os.path.dirname(path), ".tmp_" + os.path.basename(path))
+
+    def write(self, path, weights):
+        """Writes weights in the format of Keras' save_weights()."""
+        import h5py
+        # Write to a temporary file first, so that find_last() never picks
+        # up a partial checkpoint
+        tmp_path = self.temp_path(path)
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["layer_names"] = [name.encode("utf8") for name, _, _ in weights]
+            f.attrs["backend"] = K.backend().encode("utf8")
+            f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+            for layer_name, weight_names, values in weights:
+                g = f.create_group(layer_name)
+                g.attrs["weight_names"] = [n.encode("utf8") for n in weight_names]
+                for name, value in zip(weight_names, values):
+                    g.create_dataset(name, data=value)
+        os.replace(tmp_path, path)
+
+    def write_state(self, weights, state):
+        """Writes the weights and the training state into one file, so that
+        they are always replaced together."""
+        state = dict(state, weights=weights)
+        tmp_path = self.temp_path(self.state_path)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.state_path)
+
+    def remove_old(self):
+        """Deletes checkpoints that are neither the latest nor the best."""
+        if not self.keep_best:
+            return
+        with self.lock:
+            latest = max(self.saved, key=lambda p: self.saved[p][1])
+            scored = [p for p in self.saved if self.saved[p][0] is not None]
+            best = sorted(scored, key=lambda p: self.saved[p][0])[:self.keep_best]
+            old = [p for p in self.saved if p != latest and p not in best]
+            for path in old:
+                del self.saved[path]
+        for path in old:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait(self):
+        """Blocks until all pending checkpoints are written."""
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+class MetricsLogger(keras.callbacks.Callback):
+    """Streams the training losses to a metrics store (see mrcnn.metrics).
+
+    Writes an "epoch" record with the training and validation losses at
+    the end of every epoch and a "step" record every `step_interval`
+    training steps. Records are appended, so several training stages can
+    share one file.
+    """
+
+    def __init__(self, path, step_interval=0):
+        """
+        path: The metrics file to append to
+        step_interval: Log every Nth step. 0 to log epochs only.
+        """
+        super(MetricsLogger, self).__init__()
+        self.path = path
+        self.step_interval = step_interval
+
+    def record(self, kind, logs, **keys):
+        r = OrderedDict([("kind", kind)])
+        r.update(keys)
+        r["time"] = round(time.time(), 3)
+        for k, v in (logs or {}).items():
+            if k not in ["batch", "size"]:
+                r[k] = float(v)
+        self.writer.write(r)
+
+    def on_train_begin(self, logs=None):
+        self.writer = metrics.MetricsWriter(self.path)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        if self.step_interval and batch % self.step_interval == 0:
+            self.record("step", logs, epoch=self.epoch, step=batch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.record("epoch", logs, epoch=epoch)
+        self.writer.flush()
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
 
+# File name of the training state in a training log directory. See
+# MaskRCNN.load_training_state().
+TRAINING_STATE_FILE = "training_state.pkl"
+
+
 class MaskRCNN():
     """Encapsulates the Mask RCNN model functionality.
 
     The actual Keras model is in the keras_model property.
+
+    Each instance builds its model in its own TensorFlow graph and session
+    (the graph and session properties) rather than in the Keras globals,
+    so several models can live in one process. Use as_default() to work
+    with keras_model directly. detect() and detect_molded() are thread-safe:
+    one instance can serve concurrent callers without reloading weights.
     """
 
-    def __init__(self, mode, config, model_dir):
+    def __init__(self, mode, config, model_dir, device=None, session_config=None):
         """
         mode: Either "training" or "inference"
         config: A Sub-class of the Config class
         model_dir: Directory to save training logs and trained weights
+        device: Optional TensorFlow device to build the model on, e.g. "/cpu:0".
+            A tf.device() block around the constructor has no effect because
+            the model is built in its own graph.
+        session_config: Optional tf.ConfigProto for the model's session
         """
         assert mode in ['training', 'inference']
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.build(mode=mode, config=config)
+        # Created by train(), or by load_training_state() to resume a run
+        self.checkpoints = None
+        if session_config is None:
+            session_config = tf.ConfigProto(allow_soft_placement=True)
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        with self.as_default(), tf.device(device):
+            self.keras_model = self.build(mode=mode, config=config)
+            if mode == "inference":
+                # Keras builds the predict function lazily on the first
+                # call, which isn't thread-safe. Build it now.
+                self.keras_model._make_predict_function()
+
+    @contextlib.contextmanager
+    def as_default(self):
+        """Context manager that makes the model's graph and session the
+        defaults, for Keras and TensorFlow. Applies to the current thread.
+        """
+        with self.graph.as_default(), self.session.as_default():
+            yield
 
-    def build(self, mode, config):
+    def build(self, mode, config, cached_features=None):
         """Build Mask R-CNN architecture.
             input_shape: The shape of the input image.
             mode: Either "training" or "inference". The inputs and
                 outputs of the model differ accordingly.
+            cached_features: Optional. The channels of the backbone feature
+                maps C2 to C5. If given, builds a training model that takes
+                those feature maps instead of the image, to train the heads
+                from a FeatureCache.
         """
         assert mode in ['training', 'inference']
+        assert cached_features is None or mode == "training"
 
         # Image size must be dividable by 2 multiple times
         h, w = config.IMAGE_SHAPE[:2]
@@ -1852,8 +2557,16 @@ class MaskRCNN():
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
         # Inputs
-        input_image = KL.Input(
-            shape=[None, None, config.IMAGE_SHAPE[2]], name="input_image")
+        if cached_features:
+            input_features = [
+                KL.Input(shape=[None, None, channels], name="input_c{}".format(i + 2))
+                for i, channels in enumerate(cached_features)]
+            # Cached features need images molded to IMAGE_SHAPE
+            image_size = config.IMAGE_SHAPE[:2]
+        else:
+            input_image = KL.Input(
+                shape=[None, None, config.IMAGE_SHAPE[2]], name="input_image")
+            image_size = K.shape(input_image)[1:3]
         input_image_meta = KL.Input(shape=[config.IMAGE_META_SIZE],
                                     name="input_image_meta")
         if mode == "training":
@@ -1873,7 +2586,7 @@ class MaskRCNN():
                 shape=[None, 4], name="input_gt_boxes", dtype=tf.float32)
             # Normalize coordinates
             gt_boxes = KL.Lambda(lambda x: norm_boxes_graph(
-                x, K.shape(input_image)[1:3]))(input_gt_boxes)
+                x, image_size))(input_gt_boxes)
             # 3. GT Masks (zero padded)
             # [batch, height, width, MAX_GT_INSTANCES]
             if config.USE_MINI_MASK:
@@ -1888,17 +2601,27 @@ class MaskRCNN():
         elif mode == "inference":
             # Anchors in normalized coordinates
             input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
+            if config.PRIOR_ROIS:
+                # ROIs to classify next to the proposals, in normalized
+                # coordinates and zero padded. See Config.PRIOR_ROIS.
+                input_prior_rois = KL.Input(shape=[config.PRIOR_ROIS, 4],
+                                            name="input_prior_rois")
 
         # Build the shared convolutional layers.
         # Bottom-up Layers
         # Returns a list of the last layers of each stage, 5 in total.
         # Don't create the thead (stage 5), so we pick the 4th item in the list.
-        if callable(config.BACKBONE):
-            _, C2, C3, C4, C5 = config.BACKBONE(input_image, stage5=True,
-                                                train_bn=config.TRAIN_BN)
+        if cached_features:
+            C2, C3, C4, C5 = input_features
         else:
-            _, C2, C3, C4, C5 = resnet_graph(input_image, config.BACKBONE,
-                                             stage5=True, train_bn=config.TRAIN_BN)
+            if callable(config.BACKBONE):
+                _, C2, C3, C4, C5 = config.BACKBONE(input_image, stage5=True,
+                                                    train_bn=config.TRAIN_BN)
+            else:
+                _, C2, C3, C4, C5 = resnet_graph(input_image, config.BACKBONE,
+                                                 stage5=True, train_bn=config.TRAIN_BN)
+            # For FeatureCache.create()
+            self.backbone_features = (input_image, [C2, C3, C4, C5])
         # Top-down Layers
         # TODO: add assert to varify feature map sizes match what's in config
         P5 = KL.Conv2D(config.TOP_DOWN_PYRAMID_SIZE, (1, 1), name='fpn_c5p5')(C5)
@@ -1931,7 +2654,7 @@ class MaskRCNN():
             # TODO: can this be optimized to avoid duplicating the anchors?
             anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
             # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
+            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image_meta)
         else:
             anchors = input_anchors
 
@@ -1977,7 +2700,7 @@ class MaskRCNN():
                                       name="input_roi", dtype=np.int32)
                 # Normalize coordinates
                 target_rois = KL.Lambda(lambda x: norm_boxes_graph(
-                    x, K.shape(input_image)[1:3]))(input_rois)
+                    x, image_size))(input_rois)
             else:
                 target_rois = rpn_rois
 
@@ -1995,13 +2718,15 @@ class MaskRCNN():
                 fpn_classifier_graph(rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     fused_roi_align=config.FUSED_ROI_ALIGN)
 
             mrcnn_mask = build_fpn_mask_graph(rois, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              fused_roi_align=config.FUSED_ROI_ALIGN)
 
             # TODO: clean up (use tf.identify if necessary)
             output_rois = KL.Lambda(lambda x: x * 1, name="output_rois")(rois)
@@ -2019,8 +2744,9 @@ class MaskRCNN():
                 [target_mask, target_class_ids, mrcnn_mask])
 
             # Model
-            inputs = [input_image, input_image_meta,
-                      input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
+            inputs = input_features if cached_features else [input_image]
+            inputs += [input_image_meta,
+                       input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
             outputs = [rpn_class_logits, rpn_class, rpn_bbox,
@@ -2029,13 +2755,20 @@ class MaskRCNN():
                        rpn_class_loss, rpn_bbox_loss, class_loss, bbox_loss, mask_loss]
             model = KM.Model(inputs, outputs, name='mask_rcnn')
         else:
+            inputs = [input_image, input_image_meta, input_anchors]
+            if config.PRIOR_ROIS:
+                rpn_rois = KL.Concatenate(axis=1, name="rois_with_priors")(
+                    [rpn_rois, input_prior_rois])
+                inputs.append(input_prior_rois)
+
             # Network Heads
             # Proposal classifier and BBox regressor heads
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
                 fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     fused_roi_align=config.FUSED_ROI_ALIGN)
 
             # Detections
             # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in
@@ -2049,9 +2782,10 @@ class MaskRCNN():
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              fused_roi_align=config.FUSED_ROI_ALIGN)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            model = KM.Model(inputs,
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
@@ -2126,10 +2860,11 @@ class MaskRCNN():
         if exclude:
             layers = filter(lambda l: l.name not in exclude, layers)
 
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
+        with self.as_default():
+            if by_name:
+                saving.load_weights_from_hdf5_group_by_name(f, layers)
+            else:
+                saving.load_weights_from_hdf5_group(f, layers)
         if hasattr(f, 'close'):
             f.close()
 
@@ -2150,60 +2885,62 @@ class MaskRCNN():
                                 md5_hash='a268eb855778b3df3c7506639542a6af')
         return weights_path
 
-    def compile(self, learning_rate, momentum):
+    def compile(self, learning_rate, momentum, keras_model=None):
         """Gets the model ready for training. Adds losses, regularization, and
         metrics. Then calls the Keras compile() function.
         """
-        # Optimizer object
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
-        # Add Losses
-        # First, clear previously set losses to avoid duplication
-        self.keras_model._losses = []
-        self.keras_model._per_input_losses = {}
-        loss_names = [
-            "rpn_class_loss",  "rpn_bbox_loss",
-            "mrcnn_class_loss", "mrcnn_bbox_loss", "mrcnn_mask_loss"]
-        for name in loss_names:
-            layer = self.keras_model.get_layer(name)
-            if layer.output in self.keras_model.losses:
-                continue
-            loss = (
-                tf.reduce_mean(layer.output, keep_dims=True)
-                * self.config.LOSS_WEIGHTS.get(name, 1.))
-            self.keras_model.add_loss(loss)
-
-        # Add L2 Regularization
-        # Skip gamma and beta weights of batch normalization layers.
-        reg_losses = [
-            keras.regularizers.l2(self.config.WEIGHT_DECAY)(w) / tf.cast(tf.size(w), tf.float32)
-            for w in self.keras_model.trainable_weights
-            if 'gamma' not in w.name and 'beta' not in w.name]
-        self.keras_model.add_loss(tf.add_n(reg_losses))
-
-        # Compile
-        self.keras_model.compile(
-            optimizer=optimizer,
-            loss=[None] * len(self.keras_model.outputs))
-
-        # Add metrics for losses
-        for name in loss_names:
-            if name in self.keras_model.metrics_names:
-                continue
-            layer = self.keras_model.get_layer(name)
-            self.keras_model.metrics_names.append(name)
-            loss = (
-                tf.reduce_mean(layer.output, keep_dims=True)
-                * self.config.LOSS_WEIGHTS.get(name, 1.))
-            self.keras_model.metrics_tensors.append(loss)
+        keras_model = keras_model or self.keras_model
+        with self.as_default():
+            # Optimizer object
+            optimizer = keras.optimizers.SGD(
+                lr=learning_rate, momentum=momentum,
+                clipnorm=self.config.GRADIENT_CLIP_NORM)
+            # Add Losses
+            # First, clear previously set losses to avoid duplication
+            keras_model._losses = []
+            keras_model._per_input_losses = {}
+            loss_names = [
+                "rpn_class_loss",  "rpn_bbox_loss",
+                "mrcnn_class_loss", "mrcnn_bbox_loss", "mrcnn_mask_loss"]
+            for name in loss_names:
+                layer = keras_model.get_layer(name)
+                if layer.output in keras_model.losses:
+                    continue
+                loss = (
+                    tf.reduce_mean(layer.output, keep_dims=True)
+                    * self.config.LOSS_WEIGHTS.get(name, 1.))
+                keras_model.add_loss(loss)
+
+            # Add L2 Regularization
+            # Skip gamma and beta weights of batch normalization layers.
+            reg_losses = [
+                keras.regularizers.l2(self.config.WEIGHT_DECAY)(w) / tf.cast(tf.size(w), tf.float32)
+                for w in keras_model.trainable_weights
+                if 'gamma' not in w.name and 'beta' not in w.name]
+            keras_model.add_loss(tf.add_n(reg_losses))
+
+            # Compile
+            keras_model.compile(
+                optimizer=optimizer,
+                loss=[None] * len(keras_model.outputs))
+
+            # Add metrics for losses
+            for name in loss_names:
+                if name in keras_model.metrics_names:
+                    continue
+                layer = keras_model.get_layer(name)
+                keras_model.metrics_names.append(name)
+                loss = (
+                    tf.reduce_mean(layer.output, keep_dims=True)
+                    * self.config.LOSS_WEIGHTS.get(name, 1.))
+                keras_model.metrics_tensors.append(loss)
 
     def set_trainable(self, layer_regex, keras_model=None, indent=0, verbose=1):
         """Sets model layers as trainable if their names match
         the given regular expression.
         """
         # Print message on the first call (but not on recursive calls)
-        if verbose > 0 and keras_model is None:
+        if verbose > 0 and indent == 0:
             log("Selecting layers to train")
 
         keras_model = keras_model or self.keras_model
@@ -2274,7 +3011,8 @@ class MaskRCNN():
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
+              augmentation=None, custom_callbacks=None, no_augmentation_sources=None,
+              stage=None):
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
         learning_rate: The learning rate to train with
@@ -2306,9 +3044,29 @@ class MaskRCNN():
         no_augmentation_sources: Optional. List of sources to exclude for
             augmentation. A source is string that identifies a dataset and is
             defined in the Dataset class.
+        stage: Optional. Index of the training stage this call is, for
+            callers that train in several stages. It's saved in the training
+            state, so that they know where to resume. See
+            load_training_state().
+
+        The training state (weights, optimizer state, the state of the
+        callbacks that have get_state() and set_state() methods, epoch and
+        position in the training data) is saved to TRAINING_STATE_FILE in
+        the log directory at the end of every epoch.
         """
         assert self.mode == "training", "Create model in training mode."
 
+        # Train the heads from cached backbone features, with a model that
+        # starts after the backbone. See Config.FEATURE_CACHE.
+        keras_model = self.keras_model
+        feature_caches = [None, None]
+        if layers == "heads" and self.config.FEATURE_CACHE:
+            keras_model = self.heads_model()
+            feature_caches = self.load_feature_caches(train_dataset, val_dataset,
+                                                      augmentation)
+            with self.as_default():
+                copy_weights(self.keras_model, keras_model)
+
         # Pre-defined layer regular expressions
         layer_regex = {
             # all layers but the backbone
@@ -2323,58 +3081,268 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        # Create log_dir if it does not exist
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        # One checkpoint manager for all training stages, so it can rank
+        # the checkpoints of all of them
+        if self.checkpoints is None or\
+                self.checkpoints.checkpoint_path != self.checkpoint_path:
+            self.checkpoints = CheckpointManager(
+                self.checkpoint_path,
+                keep_best=self.config.CHECKPOINT_KEEP_BEST,
+                ema_weight=self.config.CHECKPOINT_EMA_WEIGHT)
+
         # Data generators
+        step_timer = None
+        if self.config.LOG_STEP_TIMES:
+            step_timer = StepTimer(os.path.join(self.log_dir, "step_times.csv"))
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        elif hasattr(os, "sched_getaffinity"):
+            # The cores this process may run on, e.g. when an experiment
+            # runner limits each training run to some of them
+            workers = len(os.sched_getaffinity(0))
+        else:
+            workers = multiprocessing.cpu_count()
+
+        # Seed the order of the training data so that a resumed run can
+        # continue where this one stops
+        if getattr(self, "sampler_seed", None) is None:
+            self.sampler_seed = np.random.randint(2**31)
+            self.samples_seen = 0
         train_generator = data_generator(train_dataset, self.config, shuffle=True,
                                          augmentation=augmentation,
                                          batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
+                                         no_augmentation_sources=no_augmentation_sources,
+                                         timing_queue=step_timer.queue if step_timer else None,
+                                         seed=self.sampler_seed, start=self.samples_seen,
+                                         worker_ids=multiprocessing.Value("i", 0),
+                                         workers=max(workers, 1),
+                                         feature_cache=feature_caches[0])
         val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
-
-        # Create log_dir if it does not exist
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+                                       batch_size=self.config.BATCH_SIZE,
+                                       feature_cache=feature_caches[1])
 
         # Callbacks
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
-                                        histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+                                        histogram_freq=0, write_graph=False, write_images=False),
+            MetricsLogger(os.path.join(self.log_dir, metrics.METRICS_FILE),
+                          step_interval=self.config.METRICS_LOG_STEPS),
+            keras.callbacks.LambdaCallback(on_batch_end=self._count_samples),
         ]
 
+        if step_timer:
+            callbacks.append(step_timer)
+
         # Add custom callbacks to the list
         if custom_callbacks:
             callbacks += custom_callbacks
 
+        # Checkpoints hold the whole model. Copy the trained weights into it
+        # before they're saved.
+        if keras_model is not self.keras_model:
+            callbacks.append(keras.callbacks.LambdaCallback(
+                on_epoch_end=lambda epoch, logs: copy_weights(keras_model, self.keras_model)))
+        self.checkpoints.weights_model = self.keras_model
+
+        # After the other callbacks, so that the state it saves includes
+        # their updates for the epoch
+        self.checkpoints.state_fn = lambda epoch: self._training_state(
+            epoch + 1, stage, callbacks, keras_model)
+        callbacks.append(self.checkpoints)
+
+        # Restore the optimizer and callback state of an interrupted run.
+        # Last, because the other callbacks reset their state when
+        # training begins, and Keras creates the optimizer weights just
+        # before that.
+        if getattr(self, "resume_state", None):
+            state = self.resume_state
+            self.resume_state = None
+            callbacks.append(keras.callbacks.LambdaCallback(
+                on_train_begin=lambda logs: self._restore_training_state(
+                    state, callbacks, keras_model)))
+
         # Train
         log("\nStarting at epoch {}. LR={}\n".format(self.epoch, learning_rate))
         log("Checkpoint Path: {}".format(self.checkpoint_path))
-        self.set_trainable(layers)
-        self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
+        self.set_trainable(layers, keras_model=keras_model)
+        self.compile(learning_rate, self.config.LEARNING_MOMENTUM, keras_model=keras_model)
+
+        with self.as_default():
+            keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=workers,
+                use_multiprocessing=True,
+            )
+            if keras_model is not self.keras_model:
+                copy_weights(keras_model, self.keras_model)
+                self.keras_model.stop_training = keras_model.stop_training
+        self.epoch = max(self.epoch, epochs)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
+    def heads_model(self):
+        """Returns a training model that takes the backbone feature maps C2
+        to C5 instead of the image, to train the heads from a FeatureCache.
+        It's built once, in the graph of this model, with weights of its own.
+        train() copies them from and back to this model.
+        """
+        if getattr(self, "_heads_model", None) is None:
+            channels = [K.int_shape(f)[-1] for f in self.backbone_features[1]]
+            with self.as_default():
+                self._heads_model = self.build(mode="training", config=self.config,
+                                               cached_features=channels)
+        return self._heads_model
+
+    def load_feature_caches(self, train_dataset, val_dataset, augmentation=None):
+        """Returns the FeatureCaches of the training and validation datasets
+        for the current backbone weights. Creates those that aren't in
+        CACHE_DIR yet, with flips for training if there's augmentation.
+        """
+        config = self.config
+        assert config.CACHE_DIR, "FEATURE_CACHE needs a CACHE_DIR."
+        assert not config.TRAIN_BN, "FEATURE_CACHE needs TRAIN_BN = False."
+        assert config.IMAGE_RESIZE_MODE in ["square", "disk"],\
+            "FEATURE_CACHE needs the square or disk IMAGE_RESIZE_MODE."
+        assert augmentation is None or type(augmentation).__name__ == "Fliplr",\
+            "FEATURE_CACHE supports no augmentation other than Fliplr."
+
+        # The features depend on the images, how they're molded, and the
+        # weights of the layers that the heads model doesn't have
+        def layers(model):
+            # The layers of the inner model in multi-GPU training
+            return model.inner_model.layers if hasattr(model, "inner_model")\
+                else model.layers
+        heads_layers = set(l.name for l in layers(self.heads_model()))
+        digest = hashlib.sha1(repr((
+            getattr(config.BACKBONE, "__name__", config.BACKBONE),
+            config.IMAGE_RESIZE_MODE, config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM,
+            config.IMAGE_MIN_SCALE, config.IMAGE_SHAPE.tolist(),
+            np.asarray(config.MEAN_PIXEL).tolist(), config.DISK_THRESHOLD,
+        )).encode("utf8"))
+        input_image, features = self.backbone_features
+        with self.as_default():
+            for value in K.batch_get_value([w for l in layers(self.keras_model)
+                                            if l.name not in heads_layers
+                                            for w in l.weights]):
+                digest.update(np.ascontiguousarray(value).tobytes())
+            inputs = [input_image]
+            if self.keras_model.uses_learning_phase and\
+                    not isinstance(K.learning_phase(), int):
+                inputs += [K.learning_phase()]
+            kf = K.function(inputs, features)
+
+        def backbone(images):
+            with self.as_default():
+                return kf([images] + [0.] * (len(inputs) - 1))
+
+        caches = []
+        for dataset, flips in [(train_dataset, augmentation is not None),
+                               (val_dataset, False)]:
+            key = digest.copy()
+            key.update(repr(([(info.get("path"), info.get("id"))
+                              for info in dataset.image_info], flips)).encode("utf8"))
+            path = os.path.join(config.CACHE_DIR, "features", key.hexdigest()[:16])
+            if os.path.exists(path):
+                caches.append(FeatureCache(path))
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                caches.append(FeatureCache.create(path, backbone, dataset, config, flips))
+        return caches
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
-        self.epoch = max(self.epoch, epochs)
+    def _count_samples(self, batch, logs):
+        self.samples_seen += self.config.BATCH_SIZE
 
+    def _training_state(self, epoch, stage, callbacks=None, keras_model=None):
+        """Returns the training state to save, except for the weights.
+        keras_model: The model being trained, if not self.keras_model
+        """
+        keras_model = keras_model or self.keras_model
+        state = {
+            "epoch": epoch,
+            "stage": stage,
+            "samples_seen": self.samples_seen,
+            "sampler_seed": self.sampler_seed,
+        }
+        if callbacks is not None:
+            state["optimizer"] = K.batch_get_value(keras_model.optimizer.weights)
+            state["callbacks"] = {type(c).__name__: c.get_state() for c in callbacks
+                                  if hasattr(c, "get_state")}
+        return state
+
+    def _restore_training_state(self, state, callbacks, keras_model=None):
+        """Sets the optimizer and callback state saved by _training_state()."""
+        weights = (keras_model or self.keras_model).optimizer.weights
+        if "optimizer" in state:
+            if len(weights) == len(state["optimizer"]):
+                K.batch_set_value(list(zip(weights, state["optimizer"])))
+            else:
+                log("Optimizer state doesn't match the trainable layers. Not restored.")
+        for c in callbacks:
+            name = type(c).__name__
+            if hasattr(c, "set_state") and name in state.get("callbacks", {}):
+                c.set_state(state["callbacks"][name])
+
+    def save_training_state(self, stage=None):
+        """Saves the weights, epoch and position in the training data, but
+        not the optimizer and callback state, in the log directory. Call it
+        between training stages, so that resuming starts the next stage
+        from scratch.
+
+        stage: The index of the next training stage
+        """
+        if self.checkpoints is None:
+            return
+        with self.as_default():
+            self.checkpoints.save_state(self._training_state(self.epoch, stage))
+        self.checkpoints.wait()
+
+    def load_training_state(self, log_dir):
+        """Loads the training state that train() saved in a log directory,
+        and sets up the model to continue that run. Checkpoints and logs go
+        to the same directory.
+
+        Returns the state dict, e.g. to get the stage to continue from.
+        """
+        with open(os.path.join(log_dir, TRAINING_STATE_FILE), "rb") as f:
+            state = pickle.load(f)
+        weights = {name: values for name, _, values in state.pop("weights")}
+        model = self.keras_model
+        layers = model.inner_model.layers if hasattr(model, "inner_model")\
+            else model.layers
+        with self.as_default():
+            K.batch_set_value([(w, v) for l in layers if l.name in weights
+                               for w, v in zip(l.weights, weights[l.name])])
+
+        self.log_dir = log_dir
+        self.checkpoint_path = os.path.join(self.log_dir, "mask_rcnn_{}_{{epoch:04d}}.h5".format(
+            self.config.NAME.lower()))
+        self.epoch = state["epoch"]
+        self.samples_seen = state["samples_seen"]
+        self.sampler_seed = state["sampler_seed"]
+        self.resume_state = state
+        # Keep the ranking of the checkpoints already on disk
+        self.checkpoints = CheckpointManager(
+            self.checkpoint_path,
+            keep_best=self.config.CHECKPOINT_KEEP_BEST,
+            ema_weight=self.config.CHECKPOINT_EMA_WEIGHT)
+        if "callbacks" in state and "CheckpointManager" in state["callbacks"]:
+            self.checkpoints.saved.update(state["callbacks"]["CheckpointManager"]["saved"])
+        print('Resuming from epoch %d' % self.epoch)
+        return state
+
+    @timed
     def mold_inputs(self, images):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
@@ -2393,12 +3361,16 @@ class MaskRCNN():
         for image in images:
             # Resize image
             # TODO: move resizing to mold_image()
+            disk = None
+            if self.config.IMAGE_RESIZE_MODE == "disk":
+                disk = utils.find_disk(image, self.config.DISK_THRESHOLD)
             molded_image, window, scale, padding, crop = utils.resize_image(
                 image,
                 min_dim=self.config.IMAGE_MIN_DIM,
                 min_scale=self.config.IMAGE_MIN_SCALE,
                 max_dim=self.config.IMAGE_MAX_DIM,
-                mode=self.config.IMAGE_RESIZE_MODE)
+                mode=self.config.IMAGE_RESIZE_MODE,
+                disk=disk)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
             image_meta = compose_image_meta(
@@ -2414,6 +3386,7 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
+    @timed
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
                           image_shape, window):
         """Reformats the detections of one image from the format of the neural
@@ -2451,18 +3424,7 @@ class MaskRCNN():
         scores = detections[:N, 5]
         masks = mrcnn_mask[np.arange(N), :, :, class_ids]
 
-        # Translate normalized coordinates in the resized image to pixel
-        # coordinates in the original image before resizing
-        window = utils.norm_boxes(window, image_shape[:2])
-        wy1, wx1, wy2, wx2 = window
-        shift = np.array([wy1, wx1, wy1, wx1])
-        wh = wy2 - wy1  # window height
-        ww = wx2 - wx1  # window width
-        scale = np.array([wh, ww, wh, ww])
-        # Convert boxes to normalized coordinates on the window
-        boxes = np.divide(boxes - shift, scale)
-        # Convert boxes to pixel coordinates on the original image
-        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+        boxes = self.unmold_boxes(boxes, original_image_shape, image_shape, window)
 
         # Filter out detections with zero area. Happens in early training when
         # network weights are still random
@@ -2486,16 +3448,72 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def unmold_boxes(self, boxes, original_image_shape, image_shape, window):
+        """Translates boxes in normalized coordinates of the molded image to
+        pixel coordinates in the original image before resizing.
+
+        boxes: [N, (y1, x1, y2, x2)] in normalized coordinates
+        original_image_shape: [H, W, C] Original image shape before resizing
+        image_shape: [H, W, C] Shape of the image after resizing and padding
+        window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
+                image is excluding the padding.
+        """
+        window = utils.norm_boxes(window, image_shape[:2])
+        wy1, wx1, wy2, wx2 = window
+        shift = np.array([wy1, wx1, wy1, wx1])
+        wh = wy2 - wy1  # window height
+        ww = wx2 - wx1  # window width
+        scale = np.array([wh, ww, wh, ww])
+        # Convert boxes to normalized coordinates on the window
+        boxes = np.divide(boxes - shift, scale)
+        # Convert boxes to pixel coordinates on the original image. Clip
+        # them to it, because the molded image can extend past it (disk
+        # resize mode).
+        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, original_image_shape[0])
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, original_image_shape[1])
+        return boxes
+
+    def unmold_background(self, rpn_rois, mrcnn_class, original_image_shape,
+                          image_shape, window):
+        """Returns the proposals of one image that the classifier head
+        assigned to the background class, highest background score first.
+
+        rpn_rois: [N, (y1, x1, y2, x2)] Proposals in normalized coordinates.
+            Zero padded.
+        mrcnn_class: [N, num_classes] Classifier probabilities of the proposals
+
+        Returns:
+        boxes: [M, (y1, x1, y2, x2)] Proposal boxes in pixels. Not refined,
+            because the box regression isn't trained for the background.
+        scores: [M] Background class probabilities
+        """
+        is_background = (np.argmax(mrcnn_class, axis=1) == 0) &\
+            np.any(rpn_rois != 0, axis=1)
+        ix = np.where(is_background)[0]
+        ix = ix[np.argsort(-mrcnn_class[ix, 0], kind="stable")]
+        boxes = self.unmold_boxes(rpn_rois[ix], original_image_shape, image_shape, window)
+        return boxes, mrcnn_class[ix, 0]
+
+    def detect(self, images, verbose=0, background=False, prior_rois=None):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        background: If True, also return the proposals that were classified
+            as background, from the same forward pass.
+        prior_rois: Optional list of [N, (y1, x1, y2, x2)] boxes in pixels of
+            each image to classify along with the RPN proposals, e.g. the
+            detections of the previous frame. Needs Config.PRIOR_ROIS. Extra
+            boxes beyond PRIOR_ROIS are ignored.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
         masks: [H, W, N] instance binary masks
+        If background is True:
+        background_rois: [M, (y1, x1, y2, x2)] background proposal boxes
+        background_scores: [M] background class probabilities
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2518,17 +3536,25 @@ class MaskRCNN():
 
         # Anchors
         anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        if self.config.DISK_MASK:
+            anchors = self.mask_off_disk_anchors(anchors, molded_images)
+        else:
+            # Duplicate across the batch dimension because Keras requires it
+            # TODO: can this be optimized to avoid duplicating the anchors?
+            anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
             log("anchors", anchors)
+        if prior_rois is not None:
+            assert self.config.PRIOR_ROIS, "Set PRIOR_ROIS to pass prior_rois."
+            prior_rois = self.mold_prior_rois(prior_rois, images, image_shape, windows)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        outputs = self.predict_detections(
+            molded_images, image_metas, anchors, background=background,
+            prior_rois=prior_rois)
+        detections, mrcnn_mask = outputs[:2]
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -2542,15 +3568,21 @@ class MaskRCNN():
                 "scores": final_scores,
                 "masks": final_masks,
             })
+            if background:
+                mrcnn_class, rpn_rois = outputs[2:]
+                results[-1]["background_rois"], results[-1]["background_scores"] =\
+                    self.unmold_background(rpn_rois[i], mrcnn_class[i], image.shape,
+                                           molded_images[i].shape, windows[i])
         return results
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+    def detect_molded(self, molded_images, image_metas, verbose=0, background=False):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
+        background: If True, also return the background proposals. See detect().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
@@ -2575,17 +3607,21 @@ class MaskRCNN():
 
         # Anchors
         anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        if self.config.DISK_MASK:
+            anchors = self.mask_off_disk_anchors(anchors, molded_images)
+        else:
+            # Duplicate across the batch dimension because Keras requires it
+            # TODO: can this be optimized to avoid duplicating the anchors?
+            anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
             log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        outputs = self.predict_detections(
+            molded_images, image_metas, anchors, background=background)
+        detections, mrcnn_mask = outputs[:2]
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2600,8 +3636,101 @@ class MaskRCNN():
                 "scores": final_scores,
                 "masks": final_masks,
             })
+            if background:
+                mrcnn_class, rpn_rois = outputs[2:]
+                results[-1]["background_rois"], results[-1]["background_scores"] =\
+                    self.unmold_background(rpn_rois[i], mrcnn_class[i], image.shape,
+                                           molded_images[i].shape, window)
         return results
 
+    def mold_prior_rois(self, prior_rois, images, image_shape, windows):
+        """Converts the prior_rois of detect() into the model input.
+
+        prior_rois: List of [N, (y1, x1, y2, x2)] boxes in pixels of each image
+        images: The original images
+        image_shape: [H, W, C] Shape of the molded images
+        windows: [batch, (y1, x1, y2, x2)] from mold_inputs()
+
+        Returns: [batch, PRIOR_ROIS, (y1, x1, y2, x2)] in normalized
+        coordinates of the molded images, zero padded.
+        """
+        molded = np.zeros([self.config.BATCH_SIZE, self.config.PRIOR_ROIS, 4],
+                          dtype=np.float32)
+        for i, (boxes, image, window) in enumerate(zip(prior_rois, images, windows)):
+            boxes = np.asarray(boxes).reshape([-1, 4])[:self.config.PRIOR_ROIS]
+            molded[i, :len(boxes)] = self.mold_boxes(boxes, image.shape,
+                                                     image_shape, window)
+        return molded
+
+    def mold_boxes(self, boxes, original_image_shape, image_shape, window):
+        """The inverse of unmold_boxes(). Translates boxes in pixel
+        coordinates of the original image to normalized coordinates of the
+        molded image.
+        """
+        window = utils.norm_boxes(window, image_shape[:2])
+        wy1, wx1, wy2, wx2 = window
+        shift = np.array([wy1, wx1, wy1, wx1])
+        wh = wy2 - wy1  # window height
+        ww = wx2 - wx1  # window width
+        scale = np.array([wh, ww, wh, ww])
+        boxes = utils.norm_boxes(boxes, original_image_shape[:2])
+        return np.clip(boxes * scale + shift, 0, 1)
+
+    def prior_rois_input(self, prior_rois=None):
+        """Returns the prior ROIs model input as a list, empty without
+        Config.PRIOR_ROIS. No prior_rois means all zero padding."""
+        if not self.config.PRIOR_ROIS:
+            return []
+        if prior_rois is None:
+            prior_rois = np.zeros([self.config.BATCH_SIZE, self.config.PRIOR_ROIS, 4],
+                                  dtype=np.float32)
+        return [prior_rois]
+
+    @timed
+    def predict_detections(self, molded_images, image_metas, anchors, background=False,
+                           prior_rois=None):
+        """Runs the network on a batch of molded inputs.
+
+        Returns the raw network outputs that unmold_detections() expects:
+        detections: [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+        mrcnn_mask: [batch, DETECTION_MAX_INSTANCES, height, width, num_classes]
+        If background is True, followed by those unmold_background() expects:
+        mrcnn_class: [batch, POST_NMS_ROIS_INFERENCE, num_classes]
+        rpn_rois: [batch, POST_NMS_ROIS_INFERENCE, (y1, x1, y2, x2)]
+        The last two have PRIOR_ROIS more ROIs, the prior ones, at the end.
+
+        prior_rois: [batch, PRIOR_ROIS, (y1, x1, y2, x2)] from
+            mold_prior_rois(), or None for none
+        """
+        model_in = [molded_images, image_metas, anchors] + self.prior_rois_input(prior_rois)
+        with self.as_default():
+            detections, mrcnn_class, _, mrcnn_mask, rpn_rois, _, _ =\
+                self.keras_model.predict(model_in, verbose=0)
+        if background:
+            return detections, mrcnn_mask, mrcnn_class, rpn_rois
+        return detections, mrcnn_mask
+
+    def mask_off_disk_anchors(self, anchors, molded_images):
+        """Zeroes the anchors that are off the solar disk of each image.
+        ProposalLayer never picks zero anchors. See Config.DISK_MASK.
+
+        anchors: [num_anchors, (y1, x1, y2, x2)] from get_anchors()
+        molded_images: [batch, height, width, channels]
+
+        Returns: [batch, num_anchors, (y1, x1, y2, x2)]
+        """
+        pixel_anchors = utils.denorm_boxes(anchors, molded_images[0].shape[:2])
+        masked = np.zeros((len(molded_images),) + anchors.shape, dtype=anchors.dtype)
+        for i, image in enumerate(molded_images):
+            disk = utils.find_disk(unmold_image(image, self.config),
+                                   self.config.DISK_THRESHOLD)
+            if disk is None:
+                masked[i] = anchors
+                continue
+            on_disk = utils.boxes_on_disk(pixel_anchors, disk, self.config.DISK_MARGIN)
+            masked[i][on_disk] = anchors[on_disk]
+        return masked
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
@@ -2615,7 +3744,8 @@ class MaskRCNN():
                 self.config.RPN_ANCHOR_RATIOS,
                 backbone_shapes,
                 self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
+                self.config.RPN_ANCHOR_STRIDE,
+                cache_dir=self.config.CACHE_DIR)
             # Keep a copy of the latest anchors in pixel coordinates because
             # it's used in inspect_model notebooks.
             # TODO: Remove this after the notebook are refactored to not use it
@@ -2694,10 +3824,11 @@ class MaskRCNN():
             assert o is not None
 
         # Build a Keras function to run parts of the computation graph
-        inputs = model.inputs
-        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
-            inputs += [K.learning_phase()]
-        kf = K.function(model.inputs, list(outputs.values()))
+        with self.as_default():
+            inputs = model.inputs
+            if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+                inputs += [K.learning_phase()]
+            kf = K.function(model.inputs, list(outputs.values()))
 
         # Prepare inputs
         if image_metas is None:
@@ -2707,15 +3838,19 @@ class MaskRCNN():
         image_shape = molded_images[0].shape
         # Anchors
         anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        if self.config.DISK_MASK:
+            anchors = self.mask_off_disk_anchors(anchors, molded_images)
+        else:
+            # Duplicate across the batch dimension because Keras requires it
+            # TODO: can this be optimized to avoid duplicating the anchors?
+            anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        model_in = [molded_images, image_metas, anchors] + self.prior_rois_input()
 
         # Run inference
-        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
-            model_in.append(0.)
-        outputs_np = kf(model_in)
+        with self.as_default():
+            if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+                model_in.append(0.)
+            outputs_np = kf(model_in)
 
         # Pack the generated Numpy arrays into a a dict and log the results.
         outputs_np = OrderedDict([(k, v)
@@ -0,0 +1,322 @@
+"""
+Mask R-CNN
+Inference on time series of full-disk solar frames: skipping frames that
+barely changed since the last detected one, and tracking.
+
+Licensed under the MIT License (see LICENSE for details)
+
+Consecutive frames of one day are minutes apart and their filaments
+hardly move, except for the rotation of the Sun. SequenceDetector
+rotates the last frame that went through the network to the time of the
+new frame, compares the two on a small grayscale copy, and only runs
+detect() if they differ by more than a threshold. Otherwise it moves the
+previous detections by the same rotation and returns those.
+
+Tracker links the detections of consecutive frames into tracks. With
+Config.PRIOR_ROIS it also feeds the rotated boxes of the tracks to the
+network as extra ROIs, so that fewer RPN proposals are needed.
+
+The rotation model assumes that solar north is up and that the solar
+equator crosses the disk center (B0 = 0), which is within a pixel or so
+over the minutes to hours between frames.
+"""
+
+import numpy as np
+import scipy.ndimage
+
+from mrcnn import utils
+
+
+# Mean sidereal rotation rate of the photosphere (degrees per day) as
+# A + B sin^2(latitude) + C sin^4(latitude). Snodgrass & Ulrich (1990).
+ROTATION_RATE = (14.713, -2.396, -1.787)
+
+# Seconds per day
+DAY = 86400.
+
+
+def rotation_rate(latitude):
+    """Returns the solar rotation rate in radians per day at the given
+    latitudes (radians)."""
+    a, b, c = ROTATION_RATE
+    s = np.sin(latitude) ** 2
+    return np.radians(a + b * s + c * s ** 2)
+
+
+def derotate_points(points, disk, days):
+    """Moves points on the solar disk by the rotation of the Sun.
+
+    points: [N, (y, x)] in pixels
+    disk: (y, x, radius) of the solar disk in pixels
+    days: Time to rotate by. Negative to rotate back.
+
+    Returns [N, (y, x)]. Points off the disk don't move. Points that would
+    rotate behind the limb stop at the limb.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape([-1, 2])
+    y, x, radius = disk
+    # Solar north is up, so latitude grows upwards
+    v = (y - points[:, 0]) / radius
+    u = (points[:, 1] - x) / radius
+    on_disk = u ** 2 + v ** 2 < 1
+    latitude = np.arcsin(np.clip(v, -1, 1))
+    longitude = np.arcsin(np.clip(u / np.maximum(np.cos(latitude), 1e-9), -1, 1))
+    longitude = np.clip(longitude + rotation_rate(latitude) * days,
+                        -np.pi / 2, np.pi / 2)
+    moved = points.copy()
+    moved[:, 1] = np.where(on_disk, x + np.cos(latitude) * np.sin(longitude) * radius,
+                           points[:, 1])
+    return moved
+
+
+def derotate_image(image, disk, days):
+    """Rotates the solar disk of a grayscale image forward by `days`.
+    Pixels that have no source on the disk become zero."""
+    grid = np.indices(image.shape[:2], dtype=np.float64).reshape([2, -1]).T
+    # Each pixel takes its value from where it was `days` earlier
+    source = derotate_points(grid, disk, -days)
+    return scipy.ndimage.map_coordinates(
+        image, source.T, order=1, cval=0).reshape(image.shape[:2])
+
+
+def box_shifts(boxes, disk, days):
+    """Returns the [N, (dy, dx)] integer pixel shifts that move boxes by
+    the solar rotation. Each box moves as a whole, by the displacement of
+    its center."""
+    boxes = np.asarray(boxes).reshape([-1, 4])
+    centers = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2,
+                        (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+    return np.round(derotate_points(centers, disk, days) - centers).astype(np.int32)
+
+
+def shift_result(result, disk, days, image_shape):
+    """Moves the detections of a detect() result by the solar rotation.
+    See box_shifts().
+    """
+    rois = result["rois"]
+    masks = result["masks"]
+    if not len(rois):
+        return dict(result)
+    shifts = box_shifts(rois, disk, days)
+    height, width = image_shape[:2]
+    new_rois = rois.copy()
+    new_masks = np.zeros_like(masks)
+    for i, (dy, dx) in enumerate(shifts):
+        new_rois[i] = rois[i] + [dy, dx, dy, dx]
+        # Masks lie within their boxes, so moving the box region moves all of it
+        ny1, nx1, ny2, nx2 = np.clip(new_rois[i], 0, [height, width, height, width])
+        new_masks[ny1:ny2, nx1:nx2, i] = masks[ny1 - dy:ny2 - dy, nx1 - dx:nx2 - dx, i]
+        new_rois[i] = [ny1, nx1, ny2, nx2]
+    return dict(result, rois=new_rois, masks=new_masks)
+
+
+class SequenceDetector(object):
+    """Runs detection on a time series of frames, one frame at a time.
+
+    A frame goes through the network if it differs from the last frame
+    that did, rotated to the time of the new frame, by more than
+    `threshold`. Otherwise the detections of that frame are rotated and
+    reused. The difference is the mean absolute difference of the disk
+    pixels of small grayscale copies, relative to the mean brightness of
+    the disk.
+    """
+
+    def __init__(self, model, threshold=0.02, max_skip=10, size=256):
+        """
+        model: A MaskRCNN (or FrozenDetector) in inference mode
+        threshold: Relative change below which a frame reuses detections
+        max_skip: Frames in a row that can reuse the same detections before
+            a frame is detected anyway. 0 for no limit.
+        size: Width and height of the copies that are compared
+        """
+        self.model = model
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """Forgets the last detected frame, e.g. at the start of a new day."""
+        self.reference = None
+        self.skipped = 0
+        self.frame_count = 0
+        self.detect_count = 0
+
+    def thumbnail(self, image):
+        """Returns a small grayscale copy of a frame and its disk in the
+        copy's pixels, or None if there's no disk."""
+        gray = image.mean(axis=2) if image.ndim == 3 else image.astype(np.float64)
+        step = max(1, int(np.ceil(max(gray.shape) / self.size)))
+        gray = gray[::step, ::step]
+        disk = utils.find_disk(gray, self.model.config.DISK_THRESHOLD)
+        return gray, disk
+
+    def change(self, thumbnail, disk, days):
+        """Relative change of a thumbnail against the reference frame,
+        rotated by `days`."""
+        reference, reference_disk = self.reference["thumbnail"], self.reference["thumbnail_disk"]
+        if disk is None or reference_disk is None or reference.shape != thumbnail.shape:
+            return np.inf
+        if days:
+            reference = derotate_image(reference, reference_disk, days)
+        # Compare the inside of the disk, away from the limb
+        y, x, radius = disk
+        yy, xx = np.indices(thumbnail.shape)
+        inside = (yy - y) ** 2 + (xx - x) ** 2 < (0.95 * radius) ** 2
+        if not np.any(inside):
+            return np.inf
+        brightness = max(thumbnail[inside].mean(), 1e-6)
+        return np.abs(thumbnail[inside] - reference[inside]).mean() / brightness
+
+    def detect(self, image, time=None):
+        """Returns the detections of a frame, like MaskRCNN.detect() does
+        for a single image, with two more entries:
+        reused: True if the detections were moved from an earlier frame
+        change: The relative change against that frame (inf if detected
+            because there was nothing to compare to)
+
+        image: [height, width, 3] frame
+        time: Time of the frame in seconds, e.g. a POSIX timestamp. Without
+            times the frames aren't rotated before comparing.
+        """
+        self.frame_count += 1
+        thumbnail, disk = self.thumbnail(image)
+        days = 0
+        if self.reference is not None and time is not None and \
+                self.reference["time"] is not None:
+            days = (time - self.reference["time"]) / DAY
+
+        change = np.inf
+        if self.reference is not None and image.shape == self.reference["shape"] and \
+                (not self.max_skip or self.skipped < self.max_skip):
+            change = self.change(thumbnail, disk, days)
+        if change < self.threshold:
+            self.skipped += 1
+            result = self.reference["result"]
+            if days:
+                step = image.shape[0] / thumbnail.shape[0]
+                result = shift_result(result, self.reference["thumbnail_disk"] * step,
+                                      days, image.shape)
+            return dict(result, reused=True, change=change)
+
+        # Full forward pass. Fill the batch with copies of the frame.
+        images = [image] * self.model.config.BATCH_SIZE
+        result = self.model.detect(images)[0]
+        self.detect_count += 1
+        self.skipped = 0
+        self.reference = {"thumbnail": thumbnail, "thumbnail_disk": disk,
+                          "time": time, "shape": image.shape, "result": result}
+        return dict(result, reused=False, change=change)
+
+    def stats(self):
+        """Returns the numbers of frames seen and detected."""
+        return {"frames": self.frame_count, "detected": self.detect_count,
+                "reused": self.frame_count - self.detect_count}
+
+
+class Tracker(object):
+    """Detects on a time series of frames and links the detections of
+    consecutive frames into tracks.
+
+    The boxes of the tracks are moved by the solar rotation to the time of
+    each new frame. If the model has Config.PRIOR_ROIS, they go into the
+    network as extra ROIs next to the RPN proposals. A detection continues
+    the track whose moved box it overlaps most, if the IoU is at least
+    `iou_threshold`, and starts a new track otherwise. Tracks without a
+    detection are kept for `max_age` frames.
+    """
+
+    def __init__(self, model, iou_threshold=0.3, max_age=3):
+        """
+        model: A MaskRCNN (or FrozenDetector) in inference mode
+        iou_threshold: Minimum IoU of a detection and a moved track box to
+            continue the track
+        max_age: Frames in a row a track can miss before it ends
+        """
+        self.model = model
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.reset()
+
+    def reset(self):
+        """Ends all tracks, e.g. at the start of a new day."""
+        # Track ID -> {"box", "score", "time", "age"}
+        self.tracks = {}
+        self.next_id = 1
+
+    def predict(self, disk, time):
+        """Returns the IDs of the live tracks, best score first, and their
+        boxes moved to the given time."""
+        track_ids = sorted(self.tracks, key=lambda i: -self.tracks[i]["score"])
+        boxes = np.array([self.tracks[i]["box"] for i in track_ids],
+                         dtype=np.int32).reshape([-1, 4])
+        if disk is None or time is None or not len(boxes):
+            return track_ids, boxes
+        days = np.array([(time - self.tracks[i]["time"]) / DAY
+                         if self.tracks[i]["time"] is not None else 0
+                         for i in track_ids])
+        for i, box in enumerate(boxes):
+            if days[i]:
+                dy, dx = box_shifts(box, disk, days[i])[0]
+                boxes[i] += [dy, dx, dy, dx]
+        return track_ids, boxes
+
+    def match(self, rois, boxes):
+        """Greedily pairs detections with the moved track boxes, highest IoU
+        first. Returns [N] indices into boxes, -1 for no match."""
+        matches = -np.ones([len(rois)], dtype=np.int32)
+        if not len(rois) or not len(boxes):
+            return matches
+        overlaps = utils.compute_overlaps(rois.astype(np.float32), boxes.astype(np.float32))
+        taken = np.zeros([len(boxes)], dtype=bool)
+        for flat in np.argsort(-overlaps, axis=None, kind="stable"):
+            d, t = np.unravel_index(flat, overlaps.shape)
+            if overlaps[d, t] < self.iou_threshold:
+                break
+            if matches[d] < 0 and not taken[t]:
+                matches[d] = t
+                taken[t] = True
+        return matches
+
+    def detect(self, image, time=None):
+        """Returns the detections of a frame, like MaskRCNN.detect() does
+        for a single image, with one more entry:
+        track_ids: [N] int track IDs. New tracks get new IDs.
+
+        image: [height, width, 3] frame
+        time: Time of the frame in seconds, e.g. a POSIX timestamp. Without
+            times the track boxes aren't moved.
+        """
+        disk = utils.find_disk(image, self.model.config.DISK_THRESHOLD)
+        track_ids, boxes = self.predict(disk, time)
+        height, width = image.shape[:2]
+        boxes = np.clip(boxes, 0, [height, width, height, width])
+
+        # Full forward pass. Fill the batch with copies of the frame.
+        images = [image] * self.model.config.BATCH_SIZE
+        if self.model.config.PRIOR_ROIS:
+            r = self.model.detect(images, prior_rois=[boxes] * len(images))[0]
+        else:
+            r = self.model.detect(images)[0]
+
+        matches = self.match(r["rois"], boxes)
+        ids = []
+        for d, t in enumerate(matches):
+            if t >= 0:
+                ids.append(track_ids[t])
+            else:
+                ids.append(self.next_id)
+                self.next_id += 1
+            self.tracks[ids[d]] = {"box": r["rois"][d], "score": r["scores"][d],
+                                   "time": time, "age": 0}
+        # Tracks without a detection keep their moved box for a while
+        for t, i in enumerate(track_ids):
+            if i in ids:
+                continue
+            track = self.tracks[i]
+            track["age"] += 1
+            if track["age"] > self.max_age:
+                del self.tracks[i]
+            else:
+                track.update(box=boxes[t], time=time)
+        return dict(r, track_ids=np.array(ids, dtype=np.int32))
@@ -12,10 +12,12 @@ import os
 import logging
 import math
 import random
+import hashlib
 import numpy as np
 import tensorflow as tf
 import scipy
 import skimage.color
+import skimage.draw
 import skimage.io
 import skimage.transform
 import urllib.request
@@ -23,6 +25,9 @@ import shutil
 import warnings
 from distutils.version import LooseVersion
 
+from mrcnn.instrument import timed
+from mrcnn.bilinear import crop_and_resize
+
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
@@ -384,8 +389,41 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_polygons(self, image_id):
+        """Load instance outlines for the given image as polygons.
+
+        Optional. Datasets whose annotations are polygons can override this
+        so that augmentation and resizing are applied to the outlines and
+        the masks are rasterized afterwards. See Config.AUGMENT_POLYGONS and
+        Config.RASTERIZE_POLYGONS.
+
+        Returns:
+            polygons: A list with one entry per instance. Each entry is a
+                list of [num_points, (x, y)] float arrays, one per part of
+                the instance, in pixel coordinates of the original image.
+            class_ids: a 1D array of class IDs of the instances.
+        Or (None, None) if polygons are not available, in which case
+        load_mask() is used.
+        """
+        return None, None
+
+    def load_disk(self, image_id):
+        """Load the solar disk of the given image, if the dataset knows it.
+
+        Optional. Used with Config.DISK_MASK. Datasets of full-disk frames
+        can override this to provide the disk instead of having it found
+        in the image with find_disk().
+
+        Returns:
+            (y, x, radius) of the disk in pixels of the original image,
+            or None to find it in the image.
+        """
+        return self.image_info[image_id].get("disk")
+
 
-def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+@timed
+def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square",
+                 disk=None):
     """Resizes an image keeping the aspect ratio unchanged.
 
     min_dim: if provided, resizes the image such that it's smaller
@@ -407,6 +445,14 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
               max_dim is not used in this mode.
+        disk: For full-disk solar frames. Crops the bounding square of the
+              solar disk, padding with zeros where it sticks out of the
+              image, and scales it to [max_dim, max_dim]. The window then
+              extends past the returned image. min_dim and min_scale are
+              not used. Falls back to square if there's no disk or it's
+              smaller than DISK_MIN_SIZE of the shorter image side.
+    disk: Optional. (y, x, radius) of the solar disk in pixels, for the
+        disk mode. Found with find_disk() if not given.
 
     Returns:
     image: the resized image
@@ -429,6 +475,16 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     if mode == "none":
         return image, window, scale, padding, crop
 
+    if mode == "disk":
+        if disk is None:
+            disk = find_disk(image)
+        # A disk given by the dataset can be implausibly small, too. It
+        # would scale the image up by orders of magnitude.
+        if disk is None or 2 * disk[2] < DISK_MIN_SIZE * min(h, w):
+            mode = "square"
+        else:
+            return resize_disk(image, disk, max_dim)
+
     # Scale?
     if min_dim:
         # Scale up but not down
@@ -492,6 +548,43 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     return image.astype(image_dtype), window, scale, padding, crop
 
 
+def resize_disk(image, disk, size):
+    """The disk mode of resize_image(). Crops the bounding square of the
+    disk, padding it with zeros where it sticks out of the image, and
+    scales the square to size x size. Only the square is resized, not the
+    whole frame.
+
+    Returns the same values as resize_image(). scale, padding and crop
+    describe the same result as scaling the whole image, padding it and
+    cropping the square, e.g. for resize_mask().
+    """
+    image_dtype = image.dtype
+    y, x, radius = disk
+    h, w = image.shape[:2]
+    # The bounding square in pixels of the original image
+    side = max(1, int(round(2 * radius)))
+    y1 = int(round(y - side / 2))
+    x1 = int(round(x - side / 2))
+    square = image[max(y1, 0):max(y1 + side, 0), max(x1, 0):max(x1 + side, 0)]
+    square_padding = [(max(-y1, 0), max(y1 + side - h, 0)),
+                      (max(-x1, 0), max(x1 + side - w, 0)), (0, 0)]
+    square = np.pad(square, square_padding[:image.ndim], mode='constant',
+                    constant_values=0)
+    scale = size / side
+    image = resize(square, (size, size), preserve_range=True)
+    # Where the square lies in the whole image scaled by scale
+    h, w = round(h * scale), round(w * scale)
+    top = int(round(y1 * scale))
+    left = int(round(x1 * scale))
+    padding = [(max(-top, 0), max(top + size - h, 0)),
+               (max(-left, 0), max(left + size - w, 0)), (0, 0)]
+    crop = (top + padding[0][0], left + padding[1][0], size, size)
+    # Where the whole resized image lies relative to the square
+    window = (-top, -left, h - top, w - left)
+    return image.astype(image_dtype), window, scale, padding, crop
+
+
+@timed
 def resize_mask(mask, scale, padding, crop=None):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
@@ -500,17 +593,89 @@ def resize_mask(mask, scale, padding, crop=None):
     scale: mask scaling factor
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
+    crop: Optional (y, x, h, w) crop of the padded mask
     """
     # Suppress warning from scipy 0.13.0, the output shape of zoom() is
     # calculated with round() instead of int()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    mask = np.pad(mask, padding, mode='constant', constant_values=0)
     if crop is not None:
         y, x, h, w = crop
         mask = mask[y:y + h, x:x + w]
-    else:
-        mask = np.pad(mask, padding, mode='constant', constant_values=0)
+    return mask
+
+
+def resize_polygons(polygons, scale, padding, crop=None):
+    """Applies the scale and padding (or crop) that resize_image() applied
+    to the image to instance polygons. The polygon counterpart of
+    resize_mask().
+
+    polygons: See Dataset.load_polygons()
+    scale: scaling factor
+    padding: Padding in the form [(top, bottom), (left, right), (0, 0)]
+    crop: Optional (y, x, h, w) crop of the padded image from resize_image()
+    """
+    shift = np.array([padding[1][0], padding[0][0]], dtype=np.float32)
+    if crop is not None:
+        shift -= np.array([crop[1], crop[0]], dtype=np.float32)
+    return [[np.asarray(p, dtype=np.float32) * scale + shift for p in parts]
+            for parts in polygons]
+
+
+def polygons_to_bboxes(polygons, shape):
+    """Computes bounding boxes from polygon vertices, without rasterizing.
+    Boxes span the pixels whose centers lie within the vertex extents, so
+    they match the masks of polygons_to_mask() except around thin spikes
+    that don't reach a pixel center, where they can be a bit larger.
+
+    polygons: See Dataset.load_polygons()
+    shape: (height, width) of the image. Boxes are clipped to it.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)]. Instances that
+    don't cover any pixel center get a box with zero area.
+    """
+    boxes = np.zeros([len(polygons), 4], dtype=np.int32)
+    for i, parts in enumerate(polygons):
+        if not len(parts):
+            continue
+        p = np.concatenate(parts, axis=0)
+        x1, y1 = np.ceil(p.min(axis=0) - 0.5)
+        x2, y2 = np.floor(p.max(axis=0) - 0.5) + 1
+        boxes[i] = [y1, x1, y2, x2]
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, shape[0])
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, shape[1])
+    return boxes
+
+
+def polygons_to_mask(polygons, shape, bbox=None):
+    """Rasterizes instance polygons into a stack of binary masks. The parts
+    of an instance are merged into one mask.
+
+    polygons: See Dataset.load_polygons(). (0, 0) is the top-left corner
+        of the top-left pixel.
+    shape: (height, width) of the masks
+    bbox: Optional [num_instances, (y1, x1, y2, x2)]. If provided, each
+        instance is rasterized into its box stretched to shape, which gives
+        mini masks directly (see minimize_mask()). Use polygons_to_bboxes()
+        to get the boxes.
+
+    Returns: bool array [height, width, instance count]
+    """
+    mask = np.zeros(tuple(shape[:2]) + (len(polygons),), dtype=bool)
+    for i, parts in enumerate(polygons):
+        if bbox is not None:
+            y1, x1, y2, x2 = bbox[i][:4]
+            shift = np.array([x1, y1], dtype=np.float32)
+            scale = np.array([shape[1] / (x2 - x1), shape[0] / (y2 - y1)])
+        for p in parts:
+            if bbox is not None:
+                p = (p - shift) * scale
+            # skimage.draw uses pixel centers, so shift by half a pixel
+            rr, cc = skimage.draw.polygon(p[:, 1] - 0.5, p[:, 0] - 0.5,
+                                          shape[:2])
+            mask[rr, cc, i] = True
     return mask
 
 
@@ -520,18 +685,15 @@ def minimize_mask(bbox, mask, mini_shape):
 
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
-        y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
-            raise Exception("Invalid bounding box with area of zero")
-        # Resize with bilinear interpolation
-        m = resize(m, mini_shape)
-        mini_mask[:, :, i] = np.around(m).astype(np.bool)
-    return mini_mask
+    bbox = np.asarray(bbox)[:, :4]
+    if np.any((bbox[:, 2] <= bbox[:, 0]) | (bbox[:, 3] <= bbox[:, 1])):
+        raise Exception("Invalid bounding box with area of zero")
+    # Cast to bool in case load_mask() returned wrong dtype
+    if mask.dtype != bool:
+        mask = mask.astype(bool)
+    # Resize with bilinear interpolation. [N, h, w] -> [h, w, N]
+    m = crop_and_resize(mask, bbox, mini_shape)
+    return np.around(m).astype(bool).transpose(1, 2, 0)
 
 
 def expand_mask(bbox, mini_mask, image_shape):
@@ -541,14 +703,18 @@ def expand_mask(bbox, mini_mask, image_shape):
     See inspect_data.ipynb notebook for more details.
     """
     mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
-        y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        # Resize with bilinear interpolation
-        m = resize(m, (h, w))
-        mask[y1:y2, x1:x2, i] = np.around(m).astype(np.bool)
+    bbox = np.asarray(bbox, dtype=np.int64)[:, :4]
+    n = mask.shape[-1]
+    if n == 0:
+        return mask
+    # Resize with bilinear interpolation. Each mini mask is scaled to the
+    # size of its box; the results are padded to the largest box.
+    mini_boxes = np.tile([0, 0, mini_mask.shape[0], mini_mask.shape[1]], (n, 1))
+    sizes = np.stack([bbox[:, 2] - bbox[:, 0], bbox[:, 3] - bbox[:, 1]], axis=1)
+    m = np.around(crop_and_resize(mini_mask, mini_boxes, sizes)).astype(bool)
+    # Paste into place. Padding is all zeros, so it's never selected.
+    i, y, x = np.nonzero(m)
+    mask[bbox[i, 0] + y, bbox[i, 1] + x, i] = True
     return mask
 
 
@@ -620,16 +786,35 @@ def generate_anchors(scales, ratios, shape, feature_stride, anchor_stride):
 
 
 def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
-                             anchor_stride):
+                             anchor_stride, cache_dir=None):
     """Generate anchors at different levels of a feature pyramid. Each scale
     is associated with a level of the pyramid, but each ratio is used in
     all levels of the pyramid.
 
+    cache_dir: Optional. Directory to cache the anchors in. Processes that
+        use the same anchors then share one read-only, memory-mapped copy.
+
     Returns:
     anchors: [N, (y1, x1, y2, x2)]. All generated anchors in one array. Sorted
         with the same order of the given scales. So, anchors of scale[0] come
         first, then anchors of scale[1], and so on.
     """
+    if cache_dir:
+        key = repr((list(scales), list(ratios), np.asarray(feature_shapes).tolist(),
+                    list(feature_strides), anchor_stride))
+        path = os.path.join(cache_dir, "anchors_{}.npy".format(
+            hashlib.sha1(key.encode("utf8")).hexdigest()[:16]))
+        if not os.path.exists(path):
+            anchors = generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                               feature_strides, anchor_stride)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Other processes may be reading or writing the same file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, anchors)
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
     anchors = []
@@ -639,6 +824,74 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+############################################################
+#  Solar Disk
+############################################################
+
+# The smallest plausible diameter of the solar disk, as a fraction of the
+# shorter side of the frame. Smaller bright regions, e.g. a label on a dark
+# frame, aren't taken as the disk.
+DISK_MIN_SIZE = 0.25
+
+
+def find_disk(image, threshold=16, max_size=512, min_size=DISK_MIN_SIZE):
+    """Finds the solar disk of a full-disk frame, i.e. the bright circle
+    with dark corners around it.
+
+    The disk is the largest connected region of bright pixels, and its
+    extent gives the center and the radius. Dark features on the disk
+    don't change the extent, and labels or time stamps in the corners
+    are separate regions. If the disk is cut by an image edge, the
+    longer of its height and width is taken as the diameter and the
+    center is measured from the opposite side. The search
+    runs on a subsample of at most max_size pixels per side.
+
+    image: [height, width] or [height, width, channels]
+    threshold: Pixels brighter than this are on the disk.
+    min_size: The smallest diameter of the disk as a fraction of the
+        shorter image side. See DISK_MIN_SIZE.
+
+    Returns (y, x, radius) in pixels, or None if there's no disk.
+    """
+    import scipy.ndimage
+    step = max(1, int(math.ceil(max(image.shape[:2]) / max_size)))
+    image = image[::step, ::step]
+    gray = image.mean(axis=2) if image.ndim == 3 else image
+    labels, count = scipy.ndimage.label(gray > threshold)
+    if not count:
+        return None
+    disk = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+    spans = [np.where(np.any(disk, axis=1))[0], np.where(np.any(disk, axis=0))[0]]
+    spans = [(ix[0], ix[-1] + 1, n) for ix, n in zip(spans, disk.shape)]
+    radius = max(end - start for start, end, _ in spans) / 2
+    if 2 * radius < min_size * min(disk.shape):
+        return None
+    center = []
+    for start, end, n in spans:
+        # Measure from the side that isn't cut by the image edge
+        if start == 0 and end < n:
+            center.append(end - radius)
+        elif end == n and start > 0:
+            center.append(start + radius)
+        else:
+            center.append((start + end) / 2)
+    return np.array(center + [radius]) * step
+
+
+def boxes_on_disk(boxes, disk, margin=0):
+    """Returns a boolean [N] array that is True for the boxes that overlap
+    the disk grown by margin.
+
+    boxes: [N, (y1, x1, y2, x2)]
+    disk: (y, x, radius) in the same coordinates as the boxes
+    """
+    y, x, radius = disk
+    # Distance from the center of the disk to the closest point of each box
+    dy = np.maximum(np.maximum(boxes[:, 0] - y, y - boxes[:, 2]), 0)
+    dx = np.maximum(np.maximum(boxes[:, 1] - x, x - boxes[:, 3]), 0)
+    return dy ** 2 + dx ** 2 <= (radius + margin) ** 2
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -837,6 +1090,54 @@ def batch_slice(inputs, graph_fn, batch_size, names=None):
     return result
 
 
+def batch_map(inputs, graph_fn, dtype, names=None):
+    """Like batch_slice(), but runs graph_fn in a tf.map_fn() loop instead
+    of building a copy of it for every item. The graph doesn't grow with
+    the batch size, which doesn't need to be known in advance.
+
+    inputs: list of tensors. All must have the same first dimension length
+    graph_fn: A function that returns a TF tensor or a list of them. It must
+        return the same shapes for every item, e.g. zero padded ones.
+    dtype: The dtype of the output of graph_fn, or a list of dtypes if it
+        returns a list.
+    names: If provided, assigns names to the resulting tensors.
+    """
+    if not isinstance(inputs, list):
+        inputs = [inputs]
+
+    # map_fn needs the outputs and dtypes in the same kind of sequence
+    def fn(x):
+        outputs = graph_fn(*x)
+        return tuple(outputs) if isinstance(outputs, (tuple, list)) else outputs
+    dtype = tuple(dtype) if isinstance(dtype, list) else dtype
+    outputs = tf.map_fn(fn, inputs, dtype=dtype)
+    if not isinstance(outputs, (tuple, list)):
+        outputs = [outputs]
+
+    if names is None:
+        names = [None] * len(outputs)
+
+    result = [tf.identity(o, name=n) for o, n in zip(outputs, names)]
+    if len(result) == 1:
+        result = result[0]
+
+    return result
+
+
+def batch_gather(params, indices, name=None):
+    """Batched tf.gather(). Gathers indices[i] from params[i] for each item
+    in the batch with one op.
+
+    params: [batch, N, ...]
+    indices: [batch, K] int32 indices into the second dimension of params
+    Returns: [batch, K, ...]
+    """
+    batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                       [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([batch_ix, indices], axis=2),
+                        name=name)
+
+
 def download_trained_weights(coco_model_path, verbose=1):
     """Download COCO trained weights from Releases.
 
@@ -88,8 +88,7 @@ if __name__ == '__main__':
 
     print("Images: {}\nClasses: {}".format(len(dataset.image_ids), dataset.class_names))
 
-    with tf.device(DEVICE):
-        model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR, config=config)
+    model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR, config=config, device=DEVICE)
 
     if args[1] == "last":
         model_path = model.find_last()
@@ -0,0 +1,314 @@
+"""
+実験ランナー
+実験ファイル(JSON)に並べたFilamentConfigの上書きごとに学習と評価を行う
+sasaki*/ando*のようにfilament.pyをディレクトリごとコピーする代わりに使う
+
+$ python3 experiment.py experiments.json
+$ python3 experiment.py experiments.json --processes=2 --cores=8 --threads=4 --gpus=0,1
+$ python3 experiment.py experiments.json --only sasaki18 sasaki19
+
+実験ファイルの形式
+{
+    "defaults": {"patience": 15, "model": "ImageNet", "config": {...}},
+    "experiments": [
+        {"name": "sasaki19", "config": {"RPN_NMS_THRESHOLD": 0.2}},
+        {"name": "sasaki18", "patience": 10, "commands": ["train"]}
+    ]
+}
+- config:   FilamentConfigの上書き (defaultsのconfigとマージされる)
+- patience: EMAEarlyStoppingのpatience (default=EMAES_PATIENCE)
+            ステージごとのリストでもよい
+- stages:   ステージごとの {"learning_rate", "epochs", "layers"} の上書きのリスト
+            (filament.make_stages())
+- model:    初期重み 'ImageNet', 'CoCo', 'random' または.h5のパス
+- commands: "train", "evaluate" (default=両方, evaluateはbboxとsegm)
+
+Config・データセット・初期重み・そこまでのスケジュールが同じステージは
+logs/cache/stagesに保存したものを再利用する。例えばステージ3だけが違う
+実験同士はステージ1と2を1回しか学習しない
+
+実験ごとに logs/<name>/ にログと重み、run.logに標準出力、
+result.jsonに評価結果を書く
+同時に動く実験はlogs/cacheのデータセットとアンカーのキャッシュを共有する
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import traceback
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+CURRENT_DIR = os.getcwd()
+DEFAULT_LOGS_DIR = os.path.join(CURRENT_DIR, "logs")
+DEFAULT_DATASET_DIR = os.path.join(CURRENT_DIR, "dataset")
+
+# The (cores, GPU) of the experiment process. Set by run_in_slot()
+_slot = None
+
+
+def load_experiments(path):
+    """実験ファイルを読み、defaultsをマージした実験のリストを返す"""
+    with open(path) as f:
+        spec = json.load(f)
+    defaults = spec.get("defaults", {})
+    experiments = []
+    for e in spec["experiments"]:
+        experiment = dict(defaults, **e)
+        experiment["config"] = dict(defaults.get("config", {}), **e.get("config", {}))
+        experiments.append(experiment)
+    names = [e["name"] for e in experiments]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError("Duplicate experiment names: {}".format(", ".join(duplicates)))
+    return experiments
+
+
+def make_slots(processes, cores, gpus):
+    """同時に動く実験ごとの (CPUコア, GPU) の割り当てを返す"""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity")\
+        else list(range(multiprocessing.cpu_count()))
+    cores = cores or max(len(available) // processes, 1)
+    if cores * processes > len(available):
+        raise ValueError("{} processes x {} cores need {} cores. {} available."
+                         .format(processes, cores, cores * processes, len(available)))
+    slots = []
+    for i in range(processes):
+        gpu = gpus[i % len(gpus)] if gpus else None
+        slots.append((available[i * cores:(i + 1) * cores], gpu))
+    return slots
+
+
+def make_pool(processes, cores=0, gpus=""):
+    """実験を並列に行うExperimentPoolを返す
+    cores: 1実験あたりのCPUコア数 (0なら均等に分ける)
+    gpus: カンマ区切りのGPU番号。実験に順に割り当てる
+    """
+    return ExperimentPool(make_slots(processes, cores, [g for g in gpus.split(",") if g]))
+
+
+class ExperimentPool(object):
+    """multiprocessing.Poolのように実験を並列に行う
+    Poolのプロセスはdaemonで子プロセスを作れず、Kerasのデータジェネレータ
+    (use_multiprocessing=True) が動かない。そこで実験ごとにdaemonでない
+    プロセスを作り、スロットの数だけ同時に動かす。新しいプロセスなので
+    実験ごとにTensorFlowが新しく始まる
+    """
+
+    def __init__(self, slots):
+        """slots: make_slots()の返す (CPUコア, GPU) のリスト"""
+        self.slots = queue.Queue()
+        for slot in slots:
+            self.slots.put(slot)
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(slots))
+
+    def apply_async(self, func, args=()):
+        """空いたスロットのプロセスでfunc(*args)を実行する
+        Futureを返し、result()はfuncの返り値。プロセスが落ちたときは
+        {"error": ...}
+        """
+        return self.executor.submit(self.run, func, args)
+
+    def run(self, func, args):
+        slot = self.slots.get()
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_in_slot,
+                                          args=(sender, slot, func, args))
+        try:
+            process.start()
+            sender.close()
+            try:
+                return receiver.recv()
+            except EOFError:
+                process.join()
+                return {"error": "Process exited with code {}".format(process.exitcode)}
+        finally:
+            process.join()
+            receiver.close()
+            self.slots.put(slot)
+
+    def close(self):
+        """新しい実験を受け付けない。実行中と待ちの実験は続ける"""
+        self.executor.shutdown(wait=False)
+
+    def join(self):
+        """全ての実験が終わるまで待つ"""
+        self.executor.shutdown(wait=True)
+
+
+def run_in_slot(conn, slot, func, args):
+    """ExperimentPoolのプロセスでfunc(*args)を実行し、返り値を送る"""
+    global _slot
+    _slot = slot
+    conn.send(func(*args))
+    conn.close()
+
+
+@contextlib.contextmanager
+def use_slot(log_dir, result, threads=0):
+    """ExperimentPoolのプロセスで、そのスロットのコアとGPUを使って実験を行う
+    標準出力はlog_dir/run.logに書き、例外はresult["error"]に記録する
+    yield: そのスロット用のTensorFlowのsession_config
+    """
+    cores, gpu = _slot
+    os.makedirs(log_dir, exist_ok=True)
+    result.update(cores=cores, gpu=gpu)
+    stdout, stderr = sys.stdout, sys.stderr
+    log_file = open(os.path.join(log_dir, "run.log"), "a")
+    try:
+        sys.stdout = sys.stderr = log_file
+
+        # Limit this run to its cores and GPU before TensorFlow starts.
+        # Keras' data generator workers follow the core affinity.
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        threads = threads or len(cores)
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        if gpu is not None:
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+
+        import tensorflow as tf
+        yield tf.ConfigProto(allow_soft_placement=True,
+                             intra_op_parallelism_threads=threads,
+                             inter_op_parallelism_threads=threads)
+    except Exception:
+        traceback.print_exc()
+        result["error"] = traceback.format_exc().splitlines()[-1]
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log_file.close()
+
+
+def run_experiment(experiment, options):
+    """プールのプロセスで1つの実験を行う。結果のdictを返す"""
+    log_dir = os.path.join(options["logs"], experiment["name"])
+    result = {"name": experiment["name"]}
+    t_start = time.time()
+    with use_slot(log_dir, result, options["threads"]) as session_config:
+        import filament
+        from mrcnn import model as modellib
+
+        overrides = dict(experiment["config"], CACHE_DIR=options["cache_dir"])
+        commands = experiment.get("commands", ["train", "evaluate"])
+        patience = experiment.get("patience", filament.EMAES_PATIENCE)
+
+        if "train" in commands:
+            config = filament.make_config(overrides)
+            config.display()
+            model = modellib.MaskRCNN(mode="training", config=config, model_dir=log_dir,
+                                      session_config=session_config)
+            initial_weights = load_initial_weights(model, experiment.get("model", filament.MODEL))
+            dataset_train, dataset_val = filament.load_datasets(
+                options["dataset"], year=options["year"], cache_dir=options["cache_dir"])
+            # Experiments that share the first stages reuse them
+            filament.train(model, dataset_train, dataset_val, patience=patience,
+                           stages=filament.make_stages(config, experiment.get("stages")),
+                           stage_store=os.path.join(options["cache_dir"], "stages"),
+                           initial_weights=initial_weights)
+            # None if every stage was reused and nothing was trained
+            if model.checkpoints:
+                model.checkpoints.wait()
+            result["train_time"] = time.time() - t_start
+            del model
+
+        if "evaluate" in commands:
+            config = filament.make_config(overrides, inference=True)
+            model = modellib.MaskRCNN(mode="inference", config=config, model_dir=log_dir,
+                                      session_config=session_config)
+            model_path = model.find_last()
+            model.load_weights(model_path, by_name=True)
+            result["weights"] = model_path
+            dataset_val = filament.FilamentDataset()
+            coco = dataset_val.load_coco(options["dataset"], "val", return_coco=True,
+                                         year=options["year"])
+            dataset_val.prepare()
+            for eval_type in ["bbox", "segm"]:
+                stats = filament.evaluate_coco(model, dataset_val, coco, eval_type,
+                                               limit=options["limit"])
+                result[eval_type] = [float(s) for s in stats]
+
+    result["time"] = time.time() - t_start
+    with open(os.path.join(log_dir, "result.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def load_initial_weights(model, weights):
+    """filament.pyの--modelと同じ初期重みを読み込み、filament.weights_id()を返す"""
+    import filament
+    path = None
+    if weights == "ImageNet":
+        path = model.get_imagenet_weights()
+        model.load_weights(path, by_name=True)
+    elif weights == "CoCo":
+        # Exclude the last layers because they require a matching number of classes
+        path = filament.COCO_MODEL_PATH
+        model.load_weights(path, by_name=True, exclude=[
+            "mrcnn_class_logits", "mrcnn_bbox_fc", "mrcnn_bbox", "mrcnn_mask"])
+    elif weights != "random":
+        path = weights
+        model.load_weights(path, by_name=True)
+    return filament.weights_id(weights, path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run Mask R-CNN filament experiments from a file of config overrides.')
+    parser.add_argument("experiments",
+                        metavar="/path/to/experiments.json",
+                        help='Experiment file')
+    parser.add_argument('--only', required=False, nargs="+",
+                        metavar="<name>",
+                        help='Run only these experiments')
+    parser.add_argument('--dataset', required=False,
+                        default=DEFAULT_DATASET_DIR,
+                        metavar="/path/to/coco/",
+                        help='Directory of the MS-COCO dataset')
+    parser.add_argument('--year', required=False,
+                        default=2016, type=int,
+                        help='Validation set year (default=2016)')
+    parser.add_argument('--limit', required=False,
+                        default=500, type=int,
+                        help='Images to use for evaluation (default=500)')
+    parser.add_argument('--logs', required=False,
+                        default=DEFAULT_LOGS_DIR,
+                        metavar="/path/to/logs/",
+                        help='Logs and checkpoints directory (default=logs/)')
+    parser.add_argument('--processes', required=False,
+                        default=1, type=int,
+                        help='Experiments to run at the same time (default=1)')
+    parser.add_argument('--cores', required=False,
+                        default=0, type=int,
+                        help='CPU cores per experiment (default=all cores / processes)')
+    parser.add_argument('--threads', required=False,
+                        default=0, type=int,
+                        help='TensorFlow and OpenMP threads per experiment (default=cores)')
+    parser.add_argument('--gpus', required=False,
+                        default="",
+                        help='Comma separated GPU ids to spread the experiments over')
+    args = parser.parse_args()
+
+    experiments = load_experiments(args.experiments)
+    if args.only:
+        experiments = [e for e in experiments if e["name"] in args.only]
+    pool = make_pool(args.processes, args.cores, args.gpus)
+    options = {
+        "dataset": args.dataset,
+        "year": args.year,
+        "limit": args.limit,
+        "logs": args.logs,
+        "threads": args.threads,
+        "cache_dir": os.path.join(args.logs, "cache"),
+    }
+    pending = [(e["name"], pool.apply_async(run_experiment, (e, options)))
+               for e in experiments]
+    pool.close()
+    for name, r in pending:
+        result = r.result()
+        print("{:20} {}".format(name, result.get("error") or
+                                "done in {:.0f}s".format(result["time"])))
+    pool.join()
@@ -4,20 +4,31 @@
 学習用
 $ python3 filament.py train
 
+中断した学習の再開用 (logs内で最後のtraining_state.pklから続きを学習)
+$ python3 filament.py resume
+
 検証用
 $ python3 filament.py evaluate --model=last --eval_type=xxxx --year=xxxxx
 
+CPU推論用のfrozen graph出力
+$ python3 filament.py export --model=last --output=filament.pb
+$ python3 filament.py export --model=last --output=filament.pb --batch_size=4
+  (グラフはこのバッチサイズでしか動かない。filament_server.pyの--batch_sizeと合わせる)
+
 predict画像出力はinspect*.pyを実行
 """
 
 import os
 import sys
+import glob
 import time
+import json
+import pickle
+import shutil
+import hashlib
 import math
 import numpy as np
 import imgaug
-import json
-import collections as cl
 import warnings
 
 from pycocotools.coco import COCO
@@ -35,6 +46,7 @@ sys.path.append(ROOT_DIR)
 
 from mrcnn.config import Config
 from mrcnn import model as modellib, utils
+from mrcnn.instrument import timed
 
 os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
 import tensorflow as tf
@@ -67,23 +79,89 @@ class FilamentConfig(Config):
 
     BACKBONE = "resnet50"
 
+    # Keep the 3 best checkpoints by EMA val_loss, and the latest
+    CHECKPOINT_KEEP_BEST = 3
+
     STEPS_PER_EPOCH = 5 
 
     NMS_COVER_THRESHOLD = 0.05
 
+    # Augment annotation polygons instead of the full-size mask stack and
+    # rasterize them straight into mini masks
+    AUGMENT_POLYGONS = True
+    RASTERIZE_POLYGONS = True
+
+    # 全面画像の黒い四隅にかかるアンカーをRPNのターゲットとproposalから外す
+    DISK_MASK = True
+
     #IMAGE_MAX_DIM = 768
 
 
+def make_config(overrides=None, inference=False):
+    """FilamentConfigの値をoverrides(dict)で上書きしたConfigを返す
+    inference=Trueなら推論用 (1枚ずつdetect)
+    """
+    overrides = dict(overrides or {})
+    unknown = [k for k in overrides if not hasattr(FilamentConfig, k)]
+    if unknown:
+        raise ValueError("Unknown config fields: {}".format(", ".join(unknown)))
+    if inference:
+        overrides.update(GPU_COUNT=1, IMAGES_PER_GPU=1, DETECTION_MIN_CONFIDENCE=0)
+    return type("FilamentConfig", (FilamentConfig,), overrides)()
+
+
+def file_version(*paths):
+    """ファイルが変わると変わるキー (パス・サイズ・更新時刻から作る)"""
+    stats = [(os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime)
+             for p in paths]
+    return hashlib.sha1(repr(stats).encode("utf8")).hexdigest()[:16]
+
+
+def weights_id(weights, path=None):
+    """初期重みを表すキー
+    weights: --modelの値 ('ImageNet', 'CoCo', 'random', ...)
+    path: 読み込んだ重みのファイル
+    """
+    return "{}:{}".format(weights, file_version(path)) if path else weights
+
+
+def load_datasets(dataset_dir, year=2016, cache_dir=None):
+    """学習用と検証用のDatasetを返す"""
+    # Training dataset
+    dataset_train = FilamentDataset()
+    dataset_train.load_coco(dataset_dir, "train", cache_dir=cache_dir)
+    dataset_train.prepare()
+
+    # Validation dataset
+    dataset_val = FilamentDataset()
+    dataset_val.load_coco(dataset_dir, "val", year=year, cache_dir=cache_dir)
+    dataset_val.prepare()
+    return dataset_train, dataset_val
+
+
 class FilamentDataset(utils.Dataset):
-    def load_coco(self, dataset_dir, subset=None,return_coco=False, year=2016):
+    def load_coco(self, dataset_dir, subset=None,return_coco=False, year=2016, cache_dir=None):
         if subset=='train':
-            coco = COCO("{}/annotations/datasets_train.json".format(dataset_dir))
+            annotation_path = "{}/annotations/datasets_train.json".format(dataset_dir)
             image_dir = "{}/train_jpg".format(dataset_dir)
 
         else:
-            coco = COCO("{}/annotations/datasets_val_{}.json".format(dataset_dir, year))
+            annotation_path = "{}/annotations/datasets_val_{}.json".format(dataset_dir, year)
             image_dir = "{}/val_jpg_{}".format(dataset_dir, year)
 
+        # 学習済みステージの再利用のキーに使う
+        self.version = file_version(annotation_path, image_dir)
+
+        # COCOのjsonの読み込みは遅いので、cache_dirがあれば読み込んだ結果を
+        # 同じマシンで並列に動く実験と共有する (experiment.py)
+        if cache_dir and not return_coco:
+            cache_path = os.path.join(cache_dir, "dataset_{}.pkl".format(self.version))
+            if os.path.exists(cache_path):
+                with open(cache_path, "rb") as f:
+                    self.class_info, self.image_info = pickle.load(f)
+                return
+
+        coco = COCO(annotation_path)
         class_ids = sorted(coco.getCatIds())
         image_ids = list(coco.imgs.keys())
         
@@ -98,6 +176,13 @@ class FilamentDataset(utils.Dataset):
                 height=coco.imgs[i]["height"],
                 annotations=coco.loadAnns(coco.getAnnIds(
                     imgIds=[i], catIds=class_ids, iscrowd=None)))
+        if cache_dir and not return_coco:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump((self.class_info, self.image_info), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
         if return_coco:
             return coco
 
@@ -130,6 +215,25 @@ class FilamentDataset(utils.Dataset):
             return super(FilamentDataset, self).load_mask(image_id)
 
 
+    def load_polygons(self, image_id):
+        # Polygon outlines of each instance, for augmenting before rasterization.
+        # Falls back to load_mask() if any annotation is stored as RLE.
+        polygons = []
+        class_ids = []
+        annotations = self.image_info[image_id]["annotations"]
+
+        for annotation in annotations:
+            class_id = self.map_source_class_id("coco.{}".format(annotation['category_id']))
+            if class_id:
+                segm = annotation['segmentation']
+                if not isinstance(segm, list):
+                    return None, None
+                polygons.append([np.array(p, dtype=np.float32).reshape(-1, 2) for p in segm])
+                class_ids.append(class_id)
+
+        return polygons, np.array(class_ids, dtype=np.int32)
+
+
     def annToRLE(self, ann, height, width):
         segm = ann['segmentation']
         if isinstance(segm, list):
@@ -154,37 +258,6 @@ class FilamentDataset(utils.Dataset):
         return m
 
 
-class GetLosses(keras.callbacks.Callback):
-    def __init__(self):
-        self.train_loss           = [0] * 1000
-        self.rpn_class_loss       = [0] * 1000
-        self.rpn_bbox_loss        = [0] * 1000
-        self.mrcnn_class_loss     = [0] * 1000
-        self.mrcnn_bbox_loss      = [0] * 1000
-        self.mrcnn_mask_loss      = [0] * 1000
-        self.val_loss             = [0] * 1000
-        self.val_rpn_class_loss   = [0] * 1000
-        self.val_rpn_bbox_loss    = [0] * 1000
-        self.val_mrcnn_class_loss = [0] * 1000
-        self.val_mrcnn_bbox_loss  = [0] * 1000
-        self.val_mrcnn_mask_loss  = [0] * 1000
-
-    def on_epoch_end(self, epoch, logs={}):
-        n = epoch
-        self.train_loss[n]           = logs['loss']
-        self.rpn_bbox_loss[n]        = logs['rpn_bbox_loss']
-        self.rpn_class_loss[n]       = logs['rpn_class_loss']
-        self.mrcnn_class_loss[n]     = logs['mrcnn_class_loss']
-        self.mrcnn_bbox_loss[n]      = logs['mrcnn_bbox_loss']
-        self.mrcnn_mask_loss[n]      = logs['mrcnn_mask_loss']
-        self.val_loss[n]             = logs['val_loss']
-        self.val_rpn_bbox_loss[n]    = logs['val_rpn_bbox_loss']
-        self.val_rpn_class_loss[n]   = logs['val_rpn_class_loss']
-        self.val_mrcnn_class_loss[n] = logs['val_mrcnn_class_loss']
-        self.val_mrcnn_bbox_loss[n]  = logs['val_mrcnn_bbox_loss']
-        self.val_mrcnn_mask_loss[n]  = logs['val_mrcnn_mask_loss']
-
-
 class EMAEarlyStopping(keras.callbacks.Callback):
     def __init__(self, log_dir, patience=0 ):
         self.ema_weight  = 0.7 
@@ -197,6 +270,17 @@ class EMAEarlyStopping(keras.callbacks.Callback):
         self.best_epoch  = 0
         self.stage_epoch = 0
         self.wait = 0
+        # Host memory copy of the weights of the best epoch
+        self.best_weights = None
+
+    def get_state(self):
+        # Saved with the training state, see MaskRCNN.load_training_state()
+        return {"ema": list(self.ema), "best_score": self.best_score,
+                "best_epoch": self.best_epoch, "stage_epoch": self.stage_epoch,
+                "wait": self.wait, "best_weights": self.best_weights}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
 
     def on_epoch_begin(self, epoch, logs={}):
         if not self.stage_epoch == 0:
@@ -211,6 +295,7 @@ class EMAEarlyStopping(keras.callbacks.Callback):
         if self.best_score > self.ema[self.stage_epoch]:
             self.best_score = self.ema[self.stage_epoch]
             self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
             self.wait = 0
         else:
             self.wait += 1
@@ -223,16 +308,15 @@ class EMAEarlyStopping(keras.callbacks.Callback):
     def on_train_end(self,logs={}):
         print("Best epoch: " + str(self.best_epoch + 1))
         print("Best EMA val_loss: " + str(self.best_score))
-        print("Restoring model weights from the end of the best epoch.")
+        if self.best_weights is not None:
+            print("Restoring model weights from the end of the best epoch.")
+            self.model.set_weights(self.best_weights)
+            self.best_weights = None
+        # Checkpoints beyond the best ones are deleted by the checkpoint
+        # manager, see CHECKPOINT_KEEP_BEST
 
-        #Delete h5 files after the best epoch
-        for i in range(self.patience):
-            num = str(self.best_epoch + i + 1).zfill(4)
-            os.remove(self.log_dir + '/mask_rcnn_filament_' + num + '.h5')
-            print("removed: mask_rcnn_filament_"  + num + "h5") 
 
-
-class Merge_Proposal(mrcnn.ProposalLayer):
+class Merge_Proposal(modellib.ProposalLayer):
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
         scores = inputs[0][:, :, 1]
@@ -316,6 +400,7 @@ class Merge_Proposal(mrcnn.ProposalLayer):
 
 
 
+@timed
 def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
     """
@@ -389,29 +474,168 @@ def evaluate_coco(model, dataset, coco, eval_type=None, limit=0, image_ids=None)
     print("Prediction time: {}. Average {}/image".format(
         t_prediction, t_prediction / len(image_ids)))
     print("Total time: ", time.time() - t_start)
+    return cocoEval.stats
 
 
-def dump_loss(get_losses, best_epoch, timestamp):
-    #Dump result to json
-    js = cl.OrderedDict()
+# 学習結果に影響しないConfigの項目。ステージのキーに含めない
+STAGE_KEY_IGNORED = ["NAME", "CHECKPOINT_KEEP_BEST", "METRICS_LOG_STEPS",
+                     "LOG_STEP_TIMES", "CACHE_DIR"]
 
-    js["train_loss"]       = get_losses.train_loss[0:best_epoch]
-    js["rpn_class_loss"]   = get_losses.rpn_class_loss[0:best_epoch]
-    js["rpn_bbox_loss"]    = get_losses.rpn_bbox_loss[0:best_epoch]
-    js["mrcnn_class_loss"] = get_losses.mrcnn_class_loss[0:best_epoch]
-    js["mrcnn_bbox_loss"]  = get_losses.mrcnn_bbox_loss[0:best_epoch]
-    js["mrcnn_mask_loss"]  = get_losses.mrcnn_mask_loss[0:best_epoch]
-    js["val_loss"]             = get_losses.val_loss[0:best_epoch]
-    js["val_rpn_class_loss"]   = get_losses.val_rpn_class_loss[0:best_epoch]
-    js["val_rpn_bbox_loss"]    = get_losses.val_rpn_bbox_loss[0:best_epoch]
-    js["val_mrcnn_class_loss"] = get_losses.val_mrcnn_class_loss[0:best_epoch]
-    js["val_mrcnn_bbox_loss"]  = get_losses.val_mrcnn_bbox_loss[0:best_epoch]
-    js["val_mrcnn_mask_loss"]  = get_losses.val_mrcnn_mask_loss[0:best_epoch]
 
-    jsonfilename = 'loss_log/loss_' + timestamp + '.json'
-    fw = open(jsonfilename,'w')
-    json.dump(js,fw)
-    print("Saved losses to : " + jsonfilename) 
+def stage_keys(config, stages, patience, dataset_train, dataset_val, initial_weights):
+    """ステージごとの学習結果のキーを返す
+    キーはConfig・データセット・初期重み・そのステージまでのスケジュールと
+    patienceのハッシュなので、これらが同じ実験同士で学習済みのステージを共有できる
+    (例えばステージ3だけが違う実験はステージ1と2を共有する)
+    patience: ステージごとのpatienceのリスト
+    """
+    values = {a: getattr(config, a) for a in dir(config)
+              if a.isupper() and a not in STAGE_KEY_IGNORED}
+    key = json.dumps([values, dataset_train.version, dataset_val.version,
+                      initial_weights], sort_keys=True,
+                     default=lambda o: o.tolist() if hasattr(o, "tolist") else str(o))
+    keys = []
+    for (message, learning_rate, epochs, layers), p in zip(stages, patience):
+        key = json.dumps([key, learning_rate, epochs, layers, p])
+        keys.append(hashlib.sha1(key.encode("utf8")).hexdigest()[:16])
+        key = keys[-1]
+    return keys
+
+
+def load_stage(model, stage_store, key):
+    """学習済みのステージがstage_storeにあれば重みを読み込んでTrueを返す"""
+    info_path = os.path.join(stage_store, key + ".json")
+    if not os.path.exists(info_path):
+        return False
+    with open(info_path) as f:
+        info = json.load(f)
+    # load_weights() sets the log directory from the file name. Keep ours.
+    log_dir, checkpoint_path = model.log_dir, model.checkpoint_path
+    model.load_weights(os.path.join(stage_store, key + ".h5"), by_name=True)
+    model.log_dir, model.checkpoint_path = log_dir, checkpoint_path
+    model.epoch = info["epoch"]
+    # このログディレクトリのcheckpointとしても置き、find_last()で見つかるようにする
+    os.makedirs(log_dir, exist_ok=True)
+    checkpoint = checkpoint_path.format(epoch=model.epoch)
+    if not os.path.exists(checkpoint):
+        try:
+            os.link(os.path.join(stage_store, key + ".h5"), checkpoint)
+        except OSError:
+            shutil.copy(os.path.join(stage_store, key + ".h5"), checkpoint)
+    return True
+
+
+def save_stage(model, stage_store, key, info):
+    """学習を終えたステージの重みをstage_storeに保存する"""
+    os.makedirs(stage_store, exist_ok=True)
+    keras_model = model.keras_model
+    if hasattr(keras_model, "inner_model"):
+        keras_model = keras_model.inner_model
+    # Other experiments may finish the same stage at the same time
+    tmp_path = os.path.join(stage_store, ".tmp_{}_{}.h5".format(key, os.getpid()))
+    with model.as_default():
+        keras_model.save_weights(tmp_path)
+    os.replace(tmp_path, os.path.join(stage_store, key + ".h5"))
+    tmp_path = os.path.join(stage_store, ".tmp_{}_{}.json".format(key, os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump(dict(info, epoch=model.epoch), f, indent=2)
+    os.replace(tmp_path, os.path.join(stage_store, key + ".json"))
+
+
+def make_stages(config, overrides=None):
+    """学習のステージのリスト [(message, learning rate, epochs, layers)] を返す
+    overrides: ステージごとの {"learning_rate", "epochs", "layers"} の上書きのリスト
+    """
+    stages = [
+        ("Stage 1 - Training network heads",
+         config.LEARNING_RATE, 1, 'heads'),
+        #Finetune layers from ResNet stage 4 and up
+        ("Stage 2 - Fine tune Resnet stage 4 and up",
+         config.LEARNING_RATE, 2, '4+'),
+        # Fine tune all layers
+        ("Stage 3 - Fine tune all layers",
+         config.LEARNING_RATE / 10, 3000, 'all'),
+    ]
+    for i, o in enumerate(overrides or []):
+        message, learning_rate, epochs, layers = stages[i]
+        stages[i] = (message, o.get("learning_rate", learning_rate),
+                     o.get("epochs", epochs), o.get("layers", layers))
+    return stages
+
+
+def train(model, dataset_train, dataset_val, patience=EMAES_PATIENCE, first_stage=0,
+          max_epochs=None, stages=None, stage_store=None, initial_weights=None):
+    """ステージごとに学習を行う (各ステージはEMAEarlyStoppingで打ち切る)
+    patience: EMAEarlyStoppingのpatience。ステージごとのリストでもよい
+    first_stage: 途中から再開するときのステージ番号
+    max_epochs: 全ステージ通しての学習エポック数の上限 (search.py用)
+        上限で止まったらload_training_state()で続きから学習できる
+    stages: make_stages()の返すステージのリスト。Noneなら既定の3段階
+    stage_store: 学習済みステージの保存先。同じキーのステージがあれば
+        学習せずにその重みを使う (stage_keys()を参照)
+    initial_weights: 学習前に読み込んだ重みを表すweights_id()のキー。
+        stage_storeと両方あるときだけステージを再利用する
+    学習を最後のステージまで終えたらTrue、上限で止まったらFalseを返す
+    """
+    config = model.config
+    stages = stages or make_stages(config)
+    if not isinstance(patience, (list, tuple)):
+        patience = [patience] * len(stages)
+
+    # Image Augmentation
+    # Right/Left flip 50% of the time
+    augmentation = imgaug.augmenters.Fliplr(0.5)
+
+    #EarlyStopping
+    early_stopping = EMAEarlyStopping(patience=patience[0],log_dir=model.log_dir)
+
+    reuse = bool(stage_store and initial_weights)
+    if reuse:
+        keys = stage_keys(config, stages, patience, dataset_train, dataset_val,
+                          initial_weights)
+
+    for stage in range(first_stage, len(stages)):
+        message, learning_rate, epochs, layers = stages[stage]
+        if max_epochs is not None and model.epoch >= max_epochs:
+            return False
+        if reuse and load_stage(model, stage_store, keys[stage]):
+            print(message + " - reusing " + keys[stage])
+            model.save_training_state(stage=stage + 1)
+            continue
+        print(message)
+        early_stopping.patience = patience[stage]
+        model.train(dataset_train, dataset_val,
+                    learning_rate=learning_rate,
+                    epochs=epochs if max_epochs is None else min(epochs, max_epochs),
+                    layers=layers,
+                    augmentation=augmentation,
+                    custom_callbacks=[early_stopping],
+                    stage=stage)
+        # 上限で止まったステージはエポックごとに保存された状態から続ける
+        if max_epochs is not None and epochs > max_epochs and\
+                not model.keras_model.stop_training:
+            return False
+        model.epoch = early_stopping.best_epoch + 1
+        # 戻した最良の重みを最新のcheckpointにして、find_last()
+        # (evaluate --model=last) が過学習した最後の重みを使わないようにする
+        if model.checkpoints is not None:
+            with model.as_default():
+                model.checkpoints.rewind(model.epoch)
+        # Resume from the next stage if interrupted between stages
+        model.save_training_state(stage=stage + 1)
+        if reuse:
+            save_stage(model, stage_store, keys[stage], {
+                "stage": stage, "message": message, "learning_rate": learning_rate,
+                "epochs": epochs, "layers": layers, "patience": patience[stage],
+                "log_dir": model.log_dir})
+    return True
+
+
+def find_training_state(logs_dir):
+    """logs_dir内で最後に学習したtraining_state.pklのあるログディレクトリを返す"""
+    state_paths = sorted(glob.glob(os.path.join(
+        logs_dir, FilamentConfig.NAME.lower() + "*", modellib.TRAINING_STATE_FILE)))
+    return os.path.dirname(state_paths[-1]) if state_paths else None
 
 
 if __name__ == '__main__':
@@ -421,7 +645,7 @@ if __name__ == '__main__':
         description='Train Mask R-CNN on MS COCO.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'evaluate' on MS COCO")
+                        help="'train', 'resume', 'evaluate' or 'export'")
     parser.add_argument('--dataset', required=False,
                         default=DEFAULT_DATASET_DIR,
                         metavar="/path/to/coco/",
@@ -445,6 +669,14 @@ if __name__ == '__main__':
     parser.add_argument('--eval_type', required=False,
                         metavar="<evaluate type>",
                         help='Evaluate Annotation type')
+    parser.add_argument('--output', required=False,
+                        default="filament.pb",
+                        metavar="/path/to/graph.pb",
+                        help='Frozen graph file written by export (default=filament.pb)')
+    parser.add_argument('--batch_size', required=False,
+                        default=1, type=int,
+                        help='Images per batch of the exported graph, the --batch_size '
+                             'of filament_server.py (default=1)')
     args = parser.parse_args()
 
     print("Command:       ", args.command)
@@ -456,28 +688,37 @@ if __name__ == '__main__':
     print("Evaluate Type: ", args.eval_type)
 
         # Configurations
-    if args.command == "train":
+    if args.command in ["train", "resume"]:
         config = FilamentConfig()
     else:
         class InferenceConfig(FilamentConfig):
             # Set batch size to 1 since we'll be running inference on
             # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
             GPU_COUNT = 1
-            IMAGES_PER_GPU = 1
+            IMAGES_PER_GPU = args.batch_size if args.command == "export" else 1
             DETECTION_MIN_CONFIDENCE = 0
         config = InferenceConfig()
 
     config.display()
 
      # Create model
-    if args.command == "train":
+    if args.command in ["train", "resume"]:
         model = modellib.MaskRCNN(mode="training", config=config, model_dir=args.logs)
     else:
         model = modellib.MaskRCNN(mode="inference", config=config, model_dir=args.logs)
     
     # Load weights 
     print("Loading weights ", end="")
-    if args.model == "last":
+    model_path = None
+    if args.command == "resume":
+        # Weights, optimizer and callback state of the last interrupted run
+        log_dir = find_training_state(args.logs)
+        if not log_dir:
+            print("Error: No training state found in " + args.logs)
+            exit(1)
+        print(log_dir)
+        training_state = model.load_training_state(log_dir)
+    elif args.model == "last":
         # Find last trained weights
         model_path = model.find_last()
         print(model_path)
@@ -499,64 +740,25 @@ if __name__ == '__main__':
         model.load_weights(model_path, by_name=True)
     print("model load completed")
 
-    if args.command == "train":
+    if args.command in ["train", "resume"]:
         #Start Timer
         t_start = time.time()
 
-        # Training dataset
-        dataset_train = FilamentDataset()
-        dataset_train.load_coco(args.dataset,"train")
-        dataset_train.prepare()
-
-        # Validation dataset
-        dataset_val = FilamentDataset()
-        dataset_val.load_coco(args.dataset,"val",year=args.year)
-        dataset_val.prepare()
+        dataset_train, dataset_val = load_datasets(args.dataset, year=args.year,
+                                                   cache_dir=config.CACHE_DIR)
 
-        # Image Augmentation
-        # Right/Left flip 50% of the time
-        augmentation = imgaug.augmenters.Fliplr(0.5)
+        first_stage = 0
+        if args.command == "resume":
+            first_stage = training_state["stage"] or 0
+        # CACHE_DIRがあれば、同じ条件で学習済みのステージを再利用する
+        stage_store = None
+        if config.CACHE_DIR and args.command == "train":
+            stage_store = os.path.join(config.CACHE_DIR, "stages")
+        train(model, dataset_train, dataset_val, patience=EMAES_PATIENCE,
+              first_stage=first_stage, stage_store=stage_store,
+              initial_weights=weights_id(args.model, model_path))
 
-        #EarlyStopping
-        early_stopping = EMAEarlyStopping(patience=EMAES_PATIENCE,log_dir=model.log_dir)
-
-        #GetLosses
-        get_losses = GetLosses()
-
-        #Training - Stage 1
-        print("Stage 1 - Training network heads")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE,
-                    epochs=1,
-                    layers='heads',
-                    augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
-        model.epoch = early_stopping.best_epoch + 1
-
-        # Training - Stage 2
-        #Finetune layers from ResNet stage 4 and up
-        print("Stage 2 - Fine tune Resnet stage 4 and up")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE,
-                    epochs=2,
-                    layers='4+',
-                    augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
-        model.epoch = early_stopping.best_epoch + 1
-
-        # Training - Stage 3
-        # Fine tune all layers
-        print("Stage 3 - Fine tune all layers")
-        model.train(dataset_train, dataset_val,
-                    learning_rate=config.LEARNING_RATE / 10,
-                    epochs=3000,
-                    layers='all',
-                    augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
-        model.epoch = early_stopping.best_epoch + 1
-
-        timestamp = os.path.basename(model.log_dir)
-        dump_loss(get_losses, early_stopping.best_epoch, timestamp)
+        print("Losses saved to : " + os.path.join(model.log_dir, "metrics.jsonl"))
 
 
         print("---------------------------------------")
@@ -579,3 +781,10 @@ if __name__ == '__main__':
             print("Error: Please specify the evaluation type.")
             exit(1)
         evaluate_coco(model, dataset_val, coco, args.eval_type, limit=int(args.limit))
+
+    elif args.command == "export":
+        # Freeze the inference graph. Load it with
+        # frozen_model.FrozenDetector(path, InferenceConfig())
+        from mrcnn import frozen_model
+        frozen_model.export_frozen_graph(model, args.output)
+        print("Saved frozen graph to : " + args.output)
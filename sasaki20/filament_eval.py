@@ -17,8 +17,6 @@ import time
 import math
 import numpy as np
 import imgaug
-import json
-import collections as cl
 import warnings
 
 from pycocotools.coco import COCO
@@ -36,6 +34,7 @@ sys.path.append(ROOT_DIR)
 
 from mrcnn.config import Config
 from mrcnn import model as modellib, utils
+from mrcnn.instrument import timed
 
 os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
 import tensorflow as tf
@@ -70,6 +69,9 @@ class FilamentConfig(Config):
 
     BACKBONE = "resnet50"
 
+    # Keep the 3 best checkpoints by EMA val_loss, and the latest
+    CHECKPOINT_KEEP_BEST = 3
+
     STEPS_PER_EPOCH = 850
 
     #IMAGE_MAX_DIM = 768
@@ -155,37 +157,6 @@ class FilamentDataset(utils.Dataset):
         return m
 
 
-class GetLosses(keras.callbacks.Callback):
-    def __init__(self):
-        self.train_loss           = [0] * 1000
-        self.rpn_class_loss       = [0] * 1000
-        self.rpn_bbox_loss        = [0] * 1000
-        self.mrcnn_class_loss     = [0] * 1000
-        self.mrcnn_bbox_loss      = [0] * 1000
-        self.mrcnn_mask_loss      = [0] * 1000
-        self.val_loss             = [0] * 1000
-        self.val_rpn_class_loss   = [0] * 1000
-        self.val_rpn_bbox_loss    = [0] * 1000
-        self.val_mrcnn_class_loss = [0] * 1000
-        self.val_mrcnn_bbox_loss  = [0] * 1000
-        self.val_mrcnn_mask_loss  = [0] * 1000
-
-    def on_epoch_end(self, epoch, logs={}):
-        n = epoch
-        self.train_loss[n]           = logs['loss']
-        self.rpn_bbox_loss[n]        = logs['rpn_bbox_loss']
-        self.rpn_class_loss[n]       = logs['rpn_class_loss']
-        self.mrcnn_class_loss[n]     = logs['mrcnn_class_loss']
-        self.mrcnn_bbox_loss[n]      = logs['mrcnn_bbox_loss']
-        self.mrcnn_mask_loss[n]      = logs['mrcnn_mask_loss']
-        self.val_loss[n]             = logs['val_loss']
-        self.val_rpn_bbox_loss[n]    = logs['val_rpn_bbox_loss']
-        self.val_rpn_class_loss[n]   = logs['val_rpn_class_loss']
-        self.val_mrcnn_class_loss[n] = logs['val_mrcnn_class_loss']
-        self.val_mrcnn_bbox_loss[n]  = logs['val_mrcnn_bbox_loss']
-        self.val_mrcnn_mask_loss[n]  = logs['val_mrcnn_mask_loss']
-
-
 class EMAEarlyStopping(keras.callbacks.Callback):
     def __init__(self, log_dir, patience=0 ):
         self.ema_weight  = 0.7 
@@ -198,6 +169,17 @@ class EMAEarlyStopping(keras.callbacks.Callback):
         self.best_epoch  = 0
         self.stage_epoch = 0
         self.wait = 0
+        # Host memory copy of the weights of the best epoch
+        self.best_weights = None
+
+    def get_state(self):
+        # Saved with the training state, see MaskRCNN.load_training_state()
+        return {"ema": list(self.ema), "best_score": self.best_score,
+                "best_epoch": self.best_epoch, "stage_epoch": self.stage_epoch,
+                "wait": self.wait, "best_weights": self.best_weights}
+
+    def set_state(self, state):
+        self.__dict__.update(state)
 
     def on_epoch_begin(self, epoch, logs={}):
         if not self.stage_epoch == 0:
@@ -212,6 +194,7 @@ class EMAEarlyStopping(keras.callbacks.Callback):
         if self.best_score > self.ema[self.stage_epoch]:
             self.best_score = self.ema[self.stage_epoch]
             self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
             self.wait = 0
         else:
             self.wait += 1
@@ -224,15 +207,15 @@ class EMAEarlyStopping(keras.callbacks.Callback):
     def on_train_end(self,logs={}):
         print("Best epoch: " + str(self.best_epoch + 1))
         print("Best EMA val_loss: " + str(self.best_score))
-        print("Restoring model weights from the end of the best epoch.")
-
-        #Delete h5 files after the best epoch
-        for i in range(self.patience):
-            num = str(self.best_epoch + i + 1).zfill(4)
-            os.remove(self.log_dir + '/mask_rcnn_filament_' + num + '.h5')
-            print("removed: mask_rcnn_filament_"  + num + "h5") 
+        if self.best_weights is not None:
+            print("Restoring model weights from the end of the best epoch.")
+            self.model.set_weights(self.best_weights)
+            self.best_weights = None
+        # Checkpoints beyond the best ones are deleted by the checkpoint
+        # manager, see CHECKPOINT_KEEP_BEST
 
 
+@timed
 def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
     """
@@ -308,29 +291,6 @@ def evaluate_coco(model, dataset, coco, eval_type=None, limit=0, image_ids=None)
     print("Total time: ", time.time() - t_start)
 
 
-def dump_loss(get_losses, best_epoch, timestamp):
-    #Dump result to json
-    js = cl.OrderedDict()
-
-    js["train_loss"]       = get_losses.train_loss[0:best_epoch]
-    js["rpn_class_loss"]   = get_losses.rpn_class_loss[0:best_epoch]
-    js["rpn_bbox_loss"]    = get_losses.rpn_bbox_loss[0:best_epoch]
-    js["mrcnn_class_loss"] = get_losses.mrcnn_class_loss[0:best_epoch]
-    js["mrcnn_bbox_loss"]  = get_losses.mrcnn_bbox_loss[0:best_epoch]
-    js["mrcnn_mask_loss"]  = get_losses.mrcnn_mask_loss[0:best_epoch]
-    js["val_loss"]             = get_losses.val_loss[0:best_epoch]
-    js["val_rpn_class_loss"]   = get_losses.val_rpn_class_loss[0:best_epoch]
-    js["val_rpn_bbox_loss"]    = get_losses.val_rpn_bbox_loss[0:best_epoch]
-    js["val_mrcnn_class_loss"] = get_losses.val_mrcnn_class_loss[0:best_epoch]
-    js["val_mrcnn_bbox_loss"]  = get_losses.val_mrcnn_bbox_loss[0:best_epoch]
-    js["val_mrcnn_mask_loss"]  = get_losses.val_mrcnn_mask_loss[0:best_epoch]
-
-    jsonfilename = 'loss_log/loss_' + timestamp + '.json'
-    fw = open(jsonfilename,'w')
-    json.dump(js,fw)
-    print("Saved losses to : " + jsonfilename) 
-
-
 if __name__ == '__main__':
     import argparse
         # Parse command line arguments
@@ -437,9 +397,6 @@ if __name__ == '__main__':
         #EarlyStopping
         early_stopping = EMAEarlyStopping(patience=EMAES_PATIENCE,log_dir=model.log_dir)
 
-        #GetLosses
-        get_losses = GetLosses()
-
         #Training - Stage 1
         print("Stage 1 - Training network heads")
         model.train(dataset_train, dataset_val,
@@ -447,7 +404,7 @@ if __name__ == '__main__':
                     epochs=1000,
                     layers='heads',
                     augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
+                    custom_callbacks=[early_stopping])
         model.epoch = early_stopping.best_epoch + 1
 
         # Training - Stage 2
@@ -458,7 +415,7 @@ if __name__ == '__main__':
                     epochs=2000,
                     layers='4+',
                     augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
+                    custom_callbacks=[early_stopping])
         model.epoch = early_stopping.best_epoch + 1
 
         # Training - Stage 3
@@ -469,11 +426,10 @@ if __name__ == '__main__':
                     epochs=3000,
                     layers='all',
                     augmentation=augmentation,
-                    custom_callbacks=[early_stopping,get_losses])
+                    custom_callbacks=[early_stopping])
         model.epoch = early_stopping.best_epoch + 1
 
-        timestamp = os.path.basename(model.log_dir)
-        dump_loss(get_losses, early_stopping.best_epoch, timestamp)
+        print("Losses saved to : " + os.path.join(model.log_dir, "metrics.jsonl"))
 
 
         print("---------------------------------------")
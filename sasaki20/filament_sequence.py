@@ -0,0 +1,164 @@
+"""
+時系列フレームの推論
+ディレクトリ内のフレームをファイル名の順にdetectする。前にdetectしたフレームを
+太陽の自転の分だけ回して比べ、変化が--threshold未満ならdetectせずに前の検出を
+回して使う (mrcnn/sequence.py)
+--trackなら全フレームをdetectし、検出をフレーム間でつないでtrack IDを付ける。
+前のフレームの検出を回したボックスをROIとして加える (Config.PRIOR_ROIS) ので、
+--post_nmsでRPNのproposalを減らせる
+フレームの時刻はファイル名の YYYYMMDD_HHMMSS から読む。読めなければ--intervalを使う
+
+$ python3 filament_sequence.py /path/to/frames/ --model=last --threshold=0.02
+$ python3 filament_sequence.py /path/to/frames/ --graph=filament.pb --output=sequence.json
+$ python3 filament_sequence.py /path/to/frames/ --track --prior_rois=50 --post_nms=300
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import calendar
+
+import numpy as np
+import skimage.io
+import skimage.color
+
+ROOT_DIR = os.path.abspath("../")
+CURRENT_DIR = os.getcwd()
+DEFAULT_LOGS_DIR = os.path.join(CURRENT_DIR, "logs")
+
+sys.path.append(ROOT_DIR)
+
+from mrcnn import model as modellib
+from mrcnn.sequence import SequenceDetector, Tracker
+import filament
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+TIME_PATTERN = re.compile(r"(\d{8})[_T-]?(\d{6})")
+
+
+def frame_time(path):
+    """ファイル名の YYYYMMDD_HHMMSS (UTC) を秒にする。なければNone"""
+    m = TIME_PATTERN.search(os.path.basename(path))
+    if not m:
+        return None
+    return calendar.timegm(time.strptime(m.group(1) + m.group(2), "%Y%m%d%H%M%S"))
+
+
+def load_frame(path):
+    """Dataset.load_image()と同じくRGBで読む"""
+    image = skimage.io.imread(path)
+    if image.ndim != 3:
+        image = skimage.color.gray2rgb(image)
+    if image.shape[-1] == 4:
+        image = image[..., :3]
+    return image
+
+
+def run_sequence(detector, paths, interval=None):
+    """フレームを順にdetectし、フレームごとの結果のリストを返す"""
+    results = []
+    for i, path in enumerate(paths):
+        t = frame_time(path)
+        if t is None and interval:
+            t = i * interval
+        t_start = time.time()
+        r = detector.detect(load_frame(path), t)
+        results.append({
+            "file": os.path.basename(path),
+            "reused": r.get("reused", False),
+            "change": None if np.isinf(r.get("change", np.inf)) else float(r["change"]),
+            "instances": int(len(r["rois"])),
+            "ms": (time.time() - t_start) * 1000,
+        })
+        if "track_ids" in r:
+            results[-1]["track_ids"] = [int(i) for i in r["track_ids"]]
+            results[-1]["rois"] = r["rois"].tolist()
+        print("{:40} {:>8} {:>10} {:>4} {:8.1f} ms".format(
+            results[-1]["file"], "reused" if results[-1]["reused"] else "detected",
+            "-" if results[-1]["change"] is None else "{:.4f}".format(r["change"]),
+            results[-1]["instances"], results[-1]["ms"]))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Detect filaments on a time series of frames, reusing detections '
+                    'of frames that barely changed.')
+    parser.add_argument("frames",
+                        metavar="/path/to/frames/",
+                        help='Directory of frames, in time order by file name')
+    parser.add_argument('--model', required=False,
+                        default="last",
+                        metavar="/path/to/weights.h5",
+                        help="Path to weights .h5 file or 'last'")
+    parser.add_argument('--graph', required=False,
+                        metavar="/path/to/graph.pb",
+                        help='Use a frozen graph from filament.py export instead')
+    parser.add_argument('--logs', required=False,
+                        default=DEFAULT_LOGS_DIR,
+                        metavar="/path/to/logs/",
+                        help='Logs and checkpoints directory (default=logs/)')
+    parser.add_argument('--threshold', required=False,
+                        default=0.02, type=float,
+                        help='Relative change below which detections are reused, '
+                             '0 to detect every frame (default=0.02)')
+    parser.add_argument('--max_skip', required=False,
+                        default=10, type=int,
+                        help='Frames in a row that can reuse detections (default=10)')
+    parser.add_argument('--interval', required=False,
+                        default=None, type=float,
+                        help='Seconds between frames whose names have no time '
+                             '(default=none, no rotation)')
+    parser.add_argument('--track', required=False,
+                        action="store_true",
+                        help='Detect every frame and link the detections into tracks')
+    parser.add_argument('--prior_rois', required=False,
+                        default=0, type=int,
+                        help='With --track, previous detections to add to the RPN '
+                             'proposals (default=0)')
+    parser.add_argument('--post_nms', required=False,
+                        default=None, type=int,
+                        help='POST_NMS_ROIS_INFERENCE (default=FilamentConfig)')
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/sequence.json",
+                        help='Write the per-frame results to this file')
+    args = parser.parse_args()
+
+    class InferenceConfig(filament.FilamentConfig):
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = 1
+        PRIOR_ROIS = args.prior_rois if args.track else 0
+        POST_NMS_ROIS_INFERENCE = args.post_nms or filament.FilamentConfig.POST_NMS_ROIS_INFERENCE
+    config = InferenceConfig()
+
+    if args.graph:
+        from mrcnn.frozen_model import FrozenDetector
+        model = FrozenDetector(args.graph, config)
+    else:
+        model = modellib.MaskRCNN(mode="inference", config=config, model_dir=args.logs)
+        model_path = model.find_last() if args.model == "last" else args.model
+        print("Loading weights ", model_path)
+        model.load_weights(model_path, by_name=True)
+
+    paths = sorted(os.path.join(args.frames, f) for f in os.listdir(args.frames)
+                   if f.lower().endswith(IMAGE_EXTENSIONS))
+    if args.track:
+        detector = Tracker(model)
+    else:
+        detector = SequenceDetector(model, threshold=args.threshold, max_skip=args.max_skip)
+    results = run_sequence(detector, paths, args.interval)
+
+    reused = sum(r["reused"] for r in results)
+    stats = {"frames": len(results), "detected": len(results) - reused, "reused": reused}
+    if args.track:
+        stats["tracks"] = detector.next_id - 1
+    ms = [r["ms"] for r in results]
+    print(", ".join("{} {}".format(v, k) for k, v in stats.items()))
+    if ms:
+        print("{:.1f} ms/frame".format(np.mean(ms)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"stats": stats, "frames": results}, f, indent=2)
@@ -0,0 +1,314 @@
+"""
+推論サーバー
+HTTPで受け取ったフレームをマイクロバッチにまとめてdetectする
+
+$ python3 filament_server.py --model=last --batch_size=4 --window=20
+$ python3 filament_server.py --graph=filament.pb   (filament.py exportの出力)
+--graphのときの--batch_sizeはexportの--batch_sizeと同じにする
+(グラフはexport時のバッチサイズでしか動かない)
+
+POST /detect?format=rle|polygon   body: PNG/JPEG画像
+GET  /stats                       キュー長・バッチ充填率・レイテンシ
+                                  (MRCNN_PROFILE=1なら関数ごとの処理時間も)
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import queue
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import skimage.io
+import skimage.color
+import skimage.measure
+from pycocotools import mask as maskUtils
+
+ROOT_DIR = os.path.abspath("../")
+CURRENT_DIR = os.getcwd()
+DEFAULT_LOGS_DIR = os.path.join(CURRENT_DIR, "logs")
+
+sys.path.append(ROOT_DIR)
+
+from mrcnn import model as modellib, instrument
+import filament
+
+
+############################################################
+#  Micro-batching
+############################################################
+
+class Request(object):
+    """A frame waiting for detection and, once done, its result."""
+
+    def __init__(self, image):
+        self.image = image
+        self.arrived = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Groups concurrently submitted frames into batches of up to BATCH_SIZE
+    and runs one detect() call per batch on a single worker thread.
+
+    A batch is dispatched when it's full or when `window` seconds have passed
+    since its first frame arrived, whichever comes first. Short batches are
+    padded with copies of the last frame because the model is built for a
+    fixed batch size.
+    """
+
+    def __init__(self, model, window=0.02, history=1000):
+        """
+        model: A MaskRCNN (or FrozenDetector) in inference mode
+        window: Seconds to wait for more frames before running a short batch
+        history: Number of recent requests and batches to compute stats on
+        """
+        self.model = model
+        self.batch_size = model.config.BATCH_SIZE
+        self.window = window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=history)
+        self.fills = collections.deque(maxlen=history)
+        self.request_count = 0
+        self.batch_count = 0
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image):
+        """Queues a frame and blocks until its detection result is ready.
+        Returns the result dict of MaskRCNN.detect()."""
+        request = Request(image)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        """Blocks for the first frame, then collects more until the batch is
+        full or the window of the first frame has passed. Frames that are
+        already queued are always taken, even if the window has passed."""
+        batch = [self.queue.get()]
+        deadline = batch[0].arrived + self.window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """Worker loop."""
+        while True:
+            batch = self.next_batch()
+            images = [r.image for r in batch]
+            images += [images[-1]] * (self.batch_size - len(images))
+            try:
+                results = self.model.detect(images)
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finished = time.time()
+            with self.lock:
+                self.batch_count += 1
+                self.request_count += len(batch)
+                self.fills.append(len(batch) / self.batch_size)
+                self.latencies.extend(finished - r.arrived for r in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        """Returns queue depth, batch fill ratio and latency percentiles (ms)
+        over the recent history."""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            fills = np.array(self.fills)
+            stats = {
+                "queue_depth": self.queue.qsize(),
+                "batch_size": self.batch_size,
+                "window_ms": self.window * 1000,
+                "requests": self.request_count,
+                "batches": self.batch_count,
+                "batch_fill_ratio": float(fills.mean()) if fills.size else None,
+            }
+        for p in [50, 90, 95, 99]:
+            stats["latency_p{}_ms".format(p)] =\
+                float(np.percentile(latencies, p)) if latencies.size else None
+        stats["latency_max_ms"] = float(latencies.max()) if latencies.size else None
+        if instrument.ENABLED:
+            stats["profile"] = instrument.summary()
+        return stats
+
+
+############################################################
+#  Result encoding
+############################################################
+
+def decode_image(data):
+    """Decodes PNG/JPEG bytes into an RGB image like Dataset.load_image()."""
+    image = skimage.io.imread(io.BytesIO(data))
+    # If grayscale. Convert to RGB for consistency.
+    if image.ndim != 3:
+        image = skimage.color.gray2rgb(image)
+    # If has an alpha channel, remove it for consistency
+    if image.shape[-1] == 4:
+        image = image[..., :3]
+    return image
+
+
+def mask_to_polygons(mask):
+    """Returns the outlines of a binary mask as lists of [x, y] points."""
+    # Pad to ensure proper polygons for masks that touch image edges.
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mask
+    contours = skimage.measure.find_contours(padded, 0.5)
+    # Flip (y, x) to (x, y) and subtract the padding. Contours run through
+    # pixel centers, which are at +0.5 in COCO polygon coordinates.
+    return [np.around(np.fliplr(c) - 0.5, 1).tolist() for c in contours]
+
+
+def encode_result(r, mask_format="rle"):
+    """Converts a detect() result into a JSON-friendly dict. Masks become
+    COCO RLEs or polygons."""
+    masks = r["masks"]
+    if mask_format == "polygon":
+        segmentations = [mask_to_polygons(masks[:, :, i])
+                         for i in range(masks.shape[-1])]
+    elif masks.shape[-1] == 0:
+        segmentations = []
+    else:
+        rles = maskUtils.encode(np.asfortranarray(masks.astype(np.uint8)))
+        segmentations = [{"size": rle["size"], "counts": rle["counts"].decode("ascii")}
+                         for rle in rles]
+    return {
+        "rois": r["rois"].tolist(),
+        "class_ids": r["class_ids"].tolist(),
+        "scores": np.around(r["scores"], 4).tolist(),
+        "masks": segmentations,
+    }
+
+
+############################################################
+#  HTTP server
+############################################################
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DetectHandler(BaseHTTPRequestHandler):
+    # Set by main()
+    batcher = None
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self.send_json(self.batcher.stats())
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/detect":
+            self.send_json({"error": "not found"}, 404)
+            return
+        mask_format = parse_qs(url.query).get("format", ["rle"])[0]
+        if mask_format not in ["rle", "polygon"]:
+            self.send_json({"error": "format must be 'rle' or 'polygon'"}, 400)
+            return
+        try:
+            data = self.rfile.read(int(self.headers["Content-Length"]))
+            image = decode_image(data)
+        except Exception as e:
+            self.send_json({"error": "bad image: {}".format(e)}, 400)
+            return
+        try:
+            r = self.batcher.submit(image)
+        except Exception as e:
+            self.send_json({"error": str(e)}, 500)
+            return
+        self.send_json(encode_result(r, mask_format))
+
+    def log_message(self, format, *args):
+        # Per-request logging costs more than the requests. Use /stats.
+        pass
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Micro-batching Mask R-CNN detection server.')
+    parser.add_argument('--model', required=False,
+                        default="last",
+                        metavar="/path/to/weights.h5",
+                        help="Path to weights .h5 file or 'last'")
+    parser.add_argument('--graph', required=False,
+                        metavar="/path/to/graph.pb",
+                        help='Serve a frozen graph from filament.py export instead')
+    parser.add_argument('--logs', required=False,
+                        default=DEFAULT_LOGS_DIR,
+                        metavar="/path/to/logs/",
+                        help='Logs and checkpoints directory (default=logs/)')
+    parser.add_argument('--batch_size', required=False,
+                        default=1, type=int,
+                        help='Maximum frames per forward pass (default=1)')
+    parser.add_argument('--window', required=False,
+                        default=20, type=float,
+                        help='Milliseconds to wait to fill a batch (default=20)')
+    parser.add_argument('--host', required=False,
+                        default="127.0.0.1",
+                        help='Address to listen on (default=127.0.0.1)')
+    parser.add_argument('--port', required=False,
+                        default=8000, type=int,
+                        help='Port to listen on (default=8000)')
+    args = parser.parse_args()
+
+    if args.graph:
+        from mrcnn.frozen_model import FrozenDetector, read_batch_size
+        # The frozen graph only runs batches of the size it was exported with
+        graph_batch_size = read_batch_size(args.graph)
+        if graph_batch_size is not None and graph_batch_size != args.batch_size:
+            parser.error("{} was exported with --batch_size={}, but the server has "
+                         "--batch_size={}. Use the same batch size or export the "
+                         "graph again.".format(args.graph, graph_batch_size, args.batch_size))
+
+    class InferenceConfig(filament.FilamentConfig):
+        GPU_COUNT = 1
+        IMAGES_PER_GPU = args.batch_size
+    config = InferenceConfig()
+    config.display()
+
+    if args.graph:
+        model = FrozenDetector(args.graph, config)
+    else:
+        model = modellib.MaskRCNN(mode="inference", config=config, model_dir=args.logs)
+        model_path = model.find_last() if args.model == "last" else args.model
+        print("Loading weights ", model_path)
+        model.load_weights(model_path, by_name=True)
+
+    DetectHandler.batcher = MicroBatcher(model, window=args.window / 1000)
+    server = ThreadingHTTPServer((args.host, args.port), DetectHandler)
+    print("Serving on http://{}:{}".format(args.host, args.port))
+    server.serve_forever()
@@ -1,3 +1,9 @@
+"""
+$ python3 plot_loss.py                      最新の logs/*/metrics.jsonl
+$ python3 plot_loss.py logs/filament2019...  学習ログのディレクトリかmetrics.jsonl
+$ python3 plot_loss.py loss_log/xxx.json     以前のdump_lossの出力
+"""
+
 import os
 import sys
 from glob import glob
@@ -9,15 +15,25 @@ import matplotlib.pyplot as plt
 import collections as cl
 import json
 
+ROOT_DIR = os.path.abspath("../")
+sys.path.append(ROOT_DIR)
+from mrcnn import metrics
+
 args = sys.argv
 
 if len(args) == 2:
     JSON_FILE = args[1]
 elif len(args) == 1:
-    loss_log_dir = os.path.join(os.getcwd(), "loss_log/")
-    target = os.path.join(loss_log_dir, '*.json')
-    files = [(f, os.path.getmtime(f)) for f in glob(target)]
-    JSON_FILE = sorted(files, key=lambda files: files[1])[-1][0]
+    JSON_FILE = metrics.find_metrics(os.path.join(os.getcwd(), "logs"))[-1]
+
+
+def load_losses(path):
+    if path.endswith(".json"):
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    data = metrics.read_metrics(path)
+    data["train_loss"] = data["loss"]
+    return data
 
 
 def ema_loss(data):
@@ -104,8 +120,7 @@ def losses(data):
 
 
 def main():
-    json_file = open(JSON_FILE, 'r')
-    data = json.load(json_file)
+    data = load_losses(JSON_FILE)
 
     losses(data)
     ema_loss(data)
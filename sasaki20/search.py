@@ -0,0 +1,227 @@
+"""
+ハイパーパラメータ探索 (Successive Halving)
+探索空間から選んだ設定を少ないエポック数で並列に学習し、EMA val_lossの
+悪い方から順に打ち切って、残った設定にエポック数を増やしていく
+
+$ python3 search.py search_space.json --trials=27 --min_epochs=2 --eta=3
+$ python3 search.py search_space.json --trials=9 --processes=3 --gpus=0,1,2
+
+探索空間の形式
+{
+    "fixed": {"STEPS_PER_EPOCH": 850},
+    "space": {
+        "RPN_ANCHOR_SCALES": [[32, 64, 128, 256], [16, 32, 64, 128]],
+        "RPN_ANCHOR_RATIOS": [[0.5, 1, 2], [0.25, 0.5, 1, 2, 4]],
+        "BACKBONE_STRIDES": [[4, 8, 16, 32]],
+        "EMAES_PATIENCE": [5, 10, 15]
+    }
+}
+- fixed: 全候補に共通のFilamentConfigの上書き
+- space: FilamentConfigの項目(とEMAES_PATIENCE)ごとの候補。全組み合わせから
+         --trials個をランダムに選ぶ
+
+1段目は全候補を--min_epochsエポックまで学習し、上位1/etaを残してエポック数を
+eta倍にする。候補が1つになるか--max_epochsに達するまで繰り返す。
+学習は各候補のtraining_state.pklから続けるので、やり直しはない。
+スコアは学習中のEMA val_lossの最小値 (EMAEarlyStoppingと同じ重み)
+候補ごとに logs/search/<trial>/、結果は logs/search/search.json
+"""
+
+import os
+import json
+import math
+import random
+import itertools
+
+import experiment
+
+CURRENT_DIR = os.getcwd()
+DEFAULT_LOGS_DIR = os.path.join(CURRENT_DIR, "logs", "search")
+DEFAULT_DATASET_DIR = os.path.join(CURRENT_DIR, "dataset")
+
+
+def ema(values, weight=0.7):
+    """EMAEarlyStoppingと同じ指数移動平均の列を返す"""
+    averages = []
+    for v in values:
+        averages.append(v if not averages else
+                        (1 - weight) * v + weight * averages[-1])
+    return averages
+
+
+def sample_trials(spec, count, seed=None):
+    """探索空間の全組み合わせから最大count個の候補を選ぶ"""
+    fixed = spec.get("fixed", {})
+    names = sorted(spec["space"])
+    candidates = []
+    for values in itertools.product(*[spec["space"][n] for n in names]):
+        config = dict(fixed, **dict(zip(names, values)))
+        # Each anchor scale needs a backbone level (stride) to go with
+        strides = config.get("BACKBONE_STRIDES")
+        scales = config.get("RPN_ANCHOR_SCALES")
+        if strides is not None and scales is not None and len(scales) > len(strides):
+            continue
+        candidates.append(config)
+    random.Random(seed).shuffle(candidates)
+
+    trials = []
+    for i, config in enumerate(candidates[:count]):
+        patience = config.pop("EMAES_PATIENCE", None)
+        trials.append({"name": "trial_{:03d}".format(i), "config": config,
+                       "patience": patience})
+    return trials
+
+
+def run_trial(trial, max_epochs, options):
+    """プールのプロセスで1つの候補をmax_epochsエポックまで学習する
+    前の段の続きから学習し、スコアを含む結果のdictを返す
+    """
+    log_dir = os.path.join(options["logs"], trial["name"])
+    result = {"name": trial["name"], "budget": max_epochs}
+    with experiment.use_slot(log_dir, result, options["threads"]) as session_config:
+        import filament
+        from mrcnn import model as modellib, metrics
+
+        config = filament.make_config(dict(trial["config"], CACHE_DIR=options["cache_dir"]))
+        model = modellib.MaskRCNN(mode="training", config=config, model_dir=log_dir,
+                                  session_config=session_config)
+        first_stage = 0
+        initial_weights = None
+        state_dir = filament.find_training_state(log_dir)
+        if state_dir:
+            first_stage = model.load_training_state(state_dir)["stage"] or 0
+        else:
+            initial_weights = experiment.load_initial_weights(model, options["model"])
+        dataset_train, dataset_val = filament.load_datasets(
+            options["dataset"], year=options["year"], cache_dir=options["cache_dir"])
+        result["finished"] = filament.train(
+            model, dataset_train, dataset_val,
+            patience=trial["patience"] or filament.EMAES_PATIENCE,
+            first_stage=first_stage, max_epochs=max_epochs,
+            stage_store=os.path.join(options["cache_dir"], "stages"),
+            initial_weights=initial_weights)
+        # None if every stage was reused and nothing was trained
+        if model.checkpoints:
+            model.checkpoints.wait()
+
+        val_loss = [v for v in metrics.read_metrics(model.log_dir)["val_loss"]
+                    if v is not None]
+        result["epochs"] = len(val_loss)
+        if val_loss:
+            result["score"] = min(ema(val_loss, config.CHECKPOINT_EMA_WEIGHT))
+    return result
+
+
+def successive_halving(trials, pool, options, min_epochs, eta=3, max_epochs=None):
+    """Successive Halvingで候補を絞る。各段の結果のリストを返す"""
+    if max_epochs is None:
+        rounds = math.ceil(math.log(max(len(trials), 1), eta))
+        max_epochs = min_epochs * eta ** rounds
+    rungs = []
+    results = {}
+    alive = trials
+    budget = min_epochs
+    while True:
+        print("Rung {}: {} trials, {} epochs".format(len(rungs), len(alive), budget))
+        # Trials that finished all stages early keep their score
+        pending = [(t, pool.apply_async(run_trial, (t, budget, options)))
+                   for t in alive if not results.get(t["name"], {}).get("finished")]
+        for trial, r in pending:
+            results[trial["name"]] = dict(r.result(), name=trial["name"], budget=budget)
+        ranked = sorted(alive, key=lambda t: results[t["name"]].get("score", math.inf))
+        rungs.append({"budget": budget,
+                      "results": [results[t["name"]] for t in ranked]})
+        for t in ranked:
+            r = results[t["name"]]
+            if "score" in r:
+                status = "EMA val_loss {:.4f} ({} epochs)".format(r["score"], r["epochs"])
+            else:
+                status = "no val_loss"
+            print("  {:12} {}".format(t["name"], r.get("error") or status))
+        if len(ranked) <= 1 or budget >= max_epochs:
+            break
+        alive = ranked[:max(len(ranked) // eta, 1)]
+        budget = min(budget * eta, max_epochs)
+    return rungs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Successive halving search over FilamentConfig.')
+    parser.add_argument("space",
+                        metavar="/path/to/search_space.json",
+                        help='Search space file')
+    parser.add_argument('--trials', required=False,
+                        default=27, type=int,
+                        help='Configs to start with (default=27)')
+    parser.add_argument('--min_epochs', required=False,
+                        default=2, type=int,
+                        help='Epochs of the first rung (default=2)')
+    parser.add_argument('--eta', required=False,
+                        default=3, type=int,
+                        help='Keep the best 1/eta of the trials per rung (default=3)')
+    parser.add_argument('--max_epochs', required=False,
+                        default=None, type=int,
+                        help='Epochs of the last rung (default=min_epochs * eta^rungs)')
+    parser.add_argument('--seed', required=False,
+                        default=None, type=int,
+                        help='Seed to sample the trials with')
+    parser.add_argument('--model', required=False,
+                        default="ImageNet",
+                        metavar="/path/to/weights.h5",
+                        help="Initial weights: 'ImageNet', 'CoCo', 'random' or a .h5 file")
+    parser.add_argument('--dataset', required=False,
+                        default=DEFAULT_DATASET_DIR,
+                        metavar="/path/to/coco/",
+                        help='Directory of the MS-COCO dataset')
+    parser.add_argument('--year', required=False,
+                        default=2016, type=int,
+                        help='Validation set year (default=2016)')
+    parser.add_argument('--logs', required=False,
+                        default=DEFAULT_LOGS_DIR,
+                        metavar="/path/to/logs/",
+                        help='Logs and checkpoints directory (default=logs/search/)')
+    parser.add_argument('--processes', required=False,
+                        default=1, type=int,
+                        help='Trials to train at the same time (default=1)')
+    parser.add_argument('--cores', required=False,
+                        default=0, type=int,
+                        help='CPU cores per trial (default=all cores / processes)')
+    parser.add_argument('--threads', required=False,
+                        default=0, type=int,
+                        help='TensorFlow and OpenMP threads per trial (default=cores)')
+    parser.add_argument('--gpus', required=False,
+                        default="",
+                        help='Comma separated GPU ids to spread the trials over')
+    args = parser.parse_args()
+
+    with open(args.space) as f:
+        spec = json.load(f)
+    trials = sample_trials(spec, args.trials, seed=args.seed)
+    options = {
+        "model": args.model,
+        "dataset": args.dataset,
+        "year": args.year,
+        "logs": args.logs,
+        "threads": args.threads,
+        "cache_dir": os.path.join(args.logs, "cache"),
+    }
+
+    pool = experiment.make_pool(args.processes, args.cores, args.gpus)
+    rungs = successive_halving(trials, pool, options, args.min_epochs,
+                               eta=args.eta, max_epochs=args.max_epochs)
+    pool.close()
+    pool.join()
+
+    os.makedirs(args.logs, exist_ok=True)
+    with open(os.path.join(args.logs, "search.json"), "w") as f:
+        json.dump({"trials": trials, "rungs": rungs}, f, indent=2)
+
+    # The winner, ready to paste into experiments.json
+    best = rungs[-1]["results"][0]["name"]
+    trial = [t for t in trials if t["name"] == best][0]
+    entry = {"name": best, "config": trial["config"]}
+    if trial["patience"]:
+        entry["patience"] = trial["patience"]
+    print("Best: " + json.dumps(entry))
@@ -0,0 +1,74 @@
+"""
+Mask R-CNN
+Tests of the numpy crop-and-resize kernel in bilinear.py. They don't need
+TensorFlow.
+
+$ python -m pytest tests/
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import skimage.transform
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from mrcnn.bilinear import crop_and_resize
+
+
+def resize(mask, shape):
+    """skimage resize() with the settings of utils.resize()"""
+    return skimage.transform.resize(mask.astype(float), shape, order=1,
+                                    mode="constant", cval=0, clip=True,
+                                    preserve_range=False, anti_aliasing=False)
+
+
+def check(images, boxes, shapes):
+    result = np.around(crop_and_resize(images, boxes, shapes)).astype(bool)
+    for i, ((y1, x1, y2, x2), (h, w)) in enumerate(zip(boxes, shapes)):
+        expected = resize(images[y1:y2, x1:x2, i], (h, w))
+        # Pixels exactly halfway between two values round either way,
+        # depending on the float error of the coordinate math
+        differ = result[i, :h, :w] != np.around(expected).astype(bool)
+        assert not np.any(differ & (np.abs(expected - 0.5) > 1e-6)), (boxes[i], shapes[i])
+        # Padding up to the largest output shape stays empty
+        assert not result[i, h:].any() and not result[i, :, w:].any()
+
+
+@pytest.mark.parametrize("box_shape", [(1, 1), (1, 7), (7, 1), (1, 30), (30, 1),
+                                       (2, 1), (2, 3)])
+def test_thin_boxes(box_shape):
+    h, w = box_shape
+    images = np.zeros([40, 40, 3], dtype=bool)
+    boxes = np.array([[5, 6, 5 + h, 6 + w],
+                      [10, 2, 10 + h, 2 + w],
+                      [0, 0, 40, 40]])
+    # A box filled by its instance, one with a gap, and a large one
+    images[5:5 + h, 6:6 + w, 0] = True
+    images[10:10 + h, 2:2 + w, 1] = True
+    images[10, 2, 1] = False
+    images[3:20, 4:9, 2] = True
+    for shape in [(56, 56), (28, 14), (3, 60)]:
+        check(images, boxes, [shape] * 3)
+    # A full thin box gives a full mini mask
+    assert crop_and_resize(images, boxes, (56, 56))[0].min() == 1
+
+
+def test_random_masks():
+    rng = np.random.RandomState(0)
+    n = 500
+    images = rng.rand(48, 48, n) > 0.4
+    # Some uniform masks, the case that needs the clip
+    images[..., :50] = True
+    y1, x1 = rng.randint(0, 40, [2, n])
+    h, w = rng.randint(1, 9, [2, n])
+    boxes = np.stack([y1, x1, y1 + h, x1 + w], axis=1)
+    shapes = rng.randint(1, 40, [n, 2])
+    check(images, boxes, shapes)
+
+
+def test_empty():
+    assert crop_and_resize(np.zeros([4, 4, 0], dtype=bool),
+                           np.zeros([0, 4]), (3, 3)).shape == (0, 0, 0)
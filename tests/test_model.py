@@ -0,0 +1,46 @@
+"""
+Mask R-CNN
+Tests of graph layers in model.py.
+
+$ python -m pytest tests/
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from mrcnn import model as modellib
+
+
+@pytest.mark.parametrize("pool_size", [7, 14])
+def test_pyramid_roi_align_fused(pool_size):
+    """crop_fused() pools the same values as crop_per_level()"""
+    rng = np.random.RandomState(0)
+    batch, count, dim = 2, 300, 256
+    feature_maps = [rng.rand(batch, dim // s, dim // s, 8).astype(np.float32)
+                    for s in [4, 8, 16, 32]]
+    # Sizes spread over all levels, from a few pixels to the whole image
+    size = np.exp(rng.uniform(np.log(0.01), np.log(1.0), (batch, count, 2)))
+    y1x1 = rng.uniform(0, 1, (batch, count, 2)) * (1 - size)
+    boxes = np.concatenate([y1x1, y1x1 + size], axis=2).astype(np.float32)
+    # Zero padding, like the output of ProposalLayer
+    boxes[:, -30:] = 0
+    image_meta = np.stack([modellib.compose_image_meta(
+        0, (dim, dim, 3), (dim, dim, 3), (0, 0, dim, dim), 1.0,
+        np.ones(2))] * batch).astype(np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        inputs = [tf.constant(boxes), tf.constant(image_meta)] +\
+            [tf.constant(f) for f in feature_maps]
+        per_level, fused = sess.run([
+            modellib.PyramidROIAlign([pool_size, pool_size], fused=fused).call(inputs)
+            for fused in [False, True]])
+    assert fused.shape == (batch, count, pool_size, pool_size, 8)
+    # Float error of the atlas coordinates only
+    assert np.allclose(fused, per_level, rtol=0, atol=1e-4)
@@ -0,0 +1,100 @@
+"""
+Mask R-CNN
+Tests of the mini mask functions in utils.py. See test_bilinear.py for
+the crop-and-resize kernel they use.
+
+$ python -m pytest tests/
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from mrcnn import utils
+
+
+def resize_each(mask, bbox, shape):
+    """The per-instance skimage path that crop_and_resize() replaces"""
+    return np.stack([
+        np.around(utils.resize(mask[y1:y2, x1:x2, i].astype(float), shape)).astype(bool)
+        for i, (y1, x1, y2, x2) in enumerate(bbox)], axis=-1)
+
+
+@pytest.mark.parametrize("box_shape", [(1, 1), (1, 7), (7, 1), (1, 30), (30, 1), (2, 1)])
+def test_minimize_mask_thin_boxes(box_shape):
+    h, w = box_shape
+    mask = np.zeros([40, 40, 3], dtype=bool)
+    bbox = np.array([[5, 6, 5 + h, 6 + w],
+                     [10, 2, 10 + h, 2 + w],
+                     [0, 0, 40, 40]])
+    mask[5:5 + h, 6:6 + w, 0] = True
+    mask[10:10 + h, 2:2 + w, 1] = True
+    mask[10:10 + h, 2, 1] = False
+    mask[3:20, 4:9, 2] = True
+
+    mini = utils.minimize_mask(bbox, mask, (56, 56))
+    assert np.array_equal(mini, resize_each(mask, bbox, (56, 56)))
+    # A thin box filled by its instance gives a full mini mask
+    assert mini[..., 0].all()
+
+
+@pytest.mark.parametrize("box_shape", [(1, 1), (1, 7), (7, 1), (1, 30), (30, 1)])
+def test_expand_mask_thin_boxes(box_shape):
+    h, w = box_shape
+    bbox = np.array([[5, 6, 5 + h, 6 + w], [0, 0, 40, 40]])
+    mini = np.ones([56, 56, 2], dtype=bool)
+    mini[:, :28, 1] = False
+
+    mask = utils.expand_mask(bbox, mini, (40, 40))
+    expected = np.zeros_like(mask)
+    for i, (y1, x1, y2, x2) in enumerate(bbox):
+        expected[y1:y2, x1:x2, i] = np.around(
+            utils.resize(mini[..., i].astype(float), (y2 - y1, x2 - x1))).astype(bool)
+    assert np.array_equal(mask, expected)
+    assert mask[5:5 + h, 6:6 + w, 0].all()
+
+
+def disk_frame(shape, y, x, radius):
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    image = np.zeros(tuple(shape) + (3,), dtype=np.uint8)
+    image[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] = 200
+    return image
+
+
+def test_find_disk():
+    image = disk_frame((300, 400), 150, 180, 120)
+    # A time stamp in a corner is a separate region
+    image[5:15, 5:60] = 255
+    y, x, radius = utils.find_disk(image)
+    assert abs(y - 150) <= 1 and abs(x - 180) <= 1 and abs(radius - 120) <= 1
+    # A small bright region alone isn't a disk
+    assert utils.find_disk(disk_frame((300, 400), 150, 180, 10)) is None
+
+
+@pytest.mark.parametrize("center", [(150, 180), (100, 330), (250, 60)])
+def test_resize_disk(center):
+    image = disk_frame((300, 400), center[0], center[1], 120)
+    disk = utils.find_disk(image)
+    resized, window, scale, padding, crop = utils.resize_image(
+        image, max_dim=128, mode="disk", disk=disk)
+    assert resized.shape == (128, 128, 3) and resized.dtype == np.uint8
+    assert scale == 128 / round(2 * disk[2])
+    # A mask resized with the returned scale, padding and crop lines up
+    # with the image
+    mask = utils.resize_mask(image[..., :1] > 0, scale, padding, crop)[..., 0]
+    on_disk = resized[..., 0] > 100
+    assert (mask & on_disk).sum() / (mask | on_disk).sum() > 0.97
+
+
+def test_resize_disk_too_small():
+    image = disk_frame((300, 400), 150, 180, 120)
+    # Scaling a 20 pixel disk to 128 pixels would scale the frame 6x
+    resized, window, scale, padding, crop = utils.resize_image(
+        image, max_dim=128, mode="disk", disk=(150, 180, 10))
+    assert resized.shape == (128, 128, 3) and scale == 128 / 400 and crop is None